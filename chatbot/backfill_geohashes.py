@@ -0,0 +1,24 @@
+"""
+One-off migration for the geohash index on posts.
+
+The nearby-post lookups query Firestore by the `geohash` field that CreatePost writes next to
+each post's GeoPoint, so posts created before that field existed are never found until this
+has run. Run it once per project, before deploying the chatbot that reads the index:
+
+    python backfill_geohashes.py [path/to/service-account.json]
+
+from the chatbot directory (the credentials default to newcredential.json). Posts that already
+have a geohash are skipped, so running it again is harmless.
+"""
+import sys
+
+from new import FirebaseDataFetcher
+
+
+def main():
+    service_account_path = sys.argv[1] if len(sys.argv) > 1 else "newcredential.json"
+    FirebaseDataFetcher(service_account_path).backfill_geohashes()
+
+
+if __name__ == "__main__":
+    main()
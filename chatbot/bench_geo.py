@@ -0,0 +1,57 @@
+"""
+Micro-benchmark: per-document haversine loop vs. the vectorized NumPy pass in geo.py.
+
+Run with `python bench_geo.py` from the chatbot directory.
+"""
+import time
+import numpy as np
+from geo import haversine_km, nearest_within_radius
+
+USER_LAT, USER_LON = 22.560768, 88.375296
+RADIUS_KM = 50
+REPEATS = 5
+
+
+def loop_filter(lats, lons):
+    """The original approach: one scalar distance call per document"""
+    nearby = []
+    for i, (lat, lon) in enumerate(zip(lats, lons)):
+        distance = haversine_km(USER_LAT, USER_LON, lat, lon)
+        if distance <= RADIUS_KM:
+            nearby.append((distance, i))
+    nearby.sort()
+    return [i for _, i in nearby]
+
+
+def vectorized_filter(lats, lons):
+    order, _ = nearest_within_radius(USER_LAT, USER_LON, lats, lons, RADIUS_KM)
+    return order.tolist()
+
+
+def best_of(func, *args):
+    best = float('inf')
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    rng = np.random.default_rng(42)
+    print(f"{'posts':>8} {'loop (ms)':>12} {'numpy (ms)':>12} {'speedup':>9}")
+    for n in (1_000, 10_000, 100_000):
+        # Roughly a 200 km box around the user, so a good share falls inside the radius
+        lats = USER_LAT + rng.uniform(-1.0, 1.0, n)
+        lons = USER_LON + rng.uniform(-1.0, 1.0, n)
+        lat_list, lon_list = lats.tolist(), lons.tolist()
+
+        assert loop_filter(lat_list, lon_list) == vectorized_filter(lats, lons)
+
+        loop_time = best_of(loop_filter, lat_list, lon_list)
+        numpy_time = best_of(vectorized_filter, lats, lons)
+        print(f"{n:>8} {loop_time * 1000:>12.2f} {numpy_time * 1000:>12.2f} {loop_time / numpy_time:>8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+import logging
+import threading
+import time
+from typing import Dict, Optional
+from connection_health import HealthMonitor
+
+logger = logging.getLogger(__name__)
+
+
+class AppComponents:
+    """
+    Application-lifetime container for the expensive chatbot components.
+
+    warm_up() loads the environment, configures Gemini, initializes Vertex AI and Firebase, loads
+    the embedding model and the persisted vector index, and optionally starts the live post
+    cache. Requests then get a ChatbotLocal session that shares all of these instead of
+    rebuilding them. start() runs it on a background thread at startup and, if a dependency is
+    not reachable yet, retries with exponential backoff (from `retry_initial_seconds` up to
+    `retry_max_seconds`) until it succeeds, so a failed first attempt does not leave the
+    service unready for good.
+    """
+
+    def __init__(self, live_post_cache: bool = False, vectorstore_path: str = "post_vectorstore",
+                 health_check_interval: float = 60, retry_initial_seconds: float = 2,
+                 retry_max_seconds: float = 60):
+        self.use_live_post_cache = live_post_cache
+        self.vectorstore_path = vectorstore_path
+        self.health_check_interval = health_check_interval
+        self.health_monitors: Dict[str, HealthMonitor] = {}
+        self.chatbot = None
+        self.live_post_cache = None
+        self.ready = threading.Event()
+        self.error: Optional[str] = None
+        self.warmup_seconds: Optional[float] = None
+        self.warmup_attempts = 0
+        self.retry_initial_seconds = retry_initial_seconds
+        self.retry_max_seconds = retry_max_seconds
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Warm up on a background thread, retrying until it succeeds or shutdown() is called"""
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name="components-warm-up", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        delay = self.retry_initial_seconds
+        while not self._stop.is_set():
+            try:
+                self.warm_up()
+                return
+            except Exception:
+                logger.warning(f"Retrying component warm-up in {delay:.0f}s")
+            if self._stop.wait(delay):
+                return
+            delay = min(delay * 2, self.retry_max_seconds)
+
+    def warm_up(self):
+        """Build every shared component; safe to call more than once"""
+        with self._lock:
+            if self.ready.is_set():
+                return
+            start_time = time.time()
+            self.warmup_attempts += 1
+            try:
+                # Imported here so the API can start serving probes before the cloud SDKs load
+                from llm_working import ChatbotLocal
+
+                if self.use_live_post_cache:
+                    from post_cache import LivePostCache
+                    from vec_search_sys import PostEmbeddingSystem
+                    from new import FirestorePostListener
+
+                    index = PostEmbeddingSystem()
+                    index.load_vectorstore(self.vectorstore_path)
+                    self.live_post_cache = LivePostCache(index=index, index_path=self.vectorstore_path)
+                    self.live_post_cache.start(FirestorePostListener())
+                    logger.info("Live post cache listener started")
+
+                chatbot = ChatbotLocal(post_cache=self.live_post_cache)
+                context_fetch = chatbot.get_context_fetch()
+                # Initialize the Firebase app and client now rather than on the first question
+                data_fetcher = context_fetch.data_fetcher
+                data_fetcher.get_firestore_client()
+
+                # Firestore connectivity is checked off the request path
+                firestore_health = HealthMonitor(
+                    "firestore", data_fetcher.test_firebase_connection, self.health_check_interval
+                )
+                data_fetcher.health_monitor = firestore_health
+                firestore_health.start()
+                self.health_monitors["firestore"] = firestore_health
+
+                self.chatbot = chatbot
+                self.error = None
+                self.warmup_seconds = time.time() - start_time
+                self.ready.set()
+                logger.info(f"Components warmed up in {self.warmup_seconds:.2f}s")
+            except Exception as e:
+                self.error = str(e)
+                logger.error(f"Component warm-up failed (attempt {self.warmup_attempts}): {e}")
+                # Stop whatever this attempt started, so the next one starts from scratch
+                self._stop_background()
+                self.live_post_cache = None
+                self.health_monitors = {}
+                raise
+
+    def new_chatbot(self):
+        """A per-request chatbot session sharing the warm components"""
+        if not self.ready.is_set():
+            raise RuntimeError("Chatbot components are not ready yet")
+        return self.chatbot.new_session()
+
+    def shutdown(self):
+        self._stop.set()
+        self._stop_background()
+
+    def _stop_background(self):
+        if self.live_post_cache is not None:
+            self.live_post_cache.stop()
+        for monitor in self.health_monitors.values():
+            monitor.stop()
+
+    async def shutdown_async(self):
+        """shutdown() plus closing the clients that belong to the event loop"""
+        self.shutdown()
+        if self.chatbot is not None:
+            await self.chatbot.aclose()
+
+    def dependencies_healthy(self) -> bool:
+        return not any(monitor.is_unhealthy() for monitor in self.health_monitors.values())
+
+    def status(self) -> Dict:
+        return {
+            "ready": self.ready.is_set(),
+            "warmup_seconds": round(self.warmup_seconds, 2) if self.warmup_seconds is not None else None,
+            "warmup_attempts": self.warmup_attempts,
+            "live_post_cache": self.live_post_cache is not None,
+            "error": self.error,
+            "dependencies": {name: monitor.status() for name, monitor in self.health_monitors.items()},
+        }
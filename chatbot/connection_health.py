@@ -0,0 +1,73 @@
+import logging
+import threading
+from datetime import datetime
+from typing import Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class HealthMonitor:
+    """
+    Cached health state for one upstream dependency.
+
+    The check function runs on a background thread every `interval_seconds`; the hot path
+    only reads the cached result, so it never pays for a connection test itself.
+    """
+
+    def __init__(self, name: str, check: Callable[[], bool], interval_seconds: float = 60):
+        self.name = name
+        self.check = check
+        self.interval_seconds = interval_seconds
+        # None until the first check has completed
+        self.healthy: Optional[bool] = None
+        self.last_checked: Optional[datetime] = None
+        self.last_error: Optional[str] = None
+        self.consecutive_failures = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def refresh(self) -> bool:
+        """Run the check once and update the cached state"""
+        try:
+            healthy = bool(self.check())
+            error = None if healthy else "health check returned False"
+        except Exception as e:
+            healthy = False
+            error = str(e)
+
+        if healthy:
+            self.consecutive_failures = 0
+        else:
+            self.consecutive_failures += 1
+            logger.warning(f"{self.name} health check failed ({self.consecutive_failures} in a row): {error}")
+        self.healthy = healthy
+        self.last_error = error
+        self.last_checked = datetime.now()
+        return healthy
+
+    def start(self):
+        """Start refreshing in the background, running the first check immediately"""
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name=f"health-{self.name}", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.refresh()
+            self._stop.wait(self.interval_seconds)
+
+    def is_unhealthy(self) -> bool:
+        """True only when the last completed check failed; unknown state does not block requests"""
+        return self.healthy is False
+
+    def status(self) -> Dict:
+        return {
+            "healthy": self.healthy,
+            "last_checked": self.last_checked.isoformat() if self.last_checked else None,
+            "last_error": self.last_error,
+            "consecutive_failures": self.consecutive_failures,
+        }
@@ -0,0 +1,171 @@
+import hashlib
+import threading
+import time
+from typing import Dict, List
+import numpy as np
+import shared_sqlite
+from shared_sqlite import transaction
+
+
+class EmbeddingCache:
+    """
+    Content-addressed embedding cache stored in SQLite.
+
+    Entries are keyed by (model id, dimensionality, task type, SHA-256 of the text) so the same
+    post text is only ever embedded once per model configuration, by any worker on the host.
+    Vectors are stored as raw float32 blobs and the least recently used entries are evicted once
+    the cache grows past `max_bytes`. Triggers keep the entry count and total size in a one-row
+    table, so checking the limit on a write is a single row read rather than a SUM over every
+    entry. Reads do not write: the keys they hit are remembered and their `last_used` is updated
+    in one batch with the next write, or once `touch_batch_size` keys are pending.
+    """
+
+    # Oldest entries read per query while evicting
+    EVICT_PAGE_SIZE = 500
+
+    def __init__(self, path: str = "embedding_cache.db", max_bytes: int = 256 * 1024 * 1024,
+                 touch_batch_size: int = 1000):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.touch_batch_size = touch_batch_size
+        self._lock = threading.Lock()
+        # key -> last read time, not yet written to the table
+        self._pending_touches: Dict[str, float] = {}
+        self.hits = 0
+        self.misses = 0
+
+        self.conn = shared_sqlite.connect(path)
+        # Totals seeded from a database written before the triggers existed must not miss a concurrent write
+        with transaction(self.conn):
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings ("
+                " key TEXT PRIMARY KEY,"
+                " vector BLOB NOT NULL,"
+                " size INTEGER NOT NULL,"
+                " last_used REAL NOT NULL)"
+            )
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_embeddings_last_used ON embeddings (last_used)")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS embedding_totals ("
+                " id INTEGER PRIMARY KEY CHECK (id = 0),"
+                " entries INTEGER NOT NULL,"
+                " bytes INTEGER NOT NULL)"
+            )
+            self.conn.execute(
+                "INSERT OR IGNORE INTO embedding_totals (id, entries, bytes)"
+                " SELECT 0, COUNT(*), COALESCE(SUM(size), 0) FROM embeddings"
+            )
+            self.conn.execute(
+                "CREATE TRIGGER IF NOT EXISTS embeddings_totals_insert AFTER INSERT ON embeddings BEGIN"
+                " UPDATE embedding_totals SET entries = entries + 1, bytes = bytes + NEW.size WHERE id = 0; END"
+            )
+            # Only size changes matter, so touching last_used does not fire it
+            self.conn.execute(
+                "CREATE TRIGGER IF NOT EXISTS embeddings_totals_update AFTER UPDATE OF size ON embeddings BEGIN"
+                " UPDATE embedding_totals SET bytes = bytes - OLD.size + NEW.size WHERE id = 0; END"
+            )
+            self.conn.execute(
+                "CREATE TRIGGER IF NOT EXISTS embeddings_totals_delete AFTER DELETE ON embeddings BEGIN"
+                " UPDATE embedding_totals SET entries = entries - 1, bytes = bytes - OLD.size WHERE id = 0; END"
+            )
+
+    @staticmethod
+    def make_key(model_id: str, dimensionality: int, task_type: str, text: str) -> str:
+        """Build the cache key for one text under a given model configuration"""
+        text_hash = hashlib.sha256(text.encode('utf-8')).hexdigest()
+        return f"{model_id}:{dimensionality}:{task_type}:{text_hash}"
+
+    def get_many(self, keys: List[str]) -> Dict[str, List[float]]:
+        """Return the cached vectors for the given keys, marking them as recently used"""
+        found = {}
+        unique_keys = list(dict.fromkeys(keys))
+        with self._lock:
+            # Stay well below SQLite's bound parameter limit
+            for start in range(0, len(unique_keys), 500):
+                chunk = unique_keys[start:start + 500]
+                placeholders = ",".join("?" * len(chunk))
+                rows = self.conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", chunk
+                ).fetchall()
+                for key, blob in rows:
+                    found[key] = np.frombuffer(blob, dtype=np.float32).tolist()
+            if found:
+                now = time.time()
+                self._pending_touches.update(dict.fromkeys(found, now))
+                if len(self._pending_touches) >= self.touch_batch_size:
+                    with transaction(self.conn):
+                        self._flush_touches()
+            self.hits += len(found)
+            self.misses += len(unique_keys) - len(found)
+        return found
+
+    def put_many(self, items: Dict[str, List[float]]):
+        """Store vectors and evict least recently used entries if the cache is over its size limit"""
+        if not items:
+            return
+        now = time.time()
+        rows = []
+        for key, values in items.items():
+            blob = np.asarray(values, dtype=np.float32).tobytes()
+            rows.append((key, blob, len(blob), now))
+        with self._lock:
+            with transaction(self.conn):
+                self._flush_touches()
+                # An upsert rather than INSERT OR REPLACE, whose implicit delete would skip the totals trigger
+                self.conn.executemany(
+                    "INSERT INTO embeddings (key, vector, size, last_used) VALUES (?, ?, ?, ?)"
+                    " ON CONFLICT (key) DO UPDATE SET vector = excluded.vector, size = excluded.size,"
+                    " last_used = excluded.last_used", rows
+                )
+                self._evict()
+
+    def _flush_touches(self):
+        """Write the pending last_used times; call with the lock held, inside a transaction"""
+        if self._pending_touches:
+            self.conn.executemany(
+                "UPDATE embeddings SET last_used = ? WHERE key = ?",
+                [(used, key) for key, used in self._pending_touches.items()]
+            )
+            self._pending_touches.clear()
+
+    def _evict(self):
+        """Drop the oldest entries until the cache is back under 90% of its size limit"""
+        total = self.conn.execute("SELECT bytes FROM embedding_totals WHERE id = 0").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        target = int(self.max_bytes * 0.9)
+        evicted = 0
+        while total > target:
+            # Deleted rows leave the front of the index, so each page starts from the oldest again
+            page = self.conn.execute(
+                "SELECT key, size FROM embeddings ORDER BY last_used LIMIT ?", (self.EVICT_PAGE_SIZE,)
+            ).fetchall()
+            if not page:
+                break
+            doomed = []
+            for key, size in page:
+                if total <= target:
+                    break
+                doomed.append((key,))
+                total -= size
+            self.conn.executemany("DELETE FROM embeddings WHERE key = ?", doomed)
+            evicted += len(doomed)
+        print(f"Embedding cache evicted {evicted} entries")
+
+    def stats(self) -> Dict[str, int]:
+        """Entry count, stored bytes and hit/miss counters for this process"""
+        with self._lock:
+            entries, total = self.conn.execute("SELECT entries, bytes FROM embedding_totals WHERE id = 0").fetchone()
+            return {
+                'entries': entries,
+                'bytes': total,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+    def close(self):
+        with self._lock:
+            with transaction(self.conn):
+                self._flush_touches()
+            self.conn.close()
@@ -0,0 +1,133 @@
+import math
+from typing import List, Optional, Tuple
+import numpy as np
+
+# Geohash encoding shared with the frontend (frontend/src/utils/geohash.js), which writes a
+# `geohash` field next to every post's location so radius queries become range scans.
+BASE32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+GEOHASH_PRECISION = 9
+EARTH_RADIUS_KM = 6371
+
+
+def encode_geohash(latitude: float, longitude: float, precision: int = GEOHASH_PRECISION) -> str:
+    """Encode a coordinate as a geohash string"""
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    geohash = []
+    bits = 0
+    bit_count = 0
+    even_bit = True
+
+    while len(geohash) < precision:
+        value, bounds = (longitude, lon_range) if even_bit else (latitude, lat_range)
+        mid = (bounds[0] + bounds[1]) / 2
+        if value >= mid:
+            bits = bits * 2 + 1
+            bounds[0] = mid
+        else:
+            bits = bits * 2
+            bounds[1] = mid
+        even_bit = not even_bit
+
+        bit_count += 1
+        if bit_count == 5:
+            geohash.append(BASE32[bits])
+            bits = 0
+            bit_count = 0
+
+    return "".join(geohash)
+
+
+def cell_size_degrees(precision: int) -> Tuple[float, float]:
+    """Height and width in degrees of a geohash cell of the given precision"""
+    total_bits = 5 * precision
+    lon_bits = (total_bits + 1) // 2
+    lat_bits = total_bits // 2
+    return 180.0 / (2 ** lat_bits), 360.0 / (2 ** lon_bits)
+
+
+def geohash_query_bounds(latitude: float, longitude: float, radius_km: float) -> List[Tuple[str, str]]:
+    """
+    Return (start, end) geohash ranges that together cover a circle around a point.
+
+    The precision is the finest one whose cells are at least half the size of the circle's
+    bounding box, so the box is covered by at most 3x3 cells. Every document in the circle
+    has a geohash inside one of the ranges; callers still need an exact distance check.
+    """
+    lat_delta = math.degrees(radius_km / EARTH_RADIUS_KM)
+    south = max(latitude - lat_delta, -90.0)
+    north = min(latitude + lat_delta, 90.0)
+
+    # A kilometre spans more longitude towards the poles, so size the box at its poleward edge
+    poleward_lat = max(abs(south), abs(north))
+    cos_lat = math.cos(math.radians(poleward_lat))
+    lon_delta = 180.0 if cos_lat < 1e-9 else min(math.degrees(radius_km / (EARTH_RADIUS_KM * cos_lat)), 180.0)
+
+    precision = 1
+    for candidate in range(GEOHASH_PRECISION, 0, -1):
+        cell_height, cell_width = cell_size_degrees(candidate)
+        if cell_height * 2 >= north - south and cell_width * 2 >= 2 * lon_delta:
+            precision = candidate
+            break
+    cell_height, cell_width = cell_size_degrees(precision)
+
+    # Sample the bounding box once per cell step (plus its far edges) to find every covered cell
+    lat_samples = _steps(south, north, cell_height)
+    lon_samples = _steps(longitude - lon_delta, longitude + lon_delta, cell_width)
+    cells = set()
+    for lat in lat_samples:
+        for lon in lon_samples:
+            wrapped_lon = (lon + 180.0) % 360.0 - 180.0
+            cells.add(encode_geohash(min(lat, 89.999999), wrapped_lon, precision))
+
+    # '~' sorts after every geohash character, so the range holds every hash with the prefix
+    return [(cell, cell + "~") for cell in sorted(cells)]
+
+
+def _steps(start: float, end: float, step: float) -> List[float]:
+    values = []
+    value = start
+    while value < end:
+        values.append(value)
+        value += step
+    values.append(end)
+    return values
+
+
+def haversine_km(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    """Great circle distance in kilometres between two points given in decimal degrees"""
+    lat1_rad = math.radians(lat1)
+    lat2_rad = math.radians(lat2)
+    dlat = lat2_rad - lat1_rad
+    dlon = math.radians(lon2 - lon1)
+
+    a = (math.sin(dlat / 2) ** 2 +
+         math.cos(lat1_rad) * math.cos(lat2_rad) * math.sin(dlon / 2) ** 2)
+    return EARTH_RADIUS_KM * 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
+
+
+def haversine_km_array(latitude: float, longitude: float, lats: np.ndarray, lons: np.ndarray) -> np.ndarray:
+    """Distances in kilometres from one point to every point in the lat/lon arrays, in one pass"""
+    lat1 = math.radians(latitude)
+    lat2 = np.radians(lats)
+    dlat = lat2 - lat1
+    dlon = np.radians(lons) - math.radians(longitude)
+
+    a = np.sin(dlat / 2) ** 2 + math.cos(lat1) * np.cos(lat2) * np.sin(dlon / 2) ** 2
+    return EARTH_RADIUS_KM * 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+
+
+def nearest_within_radius(latitude: float, longitude: float, lats: np.ndarray, lons: np.ndarray,
+                          radius_km: float, top_n: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Indices of the candidates within radius_km of the point, closest first, and their distances.
+
+    At most top_n indices are returned when top_n is given.
+    """
+    distances = haversine_km_array(latitude, longitude, lats, lons)
+    inside = np.flatnonzero(distances <= radius_km)
+    if top_n is not None and top_n < len(inside):
+        # Partial selection first so only the top_n survivors need a full sort
+        inside = inside[np.argpartition(distances[inside], top_n - 1)[:top_n]]
+    order = inside[np.argsort(distances[inside], kind="stable")]
+    return order, distances[order]
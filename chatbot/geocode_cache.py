@@ -0,0 +1,139 @@
+import re
+import threading
+import time
+from typing import Dict, Optional
+import shared_sqlite
+from shared_sqlite import transaction
+
+
+class GeocodeCache:
+    """
+    Place name to coordinates cache for the OpenWeather geocoding lookups, stored in SQLite.
+
+    Names are normalized (case, whitespace and punctuation) so 'New Delhi', 'new  delhi' and
+    'New Delhi?' share an entry. Found places are kept for `ttl_seconds`; names the geocoder did
+    not recognise are cached for the shorter `negative_ttl_seconds` so typos are not retried on
+    every question. Expired rows are purged by the first write after every
+    `purge_interval_seconds`, as a range delete on the expiry index.
+    """
+
+    def __init__(self, path: str = "geocode_cache.db", ttl_seconds: float = 30 * 24 * 3600,
+                 negative_ttl_seconds: float = 24 * 3600, purge_interval_seconds: float = 3600):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.negative_ttl_seconds = negative_ttl_seconds
+        self.purge_interval_seconds = purge_interval_seconds
+        self._last_purge = time.time()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        self.conn = shared_sqlite.connect(path)
+        # Totals seeded from a database written before the triggers existed must not miss a concurrent write
+        with transaction(self.conn):
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS geocodes ("
+                " name TEXT PRIMARY KEY,"
+                " lat REAL,"
+                " lon REAL,"
+                " city_name TEXT,"
+                " expires_at REAL NOT NULL)"
+            )
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_geocodes_expires_at ON geocodes (expires_at)")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS geocode_totals ("
+                " id INTEGER PRIMARY KEY CHECK (id = 0),"
+                " entries INTEGER NOT NULL,"
+                " unknown_entries INTEGER NOT NULL)"
+            )
+            self.conn.execute(
+                "INSERT OR IGNORE INTO geocode_totals (id, entries, unknown_entries)"
+                " SELECT 0, COUNT(*), COALESCE(SUM(lat IS NULL), 0) FROM geocodes"
+            )
+            self.conn.execute(
+                "CREATE TRIGGER IF NOT EXISTS geocodes_totals_insert AFTER INSERT ON geocodes BEGIN"
+                " UPDATE geocode_totals SET entries = entries + 1,"
+                " unknown_entries = unknown_entries + (NEW.lat IS NULL) WHERE id = 0; END"
+            )
+            self.conn.execute(
+                "CREATE TRIGGER IF NOT EXISTS geocodes_totals_update AFTER UPDATE OF lat ON geocodes BEGIN"
+                " UPDATE geocode_totals SET"
+                " unknown_entries = unknown_entries - (OLD.lat IS NULL) + (NEW.lat IS NULL) WHERE id = 0; END"
+            )
+            self.conn.execute(
+                "CREATE TRIGGER IF NOT EXISTS geocodes_totals_delete AFTER DELETE ON geocodes BEGIN"
+                " UPDATE geocode_totals SET entries = entries - 1,"
+                " unknown_entries = unknown_entries - (OLD.lat IS NULL) WHERE id = 0; END"
+            )
+        # Used only by stats(), so /stats never waits behind the writer lock
+        self.stats_conn = shared_sqlite.connect_read_only(path)
+
+    @staticmethod
+    def normalize(name: str) -> str:
+        """Cache key for a free-text place name"""
+        name = re.sub(r"[^\w\s,-]", "", name.lower())
+        name = re.sub(r"\s*,\s*", ",", name)
+        return re.sub(r"\s+", " ", name).strip(" ,-")
+
+    def get(self, name: str) -> Optional[Dict]:
+        """
+        Cached lookup result: {'lat', 'lon', 'city_name'} for a known place,
+        {'unknown': True} for a name the geocoder could not resolve, None on a miss
+        """
+        key = self.normalize(name)
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT lat, lon, city_name, expires_at FROM geocodes WHERE name = ?", (key,)
+            ).fetchone()
+            if row is None or row[3] <= time.time():
+                self.misses += 1
+                return None
+            self.hits += 1
+        lat, lon, city_name, _ = row
+        if lat is None:
+            return {'unknown': True}
+        return {'lat': lat, 'lon': lon, 'city_name': city_name}
+
+    def put(self, name: str, lat: float, lon: float, city_name: str):
+        self._store(name, lat, lon, city_name, self.ttl_seconds)
+
+    def put_unknown(self, name: str):
+        self._store(name, None, None, None, self.negative_ttl_seconds)
+
+    def _store(self, name, lat, lon, city_name, ttl):
+        now = time.time()
+        with self._lock:
+            # An upsert rather than INSERT OR REPLACE, whose implicit delete would skip the totals trigger
+            self.conn.execute(
+                "INSERT INTO geocodes (name, lat, lon, city_name, expires_at) VALUES (?, ?, ?, ?, ?)"
+                " ON CONFLICT (name) DO UPDATE SET lat = excluded.lat, lon = excluded.lon,"
+                " city_name = excluded.city_name, expires_at = excluded.expires_at",
+                (self.normalize(name), lat, lon, city_name, now + ttl)
+            )
+            if now - self._last_purge >= self.purge_interval_seconds:
+                self._purge_expired(now)
+
+    def purge_expired(self) -> int:
+        with self._lock:
+            return self._purge_expired(time.time())
+
+    def _purge_expired(self, now: float) -> int:
+        self._last_purge = now
+        return self.conn.execute("DELETE FROM geocodes WHERE expires_at <= ?", (now,)).rowcount
+
+    def stats(self) -> Dict[str, int]:
+        """Entry counts and hit/miss counters for this process"""
+        entries, unknown = self.stats_conn.execute(
+            "SELECT entries, unknown_entries FROM geocode_totals WHERE id = 0"
+        ).fetchone()
+        return {
+            'entries': entries,
+            'unknown_entries': unknown,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
+        self.stats_conn.close()
@@ -0,0 +1,134 @@
+import asyncio
+import random
+import threading
+import time
+from typing import Dict, Optional
+from urllib.parse import urlsplit
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+
+# Statuses worth retrying; anything else is returned to the caller as is
+RETRY_STATUSES = {500, 502, 503, 504}
+
+
+class HttpClientError(Exception):
+    """An outbound call failed after all retries, or ran out of its deadline"""
+
+
+class HttpClient:
+    """
+    Shared outbound HTTP layer for the upstream APIs (Places, OpenWeather).
+
+    One pooled keep-alive connection set is kept per host for each of the sync (requests) and
+    async (httpx) paths, so repeat calls skip the TCP and TLS handshakes. Every call has a
+    deadline that bounds all its attempts together, 5xx responses and network errors are retried
+    with jittered exponential backoff, and at most `per_host_limit` calls run against one host
+    at a time.
+    """
+
+    def __init__(self, timeout: float = 10.0, connect_timeout: float = 3.0, max_retries: int = 2,
+                 backoff_seconds: float = 0.25, per_host_limit: int = 10, max_connections: int = 100):
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        self.per_host_limit = per_host_limit
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max_connections, pool_maxsize=per_host_limit)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        self.async_client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=per_host_limit),
+            timeout=httpx.Timeout(timeout, connect=connect_timeout),
+        )
+
+        self._lock = threading.Lock()
+        self._host_semaphores: Dict[str, threading.BoundedSemaphore] = {}
+        self._async_host_semaphores: Dict[str, asyncio.Semaphore] = {}
+
+    def host_semaphore(self, url: str) -> threading.BoundedSemaphore:
+        host = urlsplit(url).netloc
+        with self._lock:
+            if host not in self._host_semaphores:
+                self._host_semaphores[host] = threading.BoundedSemaphore(self.per_host_limit)
+            return self._host_semaphores[host]
+
+    def async_host_semaphore(self, url: str) -> asyncio.Semaphore:
+        host = urlsplit(url).netloc
+        with self._lock:
+            if host not in self._async_host_semaphores:
+                self._async_host_semaphores[host] = asyncio.Semaphore(self.per_host_limit)
+            return self._async_host_semaphores[host]
+
+    def backoff(self, attempt: int) -> float:
+        """Full-jitter exponential backoff before retry number `attempt` (starting at 1)"""
+        return random.uniform(0, self.backoff_seconds * (2 ** (attempt - 1)))
+
+    def get(self, url: str, params: Optional[Dict] = None, deadline: Optional[float] = None) -> requests.Response:
+        """GET with pooling, retries and a deadline in seconds covering every attempt"""
+        expires = time.monotonic() + (deadline or self.timeout)
+        semaphore = self.host_semaphore(url)
+        attempt = 0
+        while True:
+            remaining = expires - time.monotonic()
+            if remaining <= 0:
+                raise HttpClientError(f"Deadline exceeded calling {url}")
+            try:
+                with semaphore:
+                    response = self.session.get(
+                        url, params=params, timeout=(min(self.connect_timeout, remaining), remaining)
+                    )
+                if response.status_code not in RETRY_STATUSES or attempt >= self.max_retries:
+                    return response
+                error = f"HTTP {response.status_code}"
+            except requests.RequestException as e:
+                if attempt >= self.max_retries:
+                    raise HttpClientError(f"Error calling {url}: {e}") from e
+                error = str(e)
+
+            attempt += 1
+            delay = self.backoff(attempt)
+            if time.monotonic() + delay >= expires:
+                raise HttpClientError(f"Deadline exceeded calling {url} after {error}")
+            print(f"Retrying {urlsplit(url).netloc} after {error} (attempt {attempt + 1})")
+            time.sleep(delay)
+
+    async def get_async(self, url: str, params: Optional[Dict] = None, deadline: Optional[float] = None) -> httpx.Response:
+        """Async variant of get"""
+        expires = time.monotonic() + (deadline or self.timeout)
+        semaphore = self.async_host_semaphore(url)
+        attempt = 0
+        while True:
+            remaining = expires - time.monotonic()
+            if remaining <= 0:
+                raise HttpClientError(f"Deadline exceeded calling {url}")
+            try:
+                async with semaphore:
+                    response = await self.async_client.get(
+                        url, params=params,
+                        timeout=httpx.Timeout(remaining, connect=min(self.connect_timeout, remaining))
+                    )
+                if response.status_code not in RETRY_STATUSES or attempt >= self.max_retries:
+                    return response
+                error = f"HTTP {response.status_code}"
+            except httpx.HTTPError as e:
+                if attempt >= self.max_retries:
+                    raise HttpClientError(f"Error calling {url}: {e}") from e
+                error = str(e) or type(e).__name__
+
+            attempt += 1
+            delay = self.backoff(attempt)
+            if time.monotonic() + delay >= expires:
+                raise HttpClientError(f"Deadline exceeded calling {url} after {error}")
+            print(f"Retrying {urlsplit(url).netloc} after {error} (attempt {attempt + 1})")
+            await asyncio.sleep(delay)
+
+    def close(self):
+        self.session.close()
+
+    async def aclose(self):
+        self.session.close()
+        await self.async_client.aclose()
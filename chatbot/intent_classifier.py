@@ -0,0 +1,344 @@
+"""
+Local intent classifier and slot extractor used ahead of the Gemini Flash intent call.
+
+Keyword, gazetteer and pattern rules decide between 'map', 'weather' and 'chat' and pull out
+location, place type and route slots. An optional scikit-learn model trained on logged Gemini
+decisions can be layered on top. Queries the rules are unsure about still go to Gemini.
+
+Train a model from a fallback log with:
+    python intent_classifier.py train intent_log.jsonl intent_model.joblib
+"""
+import json
+import random
+import re
+import sys
+import threading
+from typing import Dict, List, Optional, Tuple
+
+INTENTS = ("map", "weather", "chat")
+
+# Singular canonical place type for each phrase that names one
+PLACE_TYPES = {
+    "restaurant": "restaurant", "restaurants": "restaurant",
+    "hospital": "hospital", "hospitals": "hospital",
+    "clinic": "clinic", "clinics": "clinic",
+    "coffee shop": "coffee shop", "coffee shops": "coffee shop",
+    "cafe": "cafe", "cafes": "cafe",
+    "hotel": "hotel", "hotels": "hotel",
+    "atm": "atm", "atms": "atm",
+    "store": "store", "stores": "store", "shop": "shop", "shops": "shop",
+    "supermarket": "supermarket", "supermarkets": "supermarket",
+    "mall": "mall", "malls": "mall",
+    "school": "school", "schools": "school",
+    "college": "college", "colleges": "college",
+    "park": "park", "parks": "park",
+    "bank": "bank", "banks": "bank",
+    "pharmacy": "pharmacy", "pharmacies": "pharmacy",
+    "medical store": "pharmacy", "medical stores": "pharmacy", "chemist": "pharmacy",
+    "movie theater": "movie theater", "movie theaters": "movie theater",
+    "cinema": "movie theater", "cinemas": "movie theater",
+    "petrol pump": "petrol pump", "petrol pumps": "petrol pump",
+    "gas station": "petrol pump", "gas stations": "petrol pump",
+    "police station": "police station", "police stations": "police station",
+    "gym": "gym", "gyms": "gym",
+    "temple": "temple", "temples": "temple",
+    "museum": "museum", "museums": "museum",
+    "bar": "bar", "bars": "bar",
+    "bakery": "bakery", "bakeries": "bakery",
+    "metro station": "metro station", "metro stations": "metro station",
+    "railway station": "railway station", "bus stop": "bus stop",
+}
+
+# Known places, so a location can be recognised without an 'in ...' phrase
+GAZETTEER = {
+    name.lower(): name for name in (
+        "Kolkata", "Calcutta", "Howrah", "Salt Lake", "New Town", "Sector V", "Baguiati",
+        "Dum Dum", "Park Street", "Esplanade", "Behala", "Jadavpur", "Garia", "Barasat",
+        "Delhi", "New Delhi", "Mumbai", "Bangalore", "Bengaluru", "Chennai", "Hyderabad",
+        "Pune", "Ahmedabad", "Jaipur", "Lucknow", "Patna", "Bhubaneswar", "Guwahati",
+        "Siliguri", "Darjeeling", "Durgapur", "Asansol", "Kharagpur", "Ranchi", "Noida",
+        "Gurgaon", "Gurugram", "Chandigarh", "Goa", "Kochi", "Varanasi",
+        "London", "Paris", "New York", "Tokyo", "Dubai", "Singapore", "Sydney", "Berlin",
+    )
+}
+
+WEATHER_WORDS = re.compile(
+    r"\b(weather|temperature|temp|hot|cold|humid|humidity|wind|windy|sunny|cloudy|"
+    r"cloudiness|climate|feels like|pressure|degrees|celsius)\b"
+)
+# The weather tool only reports current conditions, the prompt sends these to 'chat'
+FORECAST_WORDS = re.compile(
+    r"\b(forecast|tomorrow|next week|weekend|tonight|later today|will it|going to rain|"
+    r"chance of rain|yesterday|last week|last year|historical|average)\b"
+)
+TRAFFIC_WORDS = re.compile(r"\b(traffic|jam|congestion|congested|road status|roadblock|gridlock)\b")
+# Phrases that suggest a place lookup without naming an establishment type
+MAP_CUES = re.compile(r"\b(where is|where's|address of|directions|how to get to|near me|nearby|nearest|closest)\b")
+# A place type plus a location is only a lookup when the user asks to find something or says 'near';
+# 'a poem about a park in Paris' names both without wanting a map search
+PLACE_FINDING = re.compile(
+    r"\b(find|show|search|look for|looking for|locate|list|where|suggest some|any good|get me to|take me to|"
+    r"near|nearby|nearest|closest|around me|around here)\b"
+)
+# Only a query that says 'weather' is trusted with a location outside the gazetteer: 'cold in winter'
+# and 'the temperature at which water boils' mention weather words and an 'in/at ...' phrase too
+EXPLICIT_WEATHER = re.compile(r"\bweather\b")
+# Below any sensible threshold, so queries no rule recognises go to Gemini
+UNKNOWN_CONFIDENCE = 0.5
+GREETINGS = re.compile(r"^(hi|hello|hey|hii+|thanks|thank you|ok|okay|bye|goodbye|good (morning|afternoon|evening|night))\b[\s!.]*$")
+# Follow-ups lean on the conversation history, which only Gemini sees
+FOLLOW_UP = re.compile(r"^(what about|how about|and\b|also\b|same\b)|\b(there|that place|that area|it)\s*\??$")
+
+LOCATION_PATTERN = re.compile(
+    r"\b(?:in|at|near|around)\s+([a-z][a-z .'-]*?)\s*"
+    r"(?:\b(?:today|now|right now|currently|please|at the moment)\b)?\s*[?.!]*$"
+)
+ROUTE_PATTERN = re.compile(r"\bfrom\s+([a-z][a-z .'-]*?)\s+to\s+([a-z][a-z .'-]*?)\s*(?:\b(?:today|now|right now)\b)?\s*[?.!]*$")
+
+
+def normalize(text: str) -> str:
+    return re.sub(r"\s+", " ", text.strip().lower())
+
+
+def display_location(text: str) -> str:
+    """Canonical spelling from the gazetteer, otherwise title case"""
+    text = text.strip(" .,'-")
+    return GAZETTEER.get(text, text.title())
+
+
+def find_place_type(text: str) -> Optional[str]:
+    # Longest phrases first so 'coffee shop' wins over 'shop'
+    for phrase in sorted(PLACE_TYPES, key=len, reverse=True):
+        if re.search(rf"\b{re.escape(phrase)}\b", text):
+            return PLACE_TYPES[phrase]
+    return None
+
+
+def find_location(text: str) -> Tuple[Optional[str], float]:
+    """Location slot and how sure we are of it: gazetteer hits beat bare 'in ...' phrases"""
+    match = LOCATION_PATTERN.search(text)
+    if match:
+        candidate = match.group(1).strip()
+        if candidate in GAZETTEER:
+            return display_location(candidate), 0.95
+        # 'in the area', 'near me', 'in the cinema' and similar are not places
+        is_place_type = re.sub(r"^(the|a|an) ", "", candidate) in PLACE_TYPES
+        if candidate not in ("me", "here", "the area", "my area", "this area", "the city") and len(candidate) > 1 and not is_place_type:
+            return display_location(candidate), 0.85
+    for name in sorted(GAZETTEER, key=len, reverse=True):
+        if re.search(rf"\b{re.escape(name)}\b", text):
+            return GAZETTEER[name], 0.9
+    return None, 0.0
+
+
+class IntentClassifier:
+    """
+    Rule-based intent and slot extraction with optional model support and agreement tracking.
+
+    classify() returns the parameters in the same shape as the Gemini extraction along with a
+    confidence in [0, 1]; callers use the local answer when the confidence reaches `threshold`.
+    Every decision is counted per confidence band, and comparisons with Gemini (on fallbacks and
+    on a `shadow_rate` sample of local answers) show how often the two agree in each band.
+    """
+
+    def __init__(self, threshold: float = 0.8, model_path: Optional[str] = None,
+                 shadow_rate: float = 0.0, log_path: Optional[str] = None):
+        self.threshold = threshold
+        self.shadow_rate = shadow_rate
+        # Gemini decisions are appended here as training data for the model
+        self.log_path = log_path
+        self.model = self.load_model(model_path) if model_path else None
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.local_hits = 0
+        self.compared = 0
+        self.agreed = 0
+        self.intent_agreed = 0
+        # Ten confidence bands of width 0.1
+        self.bands = [{"requests": 0, "compared": 0, "agreed": 0} for _ in range(10)]
+
+    @staticmethod
+    def load_model(model_path: str):
+        try:
+            import joblib
+            return joblib.load(model_path)
+        except FileNotFoundError:
+            print(f"Intent model not found at {model_path}, using rules only")
+        except ImportError as e:
+            print(f"scikit-learn/joblib unavailable ({e}), using rules only")
+        return None
+
+    def classify(self, user_query: str, history: Optional[List[Dict]] = None) -> Tuple[Dict, float]:
+        """Local intent and parameters for the query, with a confidence in [0, 1]"""
+        text = normalize(user_query)
+        params, confidence = self.apply_rules(text)
+
+        if self.model is not None:
+            params, confidence = self.blend_model(text, params, confidence)
+        if not self.has_required_slots(params):
+            # Missing slots have to be inferred from context, which only Gemini can do
+            confidence = min(confidence, 0.55)
+
+        if history and FOLLOW_UP.search(text):
+            confidence = min(confidence, 0.4)
+        return params, round(confidence, 3)
+
+    @staticmethod
+    def has_required_slots(params: Dict) -> bool:
+        if params["intent"] == "weather":
+            return bool(params.get("location"))
+        if params["intent"] == "map":
+            return bool(params.get("location")) and bool(params.get("place_type"))
+        return True
+
+    def apply_rules(self, text: str) -> Tuple[Dict, float]:
+        if GREETINGS.match(text):
+            return {"intent": "chat"}, 0.97
+
+        location, location_confidence = find_location(text)
+
+        if TRAFFIC_WORDS.search(text):
+            route = ROUTE_PATTERN.search(text)
+            if route:
+                origin, destination = display_location(route.group(1)), display_location(route.group(2))
+                return {"intent": "map", "location": origin, "place_type": "traffic",
+                        "origin": origin, "destination": destination}, 0.9
+            params = {"intent": "map", "location": location, "place_type": "traffic",
+                      "origin": None, "destination": None}
+            return params, location_confidence if location else 0.5
+
+        if WEATHER_WORDS.search(text) or re.search(r"\b(rain|raining|snow|snowing)\b", text):
+            if FORECAST_WORDS.search(text):
+                return {"intent": "chat"}, 0.85
+            if location and (location.lower() in GAZETTEER or EXPLICIT_WEATHER.search(text)):
+                return {"intent": "weather", "location": location}, location_confidence
+            if location:
+                # An unknown 'in ...' phrase may not be a place at all; let Gemini decide
+                return {"intent": "weather", "location": location}, 0.6
+            # The location has to come from the conversation or the user's coordinates
+            return {"intent": "weather", "location": None}, 0.5
+
+        # Outside the location, so 'Park Street' does not read as a park
+        place_type = find_place_type(text.replace(location.lower(), " ") if location else text)
+        if place_type:
+            if location and PLACE_FINDING.search(text):
+                return {"intent": "map", "location": location, "place_type": place_type}, location_confidence
+            if location:
+                # Both slots are there but nothing asks for a lookup; let Gemini decide
+                return {"intent": "map", "location": location, "place_type": place_type}, 0.6
+            return {"intent": "map", "location": location, "place_type": place_type}, 0.55
+
+        if MAP_CUES.search(text):
+            # Landmarks need world knowledge to place them in a city
+            return {"intent": "map", "location": location, "place_type": "landmark"}, 0.4
+
+        # Nothing the rules recognise; an unknown map or weather phrasing must not be taken for chat
+        return {"intent": "chat"}, UNKNOWN_CONFIDENCE
+
+    def blend_model(self, text: str, params: Dict, confidence: float) -> Tuple[Dict, float]:
+        """Combine the rule decision with the model's class probabilities"""
+        try:
+            probabilities = self.model.predict_proba([text])[0]
+        except Exception as e:
+            print(f"Intent model prediction failed: {e}")
+            return params, confidence
+        best = int(probabilities.argmax())
+        model_intent = self.model.classes_[best]
+        model_confidence = float(probabilities[best])
+
+        if model_intent == params["intent"]:
+            # Independent agreement makes both more believable
+            return params, 1 - (1 - confidence) * (1 - model_confidence)
+        if model_intent == "chat" and model_confidence > confidence:
+            return {"intent": "chat"}, model_confidence * (1 - confidence)
+        # The model cannot fill slots, so a disagreement on a tool intent is left to Gemini
+        return params, min(confidence, 1 - model_confidence)
+
+    def record(self, confidence: float, local_hit: bool):
+        with self._lock:
+            self.requests += 1
+            if local_hit:
+                self.local_hits += 1
+            self.bands[self.band(confidence)]["requests"] += 1
+
+    def record_comparison(self, query: str, local_params: Dict, confidence: float, llm_params: Dict):
+        """Count whether the local decision matches Gemini's and log Gemini's label"""
+        intent_match = local_params.get("intent") == llm_params.get("intent")
+        match = intent_match and all(
+            normalize(str(local_params.get(slot) or "")) == normalize(str(llm_params.get(slot) or ""))
+            for slot in ("location", "place_type")
+        )
+        with self._lock:
+            self.compared += 1
+            self.agreed += match
+            self.intent_agreed += intent_match
+            band = self.bands[self.band(confidence)]
+            band["compared"] += 1
+            band["agreed"] += match
+            if self.log_path:
+                with open(self.log_path, "a", encoding="utf-8") as log:
+                    log.write(json.dumps({"query": query, **llm_params}) + "\n")
+        if not match:
+            print(f"Local intent {local_params} ({confidence}) disagreed with Gemini {llm_params}")
+
+    def should_shadow(self) -> bool:
+        """Whether to also ask Gemini about a query answered locally, to measure agreement"""
+        return self.shadow_rate > 0 and random.random() < self.shadow_rate
+
+    @staticmethod
+    def band(confidence: float) -> int:
+        return min(int(confidence * 10), 9)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "threshold": self.threshold,
+                "model_loaded": self.model is not None,
+                "requests": self.requests,
+                "local_hits": self.local_hits,
+                "hit_rate": round(self.local_hits / self.requests, 4) if self.requests else None,
+                "compared_with_llm": self.compared,
+                "agreement_rate": round(self.agreed / self.compared, 4) if self.compared else None,
+                "intent_agreement_rate": round(self.intent_agreed / self.compared, 4) if self.compared else None,
+                "by_confidence": [
+                    {
+                        "confidence": f"{index / 10:.1f}-{(index + 1) / 10:.1f}",
+                        **band,
+                        "agreement_rate": round(band["agreed"] / band["compared"], 4) if band["compared"] else None,
+                    }
+                    for index, band in enumerate(self.bands)
+                ],
+            }
+
+
+def train_intent_model(examples: List[Dict]):
+    """Fit a small TF-IDF + logistic regression intent model on {'query', 'intent'} examples"""
+    from sklearn.feature_extraction.text import TfidfVectorizer
+    from sklearn.linear_model import LogisticRegression
+    from sklearn.pipeline import make_pipeline
+
+    texts = [normalize(example["query"]) for example in examples]
+    labels = [example["intent"] if example.get("intent") in INTENTS else "chat" for example in examples]
+    model = make_pipeline(
+        TfidfVectorizer(analyzer="char_wb", ngram_range=(2, 4), sublinear_tf=True, min_df=1),
+        LogisticRegression(max_iter=1000, class_weight="balanced"),
+    )
+    model.fit(texts, labels)
+    return model
+
+
+def main():
+    if len(sys.argv) != 4 or sys.argv[1] != "train":
+        print("Usage: python intent_classifier.py train <intent_log.jsonl> <model.joblib>")
+        sys.exit(1)
+    import joblib
+
+    with open(sys.argv[2], "r", encoding="utf-8") as log:
+        examples = [json.loads(line) for line in log if line.strip()]
+    model = train_intent_model(examples)
+    joblib.dump(model, sys.argv[3])
+    print(f"Trained on {len(examples)} examples, classes {list(model.classes_)}, saved to {sys.argv[3]}")
+
+
+if __name__ == "__main__":
+    main()
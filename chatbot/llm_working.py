@@ -1,13 +1,37 @@
 import os
+import copy
 import json
-import requests
+import asyncio
 import google.generativeai as genai
 import re
 import datetime
+import time
+import functools
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
 from run_post import ContextFetch
+from intent_classifier import IntentClassifier
+from http_client import HttpClient, HttpClientError
+from tracing import set_intent, span
+from geocode_cache import GeocodeCache
+from response_cache import ResponseCache
+from geo import encode_geohash
+from prompt_budget import PromptAssembler, estimate_tokens
+from model_router import ModelRouter, FLASH, PRO
+from single_flight import SingleFlight, normalize_question
+from request_context import RequestContext, request_attribute
+from turn_buffer import TurnBuffer
 from dotenv import load_dotenv
 class ChatbotLocal:
-    def __init__(self):
+    # Per-request state lives on the session's RequestContext, never on the shared instance
+    curr_lat = request_attribute("curr_lat")
+    curr_long = request_attribute("curr_long")
+    conversation_history = request_attribute("conversation_history")
+    local_information_string = request_attribute("local_information_string")
+    local_posts = request_attribute("local_posts")
+    served_model = request_attribute("served_model")
+
+    def __init__(self, post_cache=None):
         # Set your API keys. It's best practice to use environment variables.
         # For local testing, you can directly assign them as you have, but be mindful in production.
         load_dotenv()
@@ -21,35 +45,204 @@ class ChatbotLocal:
         genai.configure(api_key=self.GEMINI_API_KEY)
         self.model_flash = genai.GenerativeModel('gemini-1.5-flash')
         self.model_pro = genai.GenerativeModel('gemini-1.5-pro')
+        self.models = {FLASH: self.model_flash, PRO: self.model_pro}
+        # Picks Flash or Pro per answer from the intent, prompt size and recent latency
+        self.model_router = ModelRouter(
+            slo_seconds=float(os.getenv("MODEL_LATENCY_SLO_SECONDS", "8")),
+            fallback_timeout=float(os.getenv("MODEL_FALLBACK_TIMEOUT_SECONDS", "30")),
+            flash_intents=[kind.strip() for kind in os.getenv("MODEL_FLASH_INTENTS", "weather,traffic").split(",") if kind.strip()],
+        )
 
-        # --- Conversation History (Volatile) ---
-        self.conversation_history = []
+        # --- Request coalescing ---
+        # Concurrent identical questions from the same geohash cell and time window share post
+        # retrieval, intent extraction and answer generation. COALESCE_WINDOW_SECONDS=0 turns it off
+        self.single_flight = SingleFlight()
+        self.COALESCE_WINDOW_SECONDS = float(os.getenv("COALESCE_WINDOW_SECONDS", "30"))
+        self.COALESCE_PRECISION = int(os.getenv("COALESCE_GEOHASH_PRECISION", "6"))  # Cells of roughly 1 km
+
+        # --- Per-request state: location, history, local posts, served model ---
+        self.request = RequestContext()
         self.MAX_HISTORY_LENGTH = 5  # Store last 5 query-response pairs (5 user turns + 5 model turns = 10 entries)
 
         # --- Local Information Source ---
         self.LOCAL_INFO_FILE = "local_info.txt"  # Path to your local info file
-        self.local_information_string = ""  # This will store the content of the file
+        self.post_cache = post_cache  # Optional LivePostCache shared across requests
+        self.context_fetch = None  # Created on first use, then shared by every session
+        # Pooled keep-alive client with deadlines and retries for every outbound API call
+        self.http_client = HttpClient(
+            timeout=float(os.getenv("HTTP_TIMEOUT_SECONDS", "10")),
+            max_retries=int(os.getenv("HTTP_MAX_RETRIES", "2")),
+            per_host_limit=int(os.getenv("HTTP_PER_HOST_LIMIT", "10")),
+        )
+        # Place name -> coordinates for OpenWeather, shared by every worker on the host
+        self.geocode_cache = GeocodeCache(
+            os.getenv("GEOCODE_CACHE_PATH", "geocode_cache.db"),
+            ttl_seconds=float(os.getenv("GEOCODE_CACHE_TTL_DAYS", "30")) * 24 * 3600,
+            negative_ttl_seconds=float(os.getenv("GEOCODE_NEGATIVE_TTL_HOURS", "24")) * 3600,
+        )
+        # Recent weather and Places payloads, so neighbours asking the same thing skip the upstream call
+        self.response_cache = ResponseCache(
+            max_entries=int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "1024")),
+            path=os.getenv("RESPONSE_CACHE_PATH", "response_cache.db") or None,
+        )
+        self.WEATHER_CACHE_TTL_SECONDS = float(os.getenv("WEATHER_CACHE_TTL_SECONDS", "600"))
+        self.PLACES_CACHE_TTL_SECONDS = float(os.getenv("PLACES_CACHE_TTL_SECONDS", "3600"))
+        self.WEATHER_CACHE_PRECISION = 5  # Geohash cells of roughly 5 km
+
+        # --- Prompt budgets ---
+        # Optional JSON overrides such as {"chat": {"history": 2000, "posts": 1000}}
+        self.prompt_assembler = PromptAssembler(json.loads(os.getenv("PROMPT_BUDGETS", "{}")))
+
+        # --- Staged execution ---
+        # Retrieval and intent extraction are independent, so by default they run in parallel
+        # and are joined just before a formatter needs the local posts.
+        self.STAGED_EXECUTION = os.getenv("STAGED_EXECUTION", "true").lower() != "false"
+        self.stage_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="chat-stage")
+
+        # --- Local intent classifier, consulted before Gemini Flash ---
+        # Set INTENT_CONFIDENCE_THRESHOLD above 1 to always ask Gemini
+        self.intent_classifier = IntentClassifier(
+            threshold=float(os.getenv("INTENT_CONFIDENCE_THRESHOLD", "0.8")),
+            model_path=os.getenv("INTENT_MODEL_PATH"),
+            shadow_rate=float(os.getenv("INTENT_SHADOW_RATE", "0.05")),
+            log_path=os.getenv("INTENT_LOG_PATH"),
+        )
+        self.background_tasks = set()  # Keeps shadow comparison tasks alive until they finish
+
+    def get_context_fetch(self):
+        """Return the shared ContextFetch, creating it (Vertex AI, Firebase, index) on first use."""
+        if self.context_fetch is None:
+            self.context_fetch = ContextFetch(post_cache=self.post_cache)
+        return self.context_fetch
+
+    def new_session(self):
+        """
+        Returns a chatbot for one request that shares this instance's configured
+        Gemini models and ContextFetch but has its own RequestContext, so sessions can run
+        concurrently in threads or tasks without seeing each other's location or history.
+        """
+        session = copy.copy(self)
+        session.request = RequestContext()
+        return session
+
+    async def aclose(self):
+        await self.http_client.aclose()
 
     def load_local_information(self, my_question):
         """Loads a string of information from a local text file."""
+        context_fetch = self.get_context_fetch()
+        # Covers the Firestore, embedding and FAISS spans inside, or the wait on a coalesced call
+        with span("retrieval"):
+            contextual_posts = self.coalesced(
+                "posts", my_question, [],
+                lambda: context_fetch.main_with_your_data(my_question, self.curr_lat, self.curr_long)
+            )
+        self.set_local_information(contextual_posts)
+
+    async def load_local_information_async(self, my_question):
+        """Async variant of load_local_information."""
+        context_fetch = self.get_context_fetch()
+        with span("retrieval"):
+            contextual_posts = await self.coalesced_async(
+                "posts", my_question, [],
+                lambda: context_fetch.main_with_your_data_async(my_question, self.curr_lat, self.curr_long)
+            )
+        self.set_local_information(contextual_posts)
+
+    def coalesce_key(self, stage, user_query, parts):
+        """Single-flight key: the question, the geohash cell and time window it was asked in, and the stage's own inputs."""
+        cell = None
+        if self.curr_lat is not None and self.curr_long is not None:
+            cell = encode_geohash(float(self.curr_lat), float(self.curr_long), self.COALESCE_PRECISION)
+        window = int(time.time() // self.COALESCE_WINDOW_SECONDS)
+        return self.single_flight.make_key(stage, normalize_question(user_query), cell, window, *parts)
+
+    def coalesced(self, stage, user_query, parts, fn):
+        """Runs fn, or waits for an identical in-flight call from another request and shares its result."""
+        if self.COALESCE_WINDOW_SECONDS <= 0:
+            return fn()
+        return self.single_flight.do(self.coalesce_key(stage, user_query, parts), fn)
+
+    async def coalesced_async(self, stage, user_query, parts, fn):
+        """Async variant of coalesced; fn returns an awaitable."""
+        if self.COALESCE_WINDOW_SECONDS <= 0:
+            return await fn()
+        return await self.single_flight.do_async(self.coalesce_key(stage, user_query, parts), fn)
+
+    def coalesced_stream(self, stage, user_query, parts, fn):
+        """Streaming variant of coalesced; fn returns an async iterator whose items every caller receives."""
+        if self.COALESCE_WINDOW_SECONDS <= 0:
+            return fn()
+        return self.single_flight.stream(self.coalesce_key(stage, user_query, parts), fn)
+
+    def start_retrieval(self, my_question):
+        """
+        Starts loading local information. In staged mode this returns a Future that
+        finish_retrieval joins, otherwise the posts are loaded right away and None is returned.
+        """
+        if not self.STAGED_EXECUTION:
+            self.load_local_information(my_question)
+            return None
+        # Run in a copy of this context so the worker's spans land in this turn's trace
+        return self.stage_executor.submit(contextvars.copy_context().run, self.load_local_information, my_question)
+
+    async def start_retrieval_async(self, my_question):
+        """Async variant of start_retrieval, returning an asyncio Task in staged mode."""
+        if not self.STAGED_EXECUTION:
+            await self.load_local_information_async(my_question)
+            return None
+        return asyncio.create_task(self.load_local_information_async(my_question))
+
+    def finish_retrieval(self, retrieval):
+        """Waits for a staged retrieval so local_information_string is filled in."""
+        if retrieval is not None:
+            retrieval.result()
+
+    async def finish_retrieval_async(self, retrieval):
+        if retrieval is not None:
+            await retrieval
+
+    def cancel_retrieval(self, retrieval):
+        """
+        Abandons a staged retrieval whose result will not be used. Pending work is cancelled; a
+        sync retrieval that is already running cannot be stopped and finishes in the background.
+        A retrieval that already failed has its exception consumed here, so an abandoned asyncio
+        Task is not reported as "exception was never retrieved".
+        """
+        if retrieval is None:
+            return
+        if not retrieval.done():
+            retrieval.cancel()
+        elif not retrieval.cancelled() and retrieval.exception() is not None:
+            print(f"Abandoned retrieval failed: {retrieval.exception()}")
+
+    def set_local_information(self, contextual_posts):
+        """Formats the retrieved posts into the local information string."""
         
         # Reset the string at the start of each question
         self.local_information_string = ""
+        self.local_posts = contextual_posts if isinstance(contextual_posts, list) else []
         
-        context_fetch = ContextFetch()
-        contextual_posts = context_fetch.main_with_your_data(my_question, curr_lat, curr_long)
         for i, post in enumerate(contextual_posts, 1):
                 if contextual_posts == "answer based on the user given query only":
                     self.local_information_string = "answer based on the user given query only"
                 else:
                     self.local_information_string += f"{i}. {post['combined_text']} \n"
 
+    def local_posts_metadata(self):
+        """Ids and scores of the retrieved local posts, without their text."""
+        return [
+            {
+                "post_id": post["post_id"],
+                "similarity_score": post["similarity_score"],
+                "created_at": post["created_at"],
+            }
+            for post in self.local_posts
+        ]
+
     def add_to_history(self, role, text):
-        """Adds a turn to the conversation history, maintaining max length."""
-        self.conversation_history.append({"role": role, "parts": [{"text": text}]})
-        # Ensure only the last MAX_HISTORY_LENGTH * 2 entries are kept
-        while len(self.conversation_history) > self.MAX_HISTORY_LENGTH * 2: 
-            self.conversation_history.pop(0)  # Remove oldest turn
+        """Adds a turn to the conversation history; the ring buffer drops the oldest once full."""
+        self.conversation_history.append(role, text)
 
     def get_current_context_string(self):
         """
@@ -63,16 +256,100 @@ class ChatbotLocal:
         ist_now = utc_now + ist_offset
         current_time_str = ist_now.strftime("%A, %B %d, %Y at %I:%M:%S %p IST")
 
-        return f"Current date and time: {current_time_str}. The current default location for location-based queries is lattitude: {curr_lat} longitude:{curr_long}"
+        return f"Current date and time: {current_time_str}. The current default location for location-based queries is lattitude: {self.curr_lat} longitude:{self.curr_long}"
 
     def extract_parameters_and_intent(self, user_query, history):
         """
         Analyzes the user query to determine intent (map, weather, or chat)
         and extracts relevant parameters. Includes history for context.
-        The prompt explicitly defines what information each tool can retrieve,
-        now including "traffic" with origin/destination parameters.
+        The local classifier answers when it is confident, otherwise Gemini Flash decides.
+        """
+        params, confidence = self.classify_intent_locally(user_query, history)
+        if confidence >= self.intent_classifier.threshold:
+            if self.intent_classifier.should_shadow():
+                self.stage_executor.submit(self.compare_intent_with_gemini, user_query, history, params, confidence)
+            return params
+
+        llm_params = self.extract_parameters_with_gemini(user_query, history)
+        return self.resolve_intent(user_query, params, confidence, llm_params)
+
+    async def extract_parameters_and_intent_async(self, user_query, history):
+        """Async variant of extract_parameters_and_intent."""
+        params, confidence = self.classify_intent_locally(user_query, history)
+        if confidence >= self.intent_classifier.threshold:
+            if self.intent_classifier.should_shadow():
+                task = asyncio.create_task(self.compare_intent_with_gemini_async(user_query, history, params, confidence))
+                self.background_tasks.add(task)
+                task.add_done_callback(self.background_tasks.discard)
+            return params
+
+        llm_params = await self.extract_parameters_with_gemini_async(user_query, history)
+        return self.resolve_intent(user_query, params, confidence, llm_params)
+
+    def classify_intent_locally(self, user_query, history):
+        params, confidence = self.intent_classifier.classify(user_query, history)
+        local_hit = confidence >= self.intent_classifier.threshold
+        self.intent_classifier.record(confidence, local_hit)
+        if local_hit:
+            print(f"Local intent classifier ({confidence}): {params}")
+        return params, confidence
+
+    def resolve_intent(self, user_query, local_params, confidence, llm_params):
+        """Picks the final intent after a Gemini fallback and records how the two compared."""
+        if llm_params is None:
+            # Gemini is unavailable; a complete local guess beats defaulting to chat
+            if self.intent_classifier.has_required_slots(local_params):
+                return local_params
+            return {"intent": "chat"}
+        self.intent_classifier.record_comparison(user_query, local_params, confidence, llm_params)
+        return llm_params
+
+    def compare_intent_with_gemini(self, user_query, history, local_params, confidence):
+        llm_params = self.extract_parameters_with_gemini(user_query, history)
+        if llm_params is not None:
+            self.intent_classifier.record_comparison(user_query, local_params, confidence, llm_params)
+
+    async def compare_intent_with_gemini_async(self, user_query, history, local_params, confidence):
+        llm_params = await self.extract_parameters_with_gemini_async(user_query, history)
+        if llm_params is not None:
+            self.intent_classifier.record_comparison(user_query, local_params, confidence, llm_params)
+
+    def extract_parameters_with_gemini(self, user_query, history):
+        """
+        Asks Gemini Flash for the intent and parameters. The prompt explicitly defines what
+        information each tool can retrieve, including "traffic" with origin/destination parameters.
+        Returns None if the call fails. Identical concurrent questions share one call.
         """
-        history_str = "\n".join([f"{item['role']}: {item['parts'][0]['text']}" for item in history])
+        return self.coalesced("intent", user_query, [history.pairs()], lambda: self.request_intent_from_gemini(user_query, history))
+
+    async def extract_parameters_with_gemini_async(self, user_query, history):
+        """Async variant of extract_parameters_with_gemini."""
+        return await self.coalesced_async("intent", user_query, [history.pairs()], lambda: self.request_intent_from_gemini_async(user_query, history))
+
+    def request_intent_from_gemini(self, user_query, history):
+        prompt = self.build_intent_prompt(user_query, history)
+        try:
+            response = self.model_flash.generate_content(prompt)
+            text = response.text
+        except Exception as e:
+            print(f"An unexpected error occurred in extract_parameters_and_intent: {e}")
+            return None
+        return self.parse_intent_response(text)
+
+    async def request_intent_from_gemini_async(self, user_query, history):
+        prompt = self.build_intent_prompt(user_query, history)
+        try:
+            response = await self.model_flash.generate_content_async(prompt)
+            text = response.text
+        except Exception as e:
+            print(f"An unexpected error occurred in extract_parameters_and_intent: {e}")
+            return None
+        return self.parse_intent_response(text)
+
+    def build_intent_prompt(self, user_query, history):
+        """Builds the Gemini Flash prompt used for intent and parameter extraction."""
+        history, _ = self.prompt_assembler.fit("intent", user_query, history)
+        history_str = self.prompt_assembler.history_text(history)
         if history_str:
             history_str = "\nPrevious Conversation:\n" + history_str
 
@@ -120,10 +397,13 @@ class ChatbotLocal:
             "Ensure parameters are included only if applicable to the determined intent. "
             "If a location, origin, or destination is not explicitly given and cannot be inferred, set it to null."
         )
-        
+        return prompt
+
+    def parse_intent_response(self, text):
+        """Parses Gemini's intent JSON and drops parameters that don't apply to the intent."""
+        json_string = ""
         try:
-            response = self.model_flash.generate_content(prompt)
-            text = response.text.strip()
+            text = text.strip()
             print("Gemini raw response (extract_parameters_and_intent):", text)
 
             match = re.search(r"```json\s*(\{.*\})\s*```", text, re.DOTALL)
@@ -219,28 +499,70 @@ class ChatbotLocal:
         else:
             return None, "Could not determine traffic for the specified location or route."
 
+    PLACES_URL = "https://maps.googleapis.com/maps/api/place/textsearch/json"
+    GEOCODING_URL = "http://api.openweathermap.org/geo/1.0/direct"
+    WEATHER_URL = "https://api.openweathermap.org/data/2.5/weather"
+
+    def build_places_query(self, location, place_type):
+        """Builds the Places Text Search query string, or None if there is nothing to search for."""
+        if place_type and location:
+            return f"{place_type} in {location}"
+        elif place_type:
+            return f"{place_type} in Kolkata"  # Default to Kolkata if only type
+        elif location:
+            return f"places in {location}"  # General search in location
+        return None
+
     def search_places(self, location, place_type, maps_api_key):
         """
         Use the Google Places API (Text Search) to search for places.
         Returns (data, error_message).
         """
-        query_string = ""
-        if place_type and location:
-            query_string = f"{place_type} in {location}"
-        elif place_type:
-            query_string = f"{place_type} in Kolkata"  # Default to Kolkata if only type
-        elif location:
-            query_string = f"places in {location}"  # General search in location
-        else:
+        query_string = self.build_places_query(location, place_type)
+        if not query_string:
+            return None, "A location or place type is required for map search."
+
+        cache_key = self.places_cache_key(location, place_type, query_string)
+        cached = self.response_cache.get(cache_key)
+        if cached is not None:
+            return cached, None
+
+        params = {
+            "query": query_string,
+            "key": maps_api_key
+        }
+        response = self.http_client.get(self.PLACES_URL, params=params)
+        return self.cache_places_response(cache_key, response)
+
+    async def search_places_async(self, location, place_type, maps_api_key):
+        """Async variant of search_places; shared cache reads and writes run in a worker thread."""
+        query_string = self.build_places_query(location, place_type)
+        if not query_string:
             return None, "A location or place type is required for map search."
 
-        url = "https://maps.googleapis.com/maps/api/place/textsearch/json"
+        cache_key = self.places_cache_key(location, place_type, query_string)
+        cached = await self.response_cache.get_async(cache_key)
+        if cached is not None:
+            return cached, None
+
         params = {
             "query": query_string,
             "key": maps_api_key
         }
-        response = requests.get(url, params=params)
+        response = await self.http_client.get_async(self.PLACES_URL, params=params)
+        return await asyncio.to_thread(self.cache_places_response, cache_key, response)
+
+    def places_cache_key(self, location, place_type, query_string):
+        return self.response_cache.make_key("map", place_type, GeocodeCache.normalize(location or query_string))
 
+    def cache_places_response(self, cache_key, response):
+        data, error = self.parse_places_response(response)
+        if error is None:
+            self.response_cache.put(cache_key, data, self.PLACES_CACHE_TTL_SECONDS)
+        return data, error
+
+    def parse_places_response(self, response):
+        """Turns a Places API HTTP response into (data, error_message)."""
         if response.status_code != 200:
             return None, f"HTTP Error {response.status_code} from Places API: {response.text}"
 
@@ -257,36 +579,123 @@ class ChatbotLocal:
         Fetches current weather information for a given location using OpenWeatherMap API.
         Returns (weather_data, city_name, error_message).
         """
-        geo_url = "http://api.openweathermap.org/geo/1.0/direct"
+        lat, lon, city_name, error = self.geocode_location(location, openweather_api_key)
+        if error:
+            return None, None, error
+
+        cache_key = self.weather_cache_key(lat, lon)
+        cached = self.response_cache.get(cache_key)
+        if cached is not None:
+            return cached, city_name, None
+
+        weather_params = {
+            "lat": lat,
+            "lon": lon,
+            "appid": openweather_api_key,
+            "units": "metric"
+        }
+        weather_response = self.http_client.get(self.WEATHER_URL, params=weather_params)
+        return self.cache_weather_response(cache_key, weather_response, city_name)
+
+    async def get_current_weather_async(self, location, openweather_api_key):
+        """Async variant of get_current_weather; shared cache reads and writes run in a worker thread."""
+        lat, lon, city_name, error = await self.geocode_location_async(location, openweather_api_key)
+        if error:
+            return None, None, error
+
+        cache_key = self.weather_cache_key(lat, lon)
+        cached = await self.response_cache.get_async(cache_key)
+        if cached is not None:
+            return cached, city_name, None
+
+        weather_params = {
+            "lat": lat,
+            "lon": lon,
+            "appid": openweather_api_key,
+            "units": "metric"
+        }
+        weather_response = await self.http_client.get_async(self.WEATHER_URL, params=weather_params)
+        return await asyncio.to_thread(self.cache_weather_response, cache_key, weather_response, city_name)
+
+    def geocode_location(self, location, openweather_api_key):
+        """
+        Resolves a place name to (lat, lon, city_name, error_message), answering
+        repeat locations from the geocoding cache without calling OpenWeather.
+        """
+        cached = self.geocode_cache.get(location)
+        if cached is not None:
+            return self.cached_geocode(cached, location)
+
+        geo_params = {
+            "q": location,
+            "limit": 1,
+            "appid": openweather_api_key
+        }
+        geo_response = self.http_client.get(self.GEOCODING_URL, params=geo_params)
+        return self.cache_geocoding_response(geo_response, location)
+
+    async def geocode_location_async(self, location, openweather_api_key):
+        """Async variant of geocode_location; the cache's SQLite calls run in a worker thread."""
+        cached = await asyncio.to_thread(self.geocode_cache.get, location)
+        if cached is not None:
+            return self.cached_geocode(cached, location)
+
         geo_params = {
             "q": location,
             "limit": 1,
             "appid": openweather_api_key
         }
-        geo_response = requests.get(geo_url, params=geo_params)
+        geo_response = await self.http_client.get_async(self.GEOCODING_URL, params=geo_params)
+        return await asyncio.to_thread(self.cache_geocoding_response, geo_response, location)
+
+    def cached_geocode(self, cached, location):
+        if cached.get("unknown"):
+            return None, None, None, self.unknown_location_message(location)
+        return cached["lat"], cached["lon"], cached["city_name"], None
+
+    def cache_geocoding_response(self, geo_response, location):
+        """Parses a geocoding response, caching found places and names the geocoder doesn't know."""
+        lat, lon, city_name, error, not_found = self.parse_geocoding_response(geo_response, location)
+        if error is None:
+            self.geocode_cache.put(location, lat, lon, city_name)
+        elif not_found:
+            self.geocode_cache.put_unknown(location)
+        return lat, lon, city_name, error
+
+    def unknown_location_message(self, location):
+        return f"Could not find coordinates for {location}. Please check the spelling or try a more specific location."
+
+    def weather_cache_key(self, lat, lon):
+        return self.response_cache.make_key("weather", None, encode_geohash(lat, lon, self.WEATHER_CACHE_PRECISION))
+
+    def cache_weather_response(self, cache_key, weather_response, city_name):
+        weather_data, city_name, error = self.parse_weather_response(weather_response, city_name)
+        if error is None:
+            self.response_cache.put(cache_key, weather_data, self.WEATHER_CACHE_TTL_SECONDS)
+        return weather_data, city_name, error
+
+    def parse_geocoding_response(self, geo_response, location):
+        """
+        Turns an OpenWeatherMap geocoding response into (lat, lon, city_name, error_message, not_found),
+        where not_found says the geocoder answered but knows no such place.
+        """
         if geo_response.status_code != 200:
-            return None, None, f"HTTP Error {geo_response.status_code} from Geocoding API: {geo_response.text}"
+            return None, None, None, f"HTTP Error {geo_response.status_code} from Geocoding API: {geo_response.text}", False
 
         try:
             geo_data = geo_response.json()
             if not geo_data:
-                return None, None, f"Could not find coordinates for {location}. Please check the spelling or try a more specific location."
+                return None, None, None, self.unknown_location_message(location), True
             
             lat = geo_data[0]['lat']
             lon = geo_data[0]['lon']
             city_name = geo_data[0].get('name', location)
+            return lat, lon, city_name, None, False
         except (json.JSONDecodeError, IndexError, KeyError) as e:
-            return None, None, f"Error parsing geocoding response: {e}. Raw response: {geo_response.text}"
-
-        weather_url = "https://api.openweathermap.org/data/2.5/weather"
-        weather_params = {
-            "lat": lat,
-            "lon": lon,
-            "appid": openweather_api_key,
-            "units": "metric"
-        }
-        weather_response = requests.get(weather_url, params=weather_params)
+            return None, None, None, f"Error parsing geocoding response: {e}. Raw response: {geo_response.text}", False
 
+    def parse_weather_response(self, weather_response, city_name):
+        """Turns an OpenWeatherMap weather response into (weather_data, city_name, error_message)."""
         if weather_response.status_code != 200:
             return None, None, f"HTTP Error {weather_response.status_code} from Weather API: {weather_response.text}"
 
@@ -298,6 +707,79 @@ class ChatbotLocal:
         except json.JSONDecodeError as e:
             return None, None, f"Error parsing Weather API response JSON: {e}. Raw response: {weather_response.text}"
 
+    def generate_gemini_reply(self, kind, user_query, history, prompt, context, error_message):
+        """
+        Sends prompt to the Gemini model the router picks for this kind of answer, retrying once
+        on the other model if the first times out or fails. Returns error_message if both fail.
+        Identical concurrent questions with the same history share one answer.
+        """
+        model, text = self.coalesced(
+            "answer", user_query, [kind, history],
+            lambda: self.request_gemini_reply(kind, history, prompt, context, error_message)
+        )
+        if model is not None:
+            self.served_model = model
+        return text
+
+    def request_gemini_reply(self, kind, history, prompt, context, error_message):
+        """Returns (model, text) from the routed Gemini model, or (None, error_message)"""
+        route = self.model_router.choose(kind, self.prompt_assembler.history_tokens(history) + estimate_tokens(prompt))
+        with span("answer"):
+            for attempt, (model, timeout) in enumerate(route.attempts()):
+                started = time.monotonic()
+                try:
+                    chat_session = self.models[model].start_chat(history=history)
+                    response = chat_session.send_message(prompt, request_options={"timeout": timeout})
+                    text = response.text
+                except Exception as e:
+                    self.model_router.record(model, kind, route.reason, self.model_router.elapsed(started), ok=False, fallback=attempt > 0)
+                    print(f"Error generating Gemini {model} response for {context}: {e}")
+                    continue
+                self.model_router.record(model, kind, route.reason, self.model_router.elapsed(started), ok=True, fallback=attempt > 0)
+                return model, text
+        return None, error_message
+
+    async def stream_gemini_reply(self, kind, user_query, history, prompt, context, error_message):
+        """
+        Streaming variant of generate_gemini_reply, yielding the text of each chunk. The other
+        model is only tried if the first one fails before its first chunk arrives.
+        """
+        chunks = self.coalesced_stream(
+            "answer", user_query, [kind, history],
+            lambda: self.request_gemini_reply_stream(kind, history, prompt, context, error_message)
+        )
+        async for model, text in chunks:
+            if model is not None:
+                self.served_model = model
+            yield text
+
+    async def request_gemini_reply_stream(self, kind, history, prompt, context, error_message):
+        """Streaming variant of request_gemini_reply, yielding (model, text) chunks"""
+        route = self.model_router.choose(kind, self.prompt_assembler.history_tokens(history) + estimate_tokens(prompt))
+        # Up to the last chunk; time to the first one is what model_router records
+        with span("answer"):
+            for attempt, (model, timeout) in enumerate(route.attempts()):
+                started = time.monotonic()
+                served = False
+                try:
+                    chat_session = self.models[model].start_chat(history=history)
+                    # Resolves once the first chunk is in, so the timeout bounds time to first token
+                    response = await asyncio.wait_for(chat_session.send_message_async(prompt, stream=True), timeout)
+                    self.model_router.record(model, kind, route.reason, self.model_router.elapsed(started), ok=True, fallback=attempt > 0)
+                    served = True
+                    async for chunk in response:
+                        text = chunk.text
+                        if text:
+                            yield model, text
+                    return
+                except Exception as e:
+                    print(f"Error generating Gemini {model} response for {context}: {str(e) or type(e).__name__}")
+                    if served:
+                        # Part of the answer may already be out; finishing it on another model would not read right
+                        return
+                    self.model_router.record(model, kind, route.reason, self.model_router.elapsed(started), ok=False, fallback=attempt > 0)
+        yield None, error_message
+
     def format_map_results_with_gemini(self, user_query, map_data, history, local_info):
         """
         Uses Gemini to summarize map search results into a natural language response,
@@ -305,7 +787,22 @@ class ChatbotLocal:
         """
         if not map_data or not map_data.get("results"):
             return "I couldn't find any information for your map query at the moment."
+        history, local_info = self.prompt_assembler.fit("map", user_query, history, local_info)
+        prompt = self.build_map_prompt(user_query, map_data, local_info)
+        return self.generate_gemini_reply("map", user_query, history, prompt, "map formatting", "I found some places, but I'm having trouble summarizing them right now.")
+
+    async def format_map_results_stream(self, user_query, map_data, history, local_info):
+        """Streaming variant of format_map_results_with_gemini, yielding text chunks as Gemini produces them."""
+        if not map_data or not map_data.get("results"):
+            yield "I couldn't find any information for your map query at the moment."
+            return
+        history, local_info = self.prompt_assembler.fit("map", user_query, history, local_info)
+        prompt = self.build_map_prompt(user_query, map_data, local_info)
+        async for chunk in self.stream_gemini_reply("map", user_query, history, prompt, "map formatting", "I found some places, but I'm having trouble summarizing them right now."):
+            yield chunk
 
+    def build_map_prompt(self, user_query, map_data, local_info):
+        """Builds the Gemini prompt used by format_map_results_with_gemini."""
         places_info = []
         for i, place in enumerate(map_data["results"][:5]):
             name = place.get('name', 'Unknown Place')
@@ -337,14 +834,7 @@ class ChatbotLocal:
             "Do not explicitly mention 'API results' or 'extracted data'. "
             "Just provide a helpful answer as if you found them naturally."
         )
-        
-        try:
-            chat_session = self.model_pro.start_chat(history=history)
-            response = chat_session.send_message(prompt_for_summarization)
-            return response.text
-        except Exception as e:
-            print(f"Error generating Gemini response for map formatting: {e}")
-            return "I found some places, but I'm having trouble summarizing them right now."
+        return prompt_for_summarization
 
     def format_weather_data_with_gemini(self, user_query, weather_data, city_name, history, local_info):
         """
@@ -353,7 +843,22 @@ class ChatbotLocal:
         """
         if not weather_data:
             return "I couldn't retrieve complete weather information for that location."
+        history, local_info = self.prompt_assembler.fit("weather", user_query, history, local_info)
+        prompt = self.build_weather_prompt(user_query, weather_data, city_name, local_info)
+        return self.generate_gemini_reply("weather", user_query, history, prompt, "weather formatting", "I retrieved the weather data, but I'm having trouble summarizing it right now.")
 
+    async def format_weather_data_stream(self, user_query, weather_data, city_name, history, local_info):
+        """Streaming variant of format_weather_data_with_gemini, yielding text chunks as Gemini produces them."""
+        if not weather_data:
+            yield "I couldn't retrieve complete weather information for that location."
+            return
+        history, local_info = self.prompt_assembler.fit("weather", user_query, history, local_info)
+        prompt = self.build_weather_prompt(user_query, weather_data, city_name, local_info)
+        async for chunk in self.stream_gemini_reply("weather", user_query, history, prompt, "weather formatting", "I retrieved the weather data, but I'm having trouble summarizing it right now."):
+            yield chunk
+
+    def build_weather_prompt(self, user_query, weather_data, city_name, local_info):
+        """Builds the Gemini prompt used by format_weather_data_with_gemini."""
         try:
             main = weather_data['main']
             weather_desc = weather_data['weather'][0]['description']
@@ -395,19 +900,26 @@ class ChatbotLocal:
             "Do not explicitly mention 'API results' or 'extracted data'. "
             "Just provide a helpful answer."
         )
-        try:
-            chat_session = self.model_pro.start_chat(history=history)
-            response = chat_session.send_message(prompt_for_summarization)
-            return response.text
-        except Exception as e:
-            print(f"Error generating Gemini response for weather formatting: {e}")
-            return "I retrieved the weather data, but I'm having trouble summarizing it right now."
+        return prompt_for_summarization
 
     def format_traffic_results_with_gemini(self, user_query, traffic_data, location, origin, destination, history, local_info):
         """
         Uses Gemini to summarize traffic data into a natural language response,
         considering previous conversation and prioritizing local info.
         """
+        history, local_info = self.prompt_assembler.fit("traffic", user_query, history, local_info)
+        prompt = self.build_traffic_prompt(user_query, traffic_data, location, origin, destination, local_info)
+        return self.generate_gemini_reply("traffic", user_query, history, prompt, "traffic formatting", "I retrieved some traffic data, but I'm having trouble summarizing it right now.")
+
+    async def format_traffic_results_stream(self, user_query, traffic_data, location, origin, destination, history, local_info):
+        """Streaming variant of format_traffic_results_with_gemini, yielding text chunks as Gemini produces them."""
+        history, local_info = self.prompt_assembler.fit("traffic", user_query, history, local_info)
+        prompt = self.build_traffic_prompt(user_query, traffic_data, location, origin, destination, local_info)
+        async for chunk in self.stream_gemini_reply("traffic", user_query, history, prompt, "traffic formatting", "I retrieved some traffic data, but I'm having trouble summarizing it right now."):
+            yield chunk
+
+    def build_traffic_prompt(self, user_query, traffic_data, location, origin, destination, local_info):
+        """Builds the Gemini prompt used by format_traffic_results_with_gemini."""
         traffic_summary_raw = ""
         if traffic_data and "duration_text" in traffic_data:
             traffic_summary_raw = f"The estimated travel time with current traffic from {origin or location} to {destination or location} is {traffic_data['duration_text']}."
@@ -438,19 +950,28 @@ class ChatbotLocal:
             "Do not explicitly mention 'API results' or 'extracted data'. "
             "Just provide a helpful answer."
         )
-        try:
-            chat_session = self.model_pro.start_chat(history=history)
-            response = chat_session.send_message(prompt_for_summarization)
-            return response.text
-        except Exception as e:
-            print(f"Error generating Gemini response for traffic formatting: {e}")
-            return "I retrieved some traffic data, but I'm having trouble summarizing it right now."
+        return prompt_for_summarization
 
     def general_chat_with_gemini(self, user_query, history, local_info):
         """
         Handles general chat queries using Gemini, considering previous conversation
         and prioritizing local information.
         """
+        # History used to be both inlined in the prompt and sent as chat history; now it is only sent once
+        history, local_info = self.prompt_assembler.fit("chat", user_query, history, local_info, baseline_history_copies=2)
+        prompt = self.build_general_chat_prompt(user_query, local_info)
+        return self.generate_gemini_reply("chat", user_query, history, prompt, "general chat", "I'm sorry, I encountered an issue while trying to answer that question.")
+
+    async def general_chat_stream(self, user_query, history, local_info):
+        """Streaming variant of general_chat_with_gemini, yielding text chunks as Gemini produces them."""
+        # History used to be both inlined in the prompt and sent as chat history; now it is only sent once
+        history, local_info = self.prompt_assembler.fit("chat", user_query, history, local_info, baseline_history_copies=2)
+        prompt = self.build_general_chat_prompt(user_query, local_info)
+        async for chunk in self.stream_gemini_reply("chat", user_query, history, prompt, "general chat", "I'm sorry, I encountered an issue while trying to answer that question."):
+            yield chunk
+
+    def build_general_chat_prompt(self, user_query, local_info):
+        """Builds the Gemini prompt used by general_chat_with_gemini."""
         full_chat_prompt = f"{self.get_current_context_string()}\n\n"
         
         local_info_context = ""
@@ -464,20 +985,11 @@ class ChatbotLocal:
                 "Avoid repeating the local info if it does not directly pertain to the current query."
             )
 
-        for item in history:
-            full_chat_prompt += f"{item['role'].capitalize()}: {item['parts'][0]['text']}\n"
-        
+        # Earlier turns reach Gemini as chat history, so only the new question goes in the prompt
         full_chat_prompt += f"User: {user_query}\n\n"
         full_chat_prompt += f"{local_info_context}"  # Inject local info context for general chat
         full_chat_prompt += "Please provide a helpful and conversational response."
-
-        try:
-            chat_session = self.model_pro.start_chat(history=history)  # Use start_chat for full history context
-            response = chat_session.send_message(full_chat_prompt)
-            return response.text
-        except Exception as e:
-            print(f"Error generating Gemini response for general chat: {e}")
-            return "I'm sorry, I encountered an issue while trying to answer that question."
+        return full_chat_prompt
 
     def conversation(self, question_asked, user_lat, user_long, chat_history=None):
         """
@@ -492,34 +1004,245 @@ class ChatbotLocal:
         Returns:
             str: Bot response message
         """
+        farewell = self.start_conversation(question_asked, user_lat, user_long, chat_history)
+        if farewell:
+            return farewell
+
+        # Load local information (in parallel with intent extraction when staged)
+        retrieval = self.start_retrieval(question_asked)
+        try:
+            # Note: Don't add to history here since FastAPI handles this
+            # self.add_to_history("user", question_asked)
+
+            # Extract parameters and intent
+            with span("intent"):
+                params = self.extract_parameters_and_intent(question_asked, self.conversation_history)
+            intent, location, place_type, origin, destination = self.unpack_params(params)
+
+            response_message = ""
+
+            if intent == "map":
+                if place_type == "traffic":
+                    print(f"Attempting to fetch traffic data for {location} (Origin: {origin}, Destination: {destination})...")
+                    # Call the new traffic function
+                    with span("traffic"):
+                        traffic_data, error = self.get_live_traffic_data(location, origin, destination, self.MAPS_API_KEY)
+                
+                    if error:
+                        print(f"Error during traffic data fetch: {error}")
+                        response_message = f"Sorry, I couldn't get live traffic updates for {location}. {error}"
+                    elif traffic_data:
+                        self.finish_retrieval(retrieval)
+                        response_message = self.format_traffic_results_with_gemini(question_asked, traffic_data, location, origin, destination, self.conversation_history, self.local_information_string)
+                    else:
+                        response_message = f"I couldn't retrieve specific traffic information for {location} at this time."
+
+                elif not location:
+                    response_message = "I need a location to search for places. Could you please specify one?"
+                elif not place_type:
+                    response_message = f"Please specify what kind of place you are looking for in {location}, or a more specific map query."
+                else:
+                    print(f"Searching for {place_type} in {location} using Google Maps...")
+                    try:
+                        with span("places"):
+                            map_results, error = self.search_places(location, place_type, self.MAPS_API_KEY)
+                    except HttpClientError as e:
+                        map_results, error = None, str(e)
+
+                    if error:
+                        print(f"Error during map search: {error}")
+                        response_message = "Sorry, I encountered an issue while trying to get map information. Please try again later."
+                    elif map_results and "results" in map_results and map_results["results"]:
+                        self.finish_retrieval(retrieval)
+                        response_message = self.format_map_results_with_gemini(question_asked, map_results, self.conversation_history, self.local_information_string)
+                    else:
+                        response_message = f"Sorry, I couldn't find any {place_type} in {location}. Perhaps try a different type of place or location?"
+        
+            elif intent == "weather":
+                if not location:
+                    response_message = "I need a location to fetch weather information. Could you please specify one?"
+                else:
+                    print(f"Fetching weather for {location} using OpenWeatherMap...")
+                    try:
+                        with span("weather"):
+                            weather_data, city_name, error = self.get_current_weather(location, self.OPENWEATHER_API_KEY)
+                    except HttpClientError as e:
+                        weather_data, city_name, error = None, None, str(e)
+
+                    if error:
+                        print(f"Error during weather fetch: {error}")
+                        response_message = "Sorry, I couldn't retrieve weather information for that location right now. Please check the spelling or try again later."
+                    elif weather_data:
+                        self.finish_retrieval(retrieval)
+                        response_message = self.format_weather_data_with_gemini(question_asked, weather_data, city_name, self.conversation_history, self.local_information_string)
+                    else:
+                        response_message = f"Sorry, I couldn't retrieve weather information for {location}."
+
+            else: # General chat
+                print("Processing general query...")
+                self.finish_retrieval(retrieval)
+                response_message = self.general_chat_with_gemini(question_asked, self.conversation_history, self.local_information_string)
+        finally:
+            # Replies that never reached a formatter did not need the local posts
+            self.cancel_retrieval(retrieval)
+
+        print("\n" + response_message)
+        print("\n" + self.local_information_string)
+        
+        # Note: Don't add to history here since FastAPI handles this
+        # self.add_to_history("model", response_message)
+        
+        return response_message
+
+    async def conversation_async(self, question_asked, user_lat, user_long, chat_history=None):
+        """
+        Async variant of conversation. Every network call (Firestore, Vertex AI embeddings,
+        Places, OpenWeather and Gemini) is awaited or runs in a worker thread, so the event
+        loop stays free to serve other chats while this one waits on I/O.
+        """
+        response_message = ""
+        async for event in self.conversation_events(question_asked, user_lat, user_long, chat_history):
+            if event["event"] == "done":
+                response_message = event["data"]["response"]
+
+        print("\n" + response_message)
+        return response_message
+
+    async def conversation_events(self, question_asked, user_lat, user_long, chat_history=None):
+        """
+        Runs one conversation turn as a stream of events for the streaming endpoints.
+
+        Yields dicts of the form {"event": name, "data": ...}, in order:
+            intent  - detected intent and parameters, as soon as Gemini Flash returns
+            posts   - metadata of the retrieved local posts, just before the answer is generated
+            token   - a chunk of answer text, repeated while Gemini streams
+            done    - the complete answer text and the Gemini model that wrote it (None for canned replies)
+        Canned replies (missing parameters, upstream errors) arrive as a single token event.
+        """
+        farewell = self.start_conversation(question_asked, user_lat, user_long, chat_history)
+        if farewell:
+            yield {"event": "token", "data": {"text": farewell}}
+            yield {"event": "done", "data": {"response": farewell, "model": None}}
+            return
+
+        # Load local information (in parallel with intent extraction when staged)
+        retrieval = await self.start_retrieval_async(question_asked)
+        try:
+            # Extract parameters and intent
+            with span("intent"):
+                params = await self.extract_parameters_and_intent_async(question_asked, self.conversation_history)
+            intent, location, place_type, origin, destination = self.unpack_params(params)
+            yield {"event": "intent", "data": {
+                "intent": intent,
+                "location": location,
+                "place_type": place_type,
+                "origin": origin,
+                "destination": destination,
+            }}
+
+            response_message = ""
+            # Set when the answer comes from Gemini; called with the local information once retrieval has joined
+            formatter = None
+
+            if intent == "map":
+                if place_type == "traffic":
+                    print(f"Attempting to fetch traffic data for {location} (Origin: {origin}, Destination: {destination})...")
+                    with span("traffic"):
+                        traffic_data, error = self.get_live_traffic_data(location, origin, destination, self.MAPS_API_KEY)
+                
+                    if error:
+                        print(f"Error during traffic data fetch: {error}")
+                        response_message = f"Sorry, I couldn't get live traffic updates for {location}. {error}"
+                    elif traffic_data:
+                        formatter = functools.partial(self.format_traffic_results_stream, question_asked, traffic_data, location, origin, destination, self.conversation_history)
+                    else:
+                        response_message = f"I couldn't retrieve specific traffic information for {location} at this time."
+
+                elif not location:
+                    response_message = "I need a location to search for places. Could you please specify one?"
+                elif not place_type:
+                    response_message = f"Please specify what kind of place you are looking for in {location}, or a more specific map query."
+                else:
+                    print(f"Searching for {place_type} in {location} using Google Maps...")
+                    try:
+                        with span("places"):
+                            map_results, error = await self.search_places_async(location, place_type, self.MAPS_API_KEY)
+                    except HttpClientError as e:
+                        map_results, error = None, str(e)
+
+                    if error:
+                        print(f"Error during map search: {error}")
+                        response_message = "Sorry, I encountered an issue while trying to get map information. Please try again later."
+                    elif map_results and "results" in map_results and map_results["results"]:
+                        formatter = functools.partial(self.format_map_results_stream, question_asked, map_results, self.conversation_history)
+                    else:
+                        response_message = f"Sorry, I couldn't find any {place_type} in {location}. Perhaps try a different type of place or location?"
+        
+            elif intent == "weather":
+                if not location:
+                    response_message = "I need a location to fetch weather information. Could you please specify one?"
+                else:
+                    print(f"Fetching weather for {location} using OpenWeatherMap...")
+                    try:
+                        with span("weather"):
+                            weather_data, city_name, error = await self.get_current_weather_async(location, self.OPENWEATHER_API_KEY)
+                    except HttpClientError as e:
+                        weather_data, city_name, error = None, None, str(e)
+
+                    if error:
+                        print(f"Error during weather fetch: {error}")
+                        response_message = "Sorry, I couldn't retrieve weather information for that location right now. Please check the spelling or try again later."
+                    elif weather_data:
+                        formatter = functools.partial(self.format_weather_data_stream, question_asked, weather_data, city_name, self.conversation_history)
+                    else:
+                        response_message = f"Sorry, I couldn't retrieve weather information for {location}."
+
+            else: # General chat
+                print("Processing general query...")
+                formatter = functools.partial(self.general_chat_stream, question_asked, self.conversation_history)
+
+            if formatter is not None:
+                await self.finish_retrieval_async(retrieval)
+                yield {"event": "posts", "data": {"posts": self.local_posts_metadata()}}
+                async for chunk in formatter(self.local_information_string):
+                    response_message += chunk
+                    yield {"event": "token", "data": {"text": chunk}}
+            else:
+                yield {"event": "token", "data": {"text": response_message}}
+        finally:
+            # Replies that never reached a formatter did not need the local posts
+            self.cancel_retrieval(retrieval)
+
+        yield {"event": "done", "data": {"response": response_message, "model": self.served_model}}
+
+    def start_conversation(self, question_asked, user_lat, user_long, chat_history):
+        """
+        Sets up per-request state shared by conversation and conversation_async.
+        Returns a farewell message if the user ended the chat, otherwise None.
+        """
         print("Welcome to your AI Assistant! I can help with maps, weather, and general questions.")
         print(f"I will remember the last {self.MAX_HISTORY_LENGTH} turns of our conversation only within this session.")
         
-        global curr_lat
-        global curr_long
-        curr_lat = user_lat
-        curr_long = user_long
+        # Kept on the session's RequestContext so concurrent requests don't mix locations
+        self.curr_lat = user_lat
+        self.curr_long = user_long
 
-        # Use provided chat history or initialize empty list
+        # Use provided chat history (a TurnBuffer or Gemini-shaped turns) or initialize empty history
         if chat_history is not None:
-            self.conversation_history = chat_history.copy()
+            self.conversation_history = TurnBuffer.from_turns(chat_history, self.MAX_HISTORY_LENGTH * 2)
             print(f"Loaded existing conversation history with {len(self.conversation_history)} messages")
         else:
             # Only clear history if no history is provided and user says 'exit'
             if question_asked.lower() == 'exit':
-                self.conversation_history = [] 
+                self.conversation_history = TurnBuffer(self.MAX_HISTORY_LENGTH * 2)
                 print("Memory cleared. Exiting chat. Goodbye!")
                 return "Goodbye! Your conversation history has been cleared."
+        return None
 
-        # Load local information
-        self.load_local_information(question_asked)
-        
-        # Note: Don't add to history here since FastAPI handles this
-        # self.add_to_history("user", question_asked)
-
-        # Extract parameters and intent
-        params = self.extract_parameters_and_intent(question_asked, self.conversation_history)
+    def unpack_params(self, params):
+        """Pulls intent and its parameters out of the extraction result, logs them and labels the trace."""
         intent = params.get("intent", "chat")
+        set_intent(intent)
         location = params.get("location")
         place_type = params.get("place_type") 
         origin = params.get("origin")
@@ -530,65 +1253,7 @@ class ChatbotLocal:
         if place_type: print(f"  Place Type/Sub-Intent: {place_type}")
         if origin: print(f"  Origin: {origin}")
         if destination: print(f"  Destination: {destination}")
-
-        response_message = ""
-
-        if intent == "map":
-            if place_type == "traffic":
-                print(f"Attempting to fetch traffic data for {location} (Origin: {origin}, Destination: {destination})...")
-                # Call the new traffic function
-                traffic_data, error = self.get_live_traffic_data(location, origin, destination, self.MAPS_API_KEY)
-                
-                if error:
-                    print(f"Error during traffic data fetch: {error}")
-                    response_message = f"Sorry, I couldn't get live traffic updates for {location}. {error}"
-                elif traffic_data:
-                    response_message = self.format_traffic_results_with_gemini(question_asked, traffic_data, location, origin, destination, self.conversation_history, self.local_information_string)
-                else:
-                    response_message = f"I couldn't retrieve specific traffic information for {location} at this time."
-
-            elif not location:
-                response_message = "I need a location to search for places. Could you please specify one?"
-            elif not place_type:
-                response_message = f"Please specify what kind of place you are looking for in {location}, or a more specific map query."
-            else:
-                print(f"Searching for {place_type} in {location} using Google Maps...")
-                map_results, error = self.search_places(location, place_type, self.MAPS_API_KEY)
-
-                if error:
-                    print(f"Error during map search: {error}")
-                    response_message = "Sorry, I encountered an issue while trying to get map information. Please try again later."
-                elif map_results and "results" in map_results and map_results["results"]:
-                    response_message = self.format_map_results_with_gemini(question_asked, map_results, self.conversation_history, self.local_information_string)
-                else:
-                    response_message = f"Sorry, I couldn't find any {place_type} in {location}. Perhaps try a different type of place or location?"
-        
-        elif intent == "weather":
-            if not location:
-                response_message = "I need a location to fetch weather information. Could you please specify one?"
-            else:
-                print(f"Fetching weather for {location} using OpenWeatherMap...")
-                weather_data, city_name, error = self.get_current_weather(location, self.OPENWEATHER_API_KEY)
-
-                if error:
-                    print(f"Error during weather fetch: {error}")
-                    response_message = "Sorry, I couldn't retrieve weather information for that location right now. Please check the spelling or try again later."
-                elif weather_data:
-                    response_message = self.format_weather_data_with_gemini(question_asked, weather_data, city_name, self.conversation_history, self.local_information_string)
-                else:
-                    response_message = f"Sorry, I couldn't retrieve weather information for {location}."
-
-        else: # General chat
-            print("Processing general query...")
-            response_message = self.general_chat_with_gemini(question_asked, self.conversation_history, self.local_information_string)
-        
-        print("\n" + response_message)
-        print("\n" + self.local_information_string)
-        
-        # Note: Don't add to history here since FastAPI handles this
-        # self.add_to_history("model", response_message)
-        
-        return response_message
+        return intent, location, place_type, origin, destination
             
             
 
@@ -1,19 +1,27 @@
-from fastapi import FastAPI, Query, HTTPException, Request, Response
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, Query, HTTPException, Request, Response, WebSocket, WebSocketDisconnect
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from typing import Optional, Dict, List
 import uvicorn
-from pydantic import BaseModel
+from pydantic import BaseModel, Field, ValidationError
 import logging
 import traceback
 import json
+import os
+import asyncio
 import uuid
 import time
-from datetime import datetime, timedelta
-from llm_working import ChatbotLocal
+from datetime import datetime
+from components import AppComponents
+from request_metrics import RequestMetrics, prometheus_text
+from session_store import AsyncSessionStore, create_session_store
+from tracing import RequestIdFilter, Tracer, incoming_request_id, new_request_id, request_id_var
+from turn_buffer import TurnBuffer
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
+# Configure logging; every line carries the id of the request it was logged for
+logging.basicConfig(level=logging.INFO, format="%(levelname)s:%(name)s:[%(request_id)s] %(message)s")
+for handler in logging.getLogger().handlers:
+    handler.addFilter(RequestIdFilter())
 logger = logging.getLogger(__name__)
 
 app = FastAPI(
@@ -48,13 +56,37 @@ app.add_middleware(
 )
 
 
-# In-memory storage for user histories (In production, use Redis or a database)
-user_histories: Dict[str, List[Dict]] = {}
-user_last_activity: Dict[str, datetime] = {}
-
 # Configuration
 HISTORY_EXPIRY_HOURS = 24  # Clear history after 24 hours of inactivity
 MAX_HISTORY_LENGTH = 5  # Keep last 5 conversation turns
+MAX_SESSIONS = int(os.getenv("MAX_SESSIONS", "100000"))  # Least recently active users are dropped beyond this
+LIVE_POST_CACHE = os.getenv("LIVE_POST_CACHE", "false").lower() == "true"  # Keep nearby posts in memory via a Firestore listener
+
+# User histories: "memory" keeps them in this process, "sqlite" shares them between workers.
+# /stats reports the bytes they hold, since memory per instance is what limits Cloud Run scaling.
+session_store = create_session_store(
+    os.getenv("SESSION_BACKEND", "memory"),
+    path=os.getenv("SESSION_DB_PATH", "sessions.db"),
+    ttl_seconds=HISTORY_EXPIRY_HOURS * 3600,
+    max_sessions=MAX_SESSIONS,
+    sweep_interval_seconds=float(os.getenv("SESSION_SWEEP_INTERVAL_SECONDS", "60")),
+    max_turns=MAX_HISTORY_LENGTH * 2,
+)
+# What the handlers await, so a SQLite store's lock waits never block the event loop
+async_session_store = AsyncSessionStore(session_store)
+
+# Chatbot, cloud clients and post index, built once at startup and shared by all requests
+components = AppComponents(live_post_cache=LIVE_POST_CACHE)
+
+# Request and error counts, kept current by the middleware so /health, /stats and /metrics stay O(1)
+request_metrics = RequestMetrics()
+
+# Per-stage latency of chat turns by intent, in /stats and /metrics. With TRACING_ENABLED=false
+# every span is a no-op; turns slower than TRACE_SLOW_SECONDS are logged with their breakdown.
+tracer = Tracer(
+    enabled=os.getenv("TRACING_ENABLED", "true").lower() == "true",
+    slow_seconds=float(os.getenv("TRACE_SLOW_SECONDS", "8")) or None,
+)
 
 # Response models
 class ChatResponse(BaseModel):
@@ -65,6 +97,13 @@ class ChatResponse(BaseModel):
     status: str
     user_id: str
     conversation_turn: int
+    model: Optional[str] = None  # Gemini model that wrote the answer, None for canned replies
+
+class ChatMessage(BaseModel):
+    """A chat turn sent over the WebSocket"""
+    question: str = Field(..., min_length=1)
+    lat: float = Field(..., ge=-90, le=90)
+    long: float = Field(..., ge=-180, le=180)
 
 class ErrorResponse(BaseModel):
     error: str
@@ -73,21 +112,6 @@ class ErrorResponse(BaseModel):
     status: str = "error"
 
 # Utility functions for history management
-def cleanup_expired_histories():
-    """Remove expired user histories"""
-    current_time = datetime.now()
-    expired_users = []
-    
-    for user_id, last_activity in user_last_activity.items():
-        if current_time - last_activity > timedelta(hours=HISTORY_EXPIRY_HOURS):
-            expired_users.append(user_id)
-    
-    for user_id in expired_users:
-        if user_id in user_histories:
-            del user_histories[user_id]
-        del user_last_activity[user_id]
-        logger.info(f"Cleaned up expired history for user: {user_id}")
-
 def get_or_create_user_id(request: Request) -> str:
     """Get user ID from cookie or create a new one"""
     user_id = request.cookies.get("chatbot_user_id")
@@ -96,27 +120,38 @@ def get_or_create_user_id(request: Request) -> str:
         logger.info(f"Created new user ID: {user_id}")
     return user_id
 
-def get_user_history(user_id: str) -> List[Dict]:
-    """Get conversation history for a user"""
-    cleanup_expired_histories()
-    return user_histories.get(user_id, [])
+async def get_user_history(user_id: str) -> TurnBuffer:
+    """Get conversation history for a user; expired histories are dropped on read"""
+    return await async_session_store.get(user_id)
 
-def update_user_history(user_id: str, history: List[Dict]):
+async def update_user_history(user_id: str, history: TurnBuffer):
     """Update conversation history for a user"""
-    user_histories[user_id] = history
-    user_last_activity[user_id] = datetime.now()
+    await async_session_store.put(user_id, history)
     logger.info(f"Updated history for user {user_id}: {len(history)} turns")
 
-def add_to_user_history(user_id: str, role: str, text: str):
-    """Add a message to user's conversation history"""
-    history = get_user_history(user_id)
-    history.append({"role": role, "parts": [{"text": text}]})
-    
-    # Maintain max history length (keep last MAX_HISTORY_LENGTH * 2 entries)
-    while len(history) > MAX_HISTORY_LENGTH * 2:
-        history.pop(0)
-    
-    update_user_history(user_id, history)
+async def add_to_user_history(user_id: str, role: str, text: str) -> TurnBuffer:
+    """Add a message to user's conversation history and return the updated history"""
+    # Read, append and trim to the last MAX_HISTORY_LENGTH * 2 entries in one store operation,
+    # so workers sharing the store cannot lose each other's turns
+    return await async_session_store.append(user_id, role, text)
+
+async def settle_unanswered_turn(user_id: str, question: str, partial_answer: str):
+    """Close a turn that ended before its answer was recorded, so no question is left without a reply"""
+    if partial_answer:
+        await add_to_user_history(user_id, "model", partial_answer)
+    else:
+        await async_session_store.discard_last(user_id, "user", question)
+
+@app.on_event("startup")
+async def warm_up_components():
+    """Warm up shared components in the background so probes are answered meanwhile"""
+    components.start()
+    session_store.start()
+
+@app.on_event("shutdown")
+async def shutdown_components():
+    session_store.stop()
+    await components.shutdown_async()
 
 # Health check endpoints
 @app.get("/", tags=["Health"])
@@ -125,34 +160,45 @@ async def root():
 
 @app.get("/health", tags=["Health"])
 async def health_check():
-    active_users = len(user_histories)
-    total_conversations = sum(len(history) for history in user_histories.values())
+    sessions = session_store.stats()
+    active_users = sessions["sessions"]
+    total_conversations = sessions["total_turns"]
+    component_status = components.status()
     return {
-        "status": "healthy", 
+        "status": "healthy" if components.dependencies_healthy() else "degraded", 
         "service": "AI Chatbot API", 
         "version": "1.0.0",
         "active_users": active_users,
-        "total_conversations": total_conversations
+        "total_conversations": total_conversations,
+        "dependencies": component_status["dependencies"]
     }
 
+@app.get("/ready", tags=["Health"])
+async def readiness_check():
+    """Readiness probe: only succeeds once the shared components have warmed up"""
+    status = components.status()
+    if not status["ready"]:
+        return JSONResponse(status_code=503, content={"status": "warming_up", **status})
+    return {"status": "ready", **status}
+
 @app.get("/test", tags=["Health"])
 async def test_chatbot():
-    try:
-        chatbot = ChatbotLocal()
+    status = components.status()
+    if status["ready"]:
         return {"status": "success", "message": "Chatbot initialized successfully"}
-    except Exception as e:
-        logger.error(f"Chatbot initialization failed: {str(e)}")
-        return {"status": "error", "message": f"Chatbot initialization failed: {str(e)}"}
+    if status["error"]:
+        return {"status": "error", "message": f"Chatbot initialization failed: {status['error']}"}
+    return {"status": "pending", "message": "Chatbot is still warming up"}
 
 # User management endpoints
 @app.get("/user/history", tags=["User Management"])
 async def get_user_conversation_history(request: Request):
     """Get the current user's conversation history"""
     user_id = get_or_create_user_id(request)
-    history = get_user_history(user_id)
+    history = await get_user_history(user_id)
     return {
         "user_id": user_id,
-        "history": history,
+        "history": history.to_gemini(),
         "conversation_turns": len(history),
         "status": "success"
     }
@@ -161,10 +207,7 @@ async def get_user_conversation_history(request: Request):
 async def clear_user_history(request: Request):
     """Clear the current user's conversation history"""
     user_id = get_or_create_user_id(request)
-    if user_id in user_histories:
-        del user_histories[user_id]
-    if user_id in user_last_activity:
-        del user_last_activity[user_id]
+    await async_session_store.delete(user_id)
     
     logger.info(f"Cleared history for user: {user_id}")
     return {
@@ -220,6 +263,9 @@ async def process_chat_request(
     """
     Process the chat request with proper error handling and user history management
     """
+    if not components.ready.is_set():
+        raise HTTPException(status_code=503, detail="Chatbot is warming up. Please try again shortly.")
+    
     try:
         # Get or create user ID
         if provided_user_id:
@@ -239,34 +285,29 @@ async def process_chat_request(
         
         logger.info(f"Processing chat request for user {user_id}: question='{question[:50]}...', lat={lat}, long={long}")
         
-        # Get user's conversation history
-        conversation_history = get_user_history(user_id)
-        
-        # Add user message to history
-        add_to_user_history(user_id, "user", question)
+        # Add user message to history; the earlier turns are what the chatbot gets as context
+        conversation_history = await add_to_user_history(user_id, "user", question)
+        conversation_history.pop()
         
-        # Initialize the chatbot
-        chatbot = ChatbotLocal()
-        logger.info("Chatbot initialized successfully")
+        # Get a chatbot session backed by the warm shared components
+        chatbot = components.new_chatbot()
         
         # Modify the chatbot to use the existing history
-        chatbot.conversation_history = conversation_history.copy()
-        
-        # Call your conversation function
-        response_message = chatbot.conversation(
-            question_asked=question,
-            user_lat=lat,
-            user_long=long
-        )
+        chatbot.conversation_history = conversation_history
         
-        # Add bot response to history
-        add_to_user_history(user_id, "model", response_message)
+        # Call your conversation function; it awaits all I/O so other chats keep being served
+        with tracer.trace():
+            response_message = await chatbot.conversation_async(
+                question_asked=question,
+                user_lat=lat,
+                user_long=long
+            )
         
-        # Get updated conversation count
-        updated_history = get_user_history(user_id)
+        # Add bot response to history and get the updated conversation count
+        updated_history = await add_to_user_history(user_id, "model", response_message)
         conversation_turn = len(updated_history) // 2  # Divide by 2 since each turn has user + model
         
-        logger.info(f"Chat response generated successfully for user {user_id}")
+        logger.info(f"Chat response generated successfully for user {user_id} (model: {chatbot.served_model})")
         
         # Return the response
         return ChatResponse(
@@ -276,7 +317,8 @@ async def process_chat_request(
             response=response_message,
             status="success",
             user_id=user_id,
-            conversation_turn=conversation_turn
+            conversation_turn=conversation_turn,
+            model=chatbot.served_model
         )
         
     except Exception as e:
@@ -298,6 +340,130 @@ async def process_chat_request(
             detail=detail
         )
 
+# Streaming chat: the same pipeline as /chat, delivered as events while the answer is generated
+async def stream_chat_events(user_id: str, question: str, lat: float, long: float, endpoint: str):
+    """
+    Run one chat turn as a stream of intent, posts, token and done events, recording the
+    question and the final answer in the user's history like process_chat_request does.
+    Failures are counted against `endpoint`, since the stream has already answered 200.
+    """
+    logger.info(f"Processing streaming chat request for user {user_id}: question='{question[:50]}...', lat={lat}, long={long}")
+    asked = answered = False
+    streamed = []
+    try:
+        conversation_history = await add_to_user_history(user_id, "user", question)
+        asked = True
+        conversation_history.pop()
+        
+        chatbot = components.new_chatbot()
+        chatbot.conversation_history = conversation_history
+        
+        with tracer.trace():
+            async for event in chatbot.conversation_events(question, lat, long):
+                if event["event"] == "token":
+                    streamed.append(event["data"]["text"])
+                elif event["event"] == "done":
+                    updated_history = await add_to_user_history(user_id, "model", event["data"]["response"])
+                    answered = True
+                    event["data"]["user_id"] = user_id
+                    event["data"]["conversation_turn"] = len(updated_history) // 2
+                yield event
+    except Exception as e:
+        logger.error(f"Error streaming chat response: {e}")
+        logger.error(f"Traceback: {traceback.format_exc()}")
+        request_metrics.error(endpoint)
+        yield {"event": "error", "data": {"message": f"Error processing your request: {e}"}}
+    finally:
+        # Failed, or the client went away mid-stream: keep what it was sent, or forget the question
+        if asked and not answered:
+            await settle_unanswered_turn(user_id, question, "".join(streamed))
+
+def format_sse(event: Dict) -> str:
+    return f"event: {event['event']}\ndata: {json.dumps(event['data'])}\n\n"
+
+def start_chat_stream(request: Request, question: str, lat: float, long: float, provided_user_id: Optional[str]):
+    if not components.ready.is_set():
+        raise HTTPException(status_code=503, detail="Chatbot is warming up. Please try again shortly.")
+    
+    user_id = provided_user_id or get_or_create_user_id(request)
+    
+    async def body():
+        async for event in stream_chat_events(user_id, question, lat, long, request.url.path):
+            yield format_sse(event)
+    
+    stream = StreamingResponse(
+        body(),
+        media_type="text/event-stream",
+        # Stop proxies from buffering the stream
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+    stream.set_cookie(
+        key="chatbot_user_id",
+        value=user_id,
+        max_age=30 * 24 * 60 * 60,  # 30 days in seconds
+        httponly=True,
+        secure=True,
+        samesite="None"
+    )
+    return stream
+
+@app.get("/chat/stream", tags=["Chatbot"])
+async def chat_stream_get(
+    request: Request,
+    question: str = Query(..., description="The question to ask the chatbot", min_length=1),
+    lat: float = Query(..., description="User's latitude coordinate", ge=-90, le=90),
+    long: float = Query(..., description="User's longitude coordinate", ge=-180, le=180),
+    user_id: Optional[str] = Query(None, description="Optional user ID for maintaining history")
+):
+    """
+    Chat with the AI assistant over Server-Sent Events. The answer is streamed as `token`
+    events after early `intent` and `posts` events, and closed by a `done` event.
+    """
+    return start_chat_stream(request, question, lat, long, user_id)
+
+@app.post("/chat/stream", tags=["Chatbot"])
+async def chat_stream_post(
+    request: Request,
+    question: str = Query(..., description="The question to ask the chatbot", min_length=1),
+    lat: float = Query(..., description="User's latitude coordinate", ge=-90, le=90),
+    long: float = Query(..., description="User's longitude coordinate", ge=-180, le=180),
+    user_id: Optional[str] = Query(None, description="Optional user ID for maintaining history")
+):
+    """Server-Sent Events chat using POST"""
+    return start_chat_stream(request, question, lat, long, user_id)
+
+@app.websocket("/ws/chat")
+async def chat_websocket(websocket: WebSocket):
+    """
+    Chat over a WebSocket. Each message is JSON {"question", "lat", "long"}; the reply is
+    sent as the same intent, posts, token and done events as /chat/stream, one JSON object each.
+    """
+    await websocket.accept()
+    user_id = (websocket.query_params.get("user_id")
+               or websocket.cookies.get("chatbot_user_id")
+               or str(uuid.uuid4()))
+    try:
+        while True:
+            frame = await websocket.receive_text()
+            try:
+                message = ChatMessage(**json.loads(frame))
+            except (json.JSONDecodeError, ValidationError, TypeError) as e:
+                await websocket.send_json({"event": "error", "data": {"message": f"Invalid chat message: {e}"}})
+                continue
+            
+            # Each message is one chat request; the HTTP middleware never sees WebSocket traffic
+            request_id_var.set(new_request_id())
+            request_metrics.request("/ws/chat")
+            if not components.ready.is_set():
+                request_metrics.error("/ws/chat")
+                await websocket.send_json({"event": "error", "data": {"message": "Chatbot is warming up. Please try again shortly."}})
+                continue
+            
+            async for event in stream_chat_events(user_id, message.question, message.lat, message.long, "/ws/chat"):
+                await websocket.send_json(event)
+    except WebSocketDisconnect:
+        logger.info(f"WebSocket closed for user {user_id}")
+
 # Enhanced API info endpoint
 @app.get("/info", tags=["Information"])
 async def api_info():
@@ -311,17 +477,24 @@ async def api_info():
             "Location-based services",
             "Weather information",
             "Maps and places search",
-            "General conversation"
+            "General conversation",
+            "Streaming responses over Server-Sent Events and WebSocket",
+            "Per-request routing between Gemini Flash and Pro"
         ],
         "endpoints": {
             "GET /": "Root endpoint - API status",
             "GET /health": "Health check endpoint with user statistics",
             "GET /test": "Test chatbot initialization",
+            "GET /ready": "Readiness probe, passes once components have warmed up",
             "GET /chat": "Main chatbot endpoint (GET method)",
             "POST /chat": "Main chatbot endpoint (POST method)",
+            "GET /chat/stream": "Streaming chatbot endpoint (Server-Sent Events)",
+            "POST /chat/stream": "Streaming chatbot endpoint (Server-Sent Events, POST method)",
+            "WS /ws/chat": "Streaming chatbot endpoint (WebSocket)",
             "GET /user/history": "Get current user's conversation history",
             "DELETE /user/history": "Clear current user's conversation history",
             "GET /info": "API information and examples",
+            "GET /metrics": "Session and request counters and per-stage chat latency in the Prometheus text format",
             "GET /docs": "Interactive API documentation (Swagger UI)",
             "GET /redoc": "Alternative API documentation (ReDoc)"
         },
@@ -351,24 +524,61 @@ async def api_info():
 @app.get("/stats", tags=["Information"])
 async def get_statistics():
     """Get API usage statistics"""
-    cleanup_expired_histories()
+    # Running totals; expired sessions are dropped by the sweeper, not by this request
+    sessions = session_store.stats()
     
-    active_users = len(user_histories)
-    total_conversations = sum(len(history) for history in user_histories.values())
+    active_users = sessions["sessions"]
+    total_conversations = sessions["total_turns"]
     
     # Calculate average conversations per user
     avg_conversations = total_conversations / active_users if active_users > 0 else 0
     
+    # A read of the shared SQLite file, kept off the event loop
+    geocode_stats = await asyncio.to_thread(components.chatbot.geocode_cache.stats) if components.chatbot is not None else None
+    
     return {
         "active_users": active_users,
         "total_conversations": total_conversations,
         "average_conversations_per_user": round(avg_conversations, 2),
         "max_history_length": MAX_HISTORY_LENGTH,
         "history_expiry_hours": HISTORY_EXPIRY_HOURS,
+        "sessions": sessions,
+        "requests": request_metrics.stats(),
+        # p50/p95/p99 seconds per pipeline stage, overall and per intent
+        "latency": tracer.stats(),
+        # Local intent hit rate and agreement with Gemini, for tuning INTENT_CONFIDENCE_THRESHOLD
+        "intent_classifier": components.chatbot.intent_classifier.stats() if components.chatbot is not None else None,
+        "geocode_cache": geocode_stats,
+        "response_cache": components.chatbot.response_cache.stats() if components.chatbot is not None else None,
+        "model_router": components.chatbot.model_router.stats() if components.chatbot is not None else None,
+        "coalescing": components.chatbot.single_flight.stats() if components.chatbot is not None else None,
+        "prompt_budget": components.chatbot.prompt_assembler.stats() if components.chatbot is not None else None,
         "timestamp": datetime.now().isoformat(),
         "status": "success"
     }
 
+@app.get("/metrics", tags=["Information"], response_class=PlainTextResponse)
+async def get_metrics():
+    """Session and request counters and per-stage chat latency in the Prometheus text format"""
+    sessions = session_store.stats()
+    families = [
+        ("chatbot_sessions_active", "gauge", "Users with a live conversation history",
+         [({"backend": sessions["backend"]}, sessions["sessions"])]),
+        ("chatbot_session_turns", "gauge", "Turns held across all conversation histories",
+         [({"backend": sessions["backend"]}, sessions["total_turns"])]),
+        ("chatbot_session_bytes", "gauge", "Bytes held by conversation histories",
+         [({"backend": sessions["backend"]}, sessions["bytes_total"])]),
+        ("chatbot_sessions_expired_total", "counter", "Sessions dropped after inactivity by this worker",
+         [({"backend": sessions["backend"]}, sessions["expired"])]),
+        ("chatbot_sessions_evicted_total", "counter", "Sessions dropped at the session limit by this worker",
+         [({"backend": sessions["backend"]}, sessions["evicted"])]),
+        ("chatbot_ready", "gauge", "1 once the shared components have warmed up",
+         [({}, int(components.ready.is_set()))]),
+    ]
+    families += request_metrics.families()
+    families += tracer.families()
+    return PlainTextResponse(prometheus_text(families), media_type="text/plain; version=0.0.4")
+
 # Custom error handlers
 @app.exception_handler(422)
 async def validation_exception_handler(request: Request, exc):
@@ -405,25 +615,45 @@ async def not_found_handler(request: Request, exc):
             "error": "Not Found",
             "message": f"The endpoint {request.url.path} was not found",
             "status": "error",
-            "available_endpoints": ["/chat", "/health", "/info", "/docs", "/user/history"]
+            "available_endpoints": ["/chat", "/health", "/ready", "/info", "/docs", "/user/history", "/metrics"]
         }
     )
 
+def metrics_endpoint(request: Request) -> str:
+    """Route template the request matched, so unknown URLs cannot grow the metric labels"""
+    route = request.scope.get("route")
+    return route.path if route is not None else "unmatched"
+
 # Middleware to log requests
 @app.middleware("http")
 async def log_requests(request: Request, call_next):
     start_time = time.time()
     
+    # Tag everything logged for this request, including in tasks and threads it starts
+    request_id = incoming_request_id(request.headers)
+    request_id_var.set(request_id)
+    
     # Log the request with user ID if available
     user_id = request.cookies.get("chatbot_user_id", "anonymous")
     logger.info(f"Request: {request.method} {request.url} [User: {user_id}]")
     
-    response = await call_next(request)
+    request_metrics.in_flight += 1
+    try:
+        response = await call_next(request)
+    except Exception:
+        request_metrics.error(metrics_endpoint(request))
+        raise
+    finally:
+        request_metrics.in_flight -= 1
+        request_metrics.request(metrics_endpoint(request))
+    if response.status_code >= 500:
+        request_metrics.error(metrics_endpoint(request))
     
     # Log the response
     process_time = time.time() - start_time
     logger.info(f"Response: {response.status_code} - {process_time:.2f}s [User: {user_id}]")
     
+    response.headers["X-Request-ID"] = request_id
     return response
 
 if __name__ == "__main__":
@@ -0,0 +1,113 @@
+import threading
+import time
+from collections import deque
+from typing import Dict, Iterable, Optional
+
+FLASH = "flash"
+PRO = "pro"
+
+
+class Route:
+    """The models to try for one answer, in order, with the time each attempt may take"""
+
+    def __init__(self, primary: str, reason: str, timeout: float, fallback_timeout: float):
+        self.primary = primary
+        self.fallback = PRO if primary == FLASH else FLASH
+        self.reason = reason
+        self.timeout = timeout
+        self.fallback_timeout = fallback_timeout
+
+    def attempts(self):
+        """(model, timeout) pairs: the chosen model within the SLO, then the other one as a rescue"""
+        return [(self.primary, self.timeout), (self.fallback, self.fallback_timeout)]
+
+
+class ModelRouter:
+    """
+    Chooses Gemini Flash or Pro for each answer.
+
+    Intents whose answers just restate fetched data (`flash_intents`, weather and traffic by
+    default) and short prompts go to Flash; long or open-ended prompts go to Pro unless Pro's
+    recent latency (90th percentile of its last `window` calls within `latency_max_age` seconds)
+    would break `slo_seconds`; old samples age out so Pro is tried again once things settle. The
+    caller gives the chosen model `slo_seconds` to respond and, on a timeout or error before any
+    text was produced, retries once on the other model. Latency is measured to the first chunk
+    for streamed answers and to the full reply otherwise.
+    """
+
+    def __init__(self, slo_seconds: float = 8.0, fallback_timeout: float = 30.0,
+                 flash_intents: Iterable[str] = ("weather", "traffic"),
+                 flash_prompt_tokens: int = 400, pro_prompt_tokens: int = 1500,
+                 window: int = 50, min_samples: int = 5, latency_max_age: float = 300.0):
+        self.slo_seconds = slo_seconds
+        self.fallback_timeout = fallback_timeout
+        self.flash_intents = set(flash_intents)
+        self.flash_prompt_tokens = flash_prompt_tokens
+        self.pro_prompt_tokens = pro_prompt_tokens
+        self.min_samples = min_samples
+        self.latency_max_age = latency_max_age
+        self._lock = threading.Lock()
+        self.latencies = {FLASH: deque(maxlen=window), PRO: deque(maxlen=window)}
+        self.usage: Dict[str, Dict[str, Dict[str, float]]] = {}
+
+    def choose(self, kind: str, prompt_tokens: int) -> Route:
+        if kind in self.flash_intents:
+            primary, reason = FLASH, "intent"
+        elif prompt_tokens <= self.flash_prompt_tokens:
+            primary, reason = FLASH, "short_prompt"
+        elif prompt_tokens >= self.pro_prompt_tokens:
+            primary, reason = PRO, "long_prompt"
+        else:
+            primary, reason = PRO, "default"
+
+        if primary == PRO:
+            recent = self.recent_latency(PRO)
+            if recent is not None and recent > self.slo_seconds:
+                primary, reason = FLASH, "pro_latency"
+        return Route(primary, reason, self.slo_seconds, self.fallback_timeout)
+
+    def recent_latency(self, model: str) -> Optional[float]:
+        """90th percentile of the model's recent latencies, or None until enough calls were seen"""
+        cutoff = time.monotonic() - self.latency_max_age
+        with self._lock:
+            samples = sorted(latency for seen_at, latency in self.latencies[model] if seen_at > cutoff)
+        if len(samples) < self.min_samples:
+            return None
+        return samples[min(int(len(samples) * 0.9), len(samples) - 1)]
+
+    def record(self, model: str, kind: str, reason: str, latency: float, ok: bool, fallback: bool = False):
+        """Count one attempt. Failed attempts add their elapsed time so a slow model is noticed"""
+        with self._lock:
+            self.latencies[model].append((time.monotonic(), latency))
+            usage = self.usage.setdefault(model, {}).setdefault(kind, {
+                "served": 0, "failed": 0, "fallbacks": 0, "latency_total": 0.0, "reasons": {}
+            })
+            usage["served" if ok else "failed"] += 1
+            if fallback and ok:
+                usage["fallbacks"] += 1
+            usage["latency_total"] += latency
+            usage["reasons"][reason] = usage["reasons"].get(reason, 0) + 1
+
+    @staticmethod
+    def elapsed(started: float) -> float:
+        return time.monotonic() - started
+
+    def stats(self) -> Dict:
+        by_model = {}
+        with self._lock:
+            for model, kinds in self.usage.items():
+                by_model[model] = {}
+                for kind, usage in kinds.items():
+                    attempts = usage["served"] + usage["failed"]
+                    by_model[model][kind] = {
+                        "served": usage["served"],
+                        "failed": usage["failed"],
+                        "fallbacks": usage["fallbacks"],
+                        "avg_latency_seconds": round(usage["latency_total"] / attempts, 3) if attempts else None,
+                        "reasons": dict(usage["reasons"]),
+                    }
+        return {
+            "slo_seconds": self.slo_seconds,
+            "recent_p90_seconds": {model: self.recent_latency(model) for model in (FLASH, PRO)},
+            "by_model": by_model,
+        }
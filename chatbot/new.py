@@ -1,45 +1,172 @@
 import json
 import os
-from datetime import datetime
+from datetime import datetime, timezone
 import firebase_admin
-from firebase_admin import credentials, firestore
-import math
+from firebase_admin import credentials, firestore, firestore_async
+import numpy as np
+from geo import encode_geohash, geohash_query_bounds, haversine_km, nearest_within_radius
+from tracing import span
 
 
 class FirebaseDataFetcher:
     """Class to fetch data from Firebase Firestore and save as JSON"""
 
-    def __init__(self, service_account_path="newcredential.json"):
+    # Only the fields the chatbot uses are sent over the wire (geohash and expiresAt
+    # are also needed to resume paged queries from the last document)
+    POST_FIELDS = [
+        'caption', 'commentCount', 'createdAt', 'expiresAt', 'geohash',
+        'imageUrl', 'likes', 'location', 'tags', 'title', 'username',
+    ]
+    PAGE_SIZE = 300
+
+    def __init__(self, service_account_path="newcredential.json", health_monitor=None):
         """Initialize the FirebaseDataFetcher with service account path"""
         self.service_account_path = service_account_path
+        # Optional connection_health.HealthMonitor refreshed in the background
+        self.health_monitor = health_monitor
 
     def calculate_distance(self, lat1, lon1, lat2, lon2):
         """
         Calculate the great circle distance between two points on the earth (specified in decimal degrees) Returns distance in kilometers"""
-        R = 6371  # Radius of the earth in km
+        return haversine_km(lat1, lon1, lat2, lon2)
+
+    def stream_nearby_docs(self, db, user_lat, user_lon, radius_km):
+        """
+        Yield live, approved post documents from the geohash cells covering the search radius.
+        
+        Status and expiry are filtered by Firestore, only POST_FIELDS are returned and each
+        cell is read in pages of PAGE_SIZE using the last document as cursor.
+        """
+        seen_ids = set()
+        now = datetime.now(timezone.utc)
+        bounds = geohash_query_bounds(user_lat, user_lon, radius_km)
+        print(f"🗺️  Scanning {len(bounds)} geohash ranges")
+        for start, end in bounds:
+            query = self.nearby_cell_query(db, start, end, now)
+            last_doc = None
+            while True:
+                page = query.start_after(last_doc) if last_doc else query
+                docs = list(page.stream())
+                for doc in docs:
+                    if doc.id not in seen_ids:
+                        seen_ids.add(doc.id)
+                        yield doc
+                if len(docs) < self.PAGE_SIZE:
+                    break
+                last_doc = docs[-1]
+
+    async def stream_nearby_docs_async(self, db, user_lat, user_lon, radius_km):
+        """Async variant of stream_nearby_docs for an AsyncClient"""
+        seen_ids = set()
+        now = datetime.now(timezone.utc)
+        bounds = geohash_query_bounds(user_lat, user_lon, radius_km)
+        print(f"🗺️  Scanning {len(bounds)} geohash ranges")
+        for start, end in bounds:
+            query = self.nearby_cell_query(db, start, end, now)
+            last_doc = None
+            while True:
+                page = query.start_after(last_doc) if last_doc else query
+                docs = [doc async for doc in page.stream()]
+                for doc in docs:
+                    if doc.id not in seen_ids:
+                        seen_ids.add(doc.id)
+                        yield doc
+                if len(docs) < self.PAGE_SIZE:
+                    break
+                last_doc = docs[-1]
+
+    def nearby_cell_query(self, db, start, end, now):
+        """Query for live, approved posts in one geohash range, shared by the sync and async clients"""
+        return (db.collection('posts')
+                .where(filter=firestore.FieldFilter('verification_status', '==', 'Approved'))
+                .where(filter=firestore.FieldFilter('geohash', '>=', start))
+                .where(filter=firestore.FieldFilter('geohash', '<', end))
+                .where(filter=firestore.FieldFilter('expiresAt', '>', now))
+                .order_by('geohash')
+                .order_by('expiresAt')
+                .select(self.POST_FIELDS)
+                .limit(self.PAGE_SIZE))
+
+    def initialize_app(self):
+        if not firebase_admin._apps:
+            cred = credentials.Certificate(self.service_account_path)
+            firebase_admin.initialize_app(cred)
+
+    def get_firestore_client(self):
+        """Initialize the Firebase Admin SDK if needed and return a Firestore client"""
+        self.initialize_app()
+        return firestore.client()
+
+    def get_async_firestore_client(self):
+        """Initialize the Firebase Admin SDK if needed and return an asyncio Firestore client"""
+        self.initialize_app()
+        return firestore_async.client()
+
+    def backfill_geohashes(self):
+        """One-off migration, run by backfill_geohashes.py: write the geohash field on posts created before it existed"""
+        db = self.get_firestore_client()
         
-        # Convert decimal degrees to radians
-        lat1_rad = math.radians(lat1)
-        lon1_rad = math.radians(lon1)
-        lat2_rad = math.radians(lat2)
-        lon2_rad = math.radians(lon2)
+        batch = db.batch()
+        batch_count = 0
+        updated = 0
+        for doc in db.collection('posts').select(['location', 'geohash']).stream():
+            data = doc.to_dict()
+            location = data.get('location')
+            if not location or data.get('geohash'):
+                continue
+            batch.update(doc.reference, {'geohash': encode_geohash(location.latitude, location.longitude)})
+            batch_count += 1
+            updated += 1
+            # Firestore batches are limited to 500 operations
+            if batch_count >= 500:
+                batch.commit()
+                batch = db.batch()
+                batch_count = 0
+        if batch_count:
+            batch.commit()
+        print(f"✅ Added geohash to {updated} posts")
+        return updated
+
+    def doc_to_post(self, doc):
+        """Convert a Firestore post document into the post dict used by the chatbot"""
+        data = doc.to_dict()
         
-        # Calculate differences
-        dlat = lat2_rad - lat1_rad
-        dlon = lon2_rad - lon1_rad
+        # Convert Firestore timestamps to strings if they exist
+        created_at = data.get('createdAt', '')
+        expires_at = data.get('expiresAt', '')
         
-        # Haversine formula
-        a = (math.sin(dlat/2) * math.sin(dlat/2) + 
-            math.cos(lat1_rad) * math.cos(lat2_rad) * 
-            math.sin(dlon/2) * math.sin(dlon/2))
+        if hasattr(created_at, 'isoformat'):
+            created_at = created_at.isoformat()
+        elif hasattr(created_at, 'strftime'):
+            created_at = created_at.strftime('%Y-%m-%d %H:%M:%S')
         
-        c = 2 * math.atan2(math.sqrt(a), math.sqrt(1-a))
-        distance = R * c  # Distance in km
+        if hasattr(expires_at, 'isoformat'):
+            expires_at = expires_at.isoformat()
+        elif hasattr(expires_at, 'strftime'):
+            expires_at = expires_at.strftime('%Y-%m-%d %H:%M:%S')
         
-        return distance
+        # Structure the data like your Firebase schema
+        location = data['location'] 
+        
+        return {
+            'id': doc.id,
+            'caption': data.get('caption', ''),
+            'commentCount': data.get('commentCount', 0),
+            'createdAt': str(created_at),
+            'expiresAt': str(expires_at),
+            'imageUrl': data.get('imageUrl', ''),
+            'likes': data.get('likes', 0),
+            'location': {
+                'latitude': location.latitude,
+                'longitude': location.longitude
+                },
+            'tags': data.get('tags', []),
+            'title': data.get('title', ''),
+            'username': data.get('username', ''),
+        }
 
-    def fetch_firebase_data(self, user_lat, user_lon, radius_km):
-        """Fetch all posts from Firebase Firestore and save as JSON"""
+    def fetch_firebase_data(self, user_lat, user_lon, radius_km, max_posts=None):
+        """Fetch posts within radius_km of the user from Firebase Firestore"""
         
         try:
             # Check if service account file exists
@@ -59,142 +186,137 @@ class FirebaseDataFetcher:
             # Get Firestore client
             db = firestore.client()
             
-            # Fetch all posts from 'posts' collection
-            print("📡 Fetching posts from Firestore...")
-            #fetching ordered by createdAt in descending order
-            posts_ref = db.collection('posts').order_by('createdAt', direction=firestore.Query.DESCENDING)
-            docs = posts_ref.stream()
+            # Fetch only posts in the geohash cells around the user
+            print("📡 Fetching nearby posts from Firestore...")
+            docs = self.stream_nearby_docs(db, user_lat, user_lon, radius_km)
+            return self.build_output(docs, user_lat, user_lon, radius_km, max_posts)
             
-            posts = []
-            count = 0
+        except Exception as e:
+            self.print_fetch_error(e)
+            return None
+
+    async def fetch_firebase_data_async(self, user_lat, user_lon, radius_km, max_posts=None):
+        """Async variant of fetch_firebase_data using the asyncio Firestore client"""
+        
+        try:
+            if not os.path.exists(self.service_account_path):
+                print(f"❌ Service account file not found: {self.service_account_path}")
+                print("💡 Please make sure the file path is correct and the file exists")
+                return None
             
-            for doc in docs:
-                
-                data = doc.to_dict()
-                
-                print(f"📄 Processing document {doc.id}...")
-                
-                # Convert Firestore timestamps to strings if they exist
-                created_at = data.get('createdAt', '')
-                expires_at = data.get('expiresAt', '')
-                
-                if hasattr(created_at, 'isoformat'):
-                    created_at = created_at.isoformat()
-                elif hasattr(created_at, 'strftime'):
-                    created_at = created_at.strftime('%Y-%m-%d %H:%M:%S')
-                
-                if hasattr(expires_at, 'isoformat'):
-                    expires_at = expires_at.isoformat()
-                elif hasattr(expires_at, 'strftime'):
-                    expires_at = expires_at.strftime('%Y-%m-%d %H:%M:%S')
-                
-                # Structure the data like your Firebase schema
-                location = data['location'] 
-                
-                post = {
-                    'id': doc.id,
-                    'caption': data.get('caption', ''),
-                    'commentCount': data.get('commentCount', 0),
-                    'createdAt': str(created_at),
-                    'creatorId': data.get('creatorId', ''),
-                    'description': data.get('description', ''),
-                    'duration': data.get('duration', 0),
-                    'expiresAt': str(expires_at),
-                    'eventTimesOnly': data.get('eventTimesOnly', False),
-                    'eventTimesSet': data.get('eventTimesSet', 0),
-                    'imageUrl': data.get('imageUrl', ''),
-                    'isAnonymous': data.get('isAnonymous', False),
-                    'likedBy': data.get('likedBy', False),
-                    'likes': data.get('likes', 0),
-                    'location': {
-                        'latitude': location.latitude,
-                        'longitude': location.longitude
-                        },
-                    'tags': data.get('tags', []),
-                    'title': data.get('title', ''),
-                    'userAvatar': data.get('userAvatar', ''),
-                    'username': data.get('username', ''),
-                    # 'isVisible': data.get('is_visible', 0)
-                    'verificationStatus': data.get('verification_status', 'Approved'),
-                }
-                #filter out posts by distance
-                distance = self.calculate_distance(user_lat, user_lon, location.latitude, location.longitude)
-                if distance <= radius_km and post['verificationStatus'] == 'Approved':
-                    posts.append(post)
-                    count +=1
-                
-                if count % 10 == 0:
-                    print(f"📄 Processed {count} posts...")
+            db = self.get_async_firestore_client()
             
+            print("📡 Fetching nearby posts from Firestore...")
+            docs = [doc async for doc in self.stream_nearby_docs_async(db, user_lat, user_lon, radius_km)]
+            return self.build_output(docs, user_lat, user_lon, radius_km, max_posts)
             
-            print(f"✅ Successfully fetched {len(posts)} posts")
+        except Exception as e:
+            self.print_fetch_error(e)
+            return None
+
+    def build_output(self, docs, user_lat, user_lon, radius_km, max_posts=None):
+        """Convert fetched documents into the export dict, keeping the closest posts within radius_km"""
+        posts = []
+        candidates = []
+        candidate_lats = []
+        candidate_lons = []
+        count = 0
+        
+        for doc in docs:
             
-            if len(posts) == 0:
-                print("⚠️  No posts found in the collection. Check your collection name and permissions.")
-                return {
-                    'metadata': {
-                    'totalPosts': len(posts),
-                    'exportedAt': datetime.now().isoformat(),
-                    'source': 'Firebase Firestore'
-                },
-                    'posts' : 'no matched post'
-                }
+            print(f"📄 Processing document {doc.id}...")
+            post = self.doc_to_post(doc)
+            location = post['location']
             
-            # Create output data
-            output_data = {
+            # Approval and expiry are already filtered by the query,
+            # distance filtering happens for all candidates at once below
+            candidates.append(post)
+            candidate_lats.append(location['latitude'])
+            candidate_lons.append(location['longitude'])
+            count +=1
+            
+            if count % 10 == 0:
+                print(f"📄 Processed {count} posts...")
+        
+        #filter out posts by distance, closest first
+        order, distances = nearest_within_radius(
+            user_lat, user_lon,
+            np.asarray(candidate_lats, dtype=np.float64),
+            np.asarray(candidate_lons, dtype=np.float64),
+            radius_km, top_n=max_posts
+        )
+        for index, distance in zip(order.tolist(), distances.tolist()):
+            post = candidates[index]
+            post['distanceKm'] = round(distance, 3)
+            posts.append(post)
+        
+        print(f"✅ Successfully fetched {len(posts)} posts")
+        
+        if len(posts) == 0:
+            print("⚠️  No posts found in the collection. Check your collection name and permissions.")
+            return {
                 'metadata': {
-                    'totalPosts': len(posts),
-                    'exportedAt': datetime.now().isoformat(),
-                    'source': 'Firebase Firestore'
-                },
-                'posts': posts
+                'totalPosts': len(posts),
+                'exportedAt': datetime.now().isoformat(),
+                'source': 'Firebase Firestore'
+            },
+                'posts' : 'no matched post'
             }
+        
+        # Create output data
+        output_data = {
+            'metadata': {
+                'totalPosts': len(posts),
+                'exportedAt': datetime.now().isoformat(),
+                'source': 'Firebase Firestore'
+            },
+            'posts': posts
+        }
+        
+        # Save to JSON file in current directory
+        timestamp = datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
+        filename = f'firebase_posts_{timestamp}.json'
+        
+        # print(f"💾 Saving to file: {filename}")
+        #for converting to json
+        # ###############################################################################################3
+        # try:
+        #     with open(filename, 'w', encoding='utf-8') as f:
+        #         json.dump(output_data, f, indent=2, ensure_ascii=False, default=str)
             
-            # Save to JSON file in current directory
-            timestamp = datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
-            filename = f'firebase_posts_{timestamp}.json'
-            
-            # print(f"💾 Saving to file: {filename}")
-            #for converting to json
-            # ###############################################################################################3
-            # try:
-            #     with open(filename, 'w', encoding='utf-8') as f:
-            #         json.dump(output_data, f, indent=2, ensure_ascii=False, default=str)
+        #     # Verify file was created
+        #     if os.path.exists(filename):
+        #         file_size = os.path.getsize(filename)
+        #         print(f"✅ File created successfully: {filename} ({file_size} bytes)")
+        #     else:
+        #         print(f"❌ File was not created: {filename}")
+        #         return None
                 
-            #     # Verify file was created
-            #     if os.path.exists(filename):
-            #         file_size = os.path.getsize(filename)
-            #         print(f"✅ File created successfully: {filename} ({file_size} bytes)")
-            #     else:
-            #         print(f"❌ File was not created: {filename}")
-            #         return None
-                    
-            # except Exception as file_error:
-            #     print(f"❌ Error writing file: {file_error}")
-            #     return None
-            #############################################################################################3
-            
-            # Print results
-            print(f"\n🎉 Export completed!")
-            # print(f"📁 File: {os.path.abspath(filename)}")
-            print(f"📊 Total Posts: {len(posts)}")
-            print(f"🖼️  Posts with Images: {len([p for p in posts if p['imageUrl']])}")
-            print(f"❤️  Total Likes: {sum(p['likes'] for p in posts)}")
-            print(f"💬 Total Comments: {sum(p['commentCount'] for p in posts)}")
-            
-            return output_data  # Return the data instead of file path for testing
-            # return filename  # Uncomment this line if you want to return the filename
-            
-        except Exception as e:
-            print(f"❌ Error: {e}")
-            print(f"❌ Error type: {type(e).__name__}")
-            print("\n💡 Troubleshooting checklist:")
-            print("1. ✓ Check if service account key file exists and path is correct")
-            print("2. ✓ Verify the service account has Firestore read permissions")
-            print("3. ✓ Make sure your collection is named 'posts'")
-            print("4. ✓ Check your internet connection")
-            print("5. ✓ Verify Firebase project ID is correct in service account key")
-            return None
+        # except Exception as file_error:
+        #     print(f"❌ Error writing file: {file_error}")
+        #     return None
+        #############################################################################################3
+        
+        # Print results
+        print(f"\n🎉 Export completed!")
+        # print(f"📁 File: {os.path.abspath(filename)}")
+        print(f"📊 Total Posts: {len(posts)}")
+        print(f"🖼️  Posts with Images: {len([p for p in posts if p['imageUrl']])}")
+        print(f"❤️  Total Likes: {sum(p['likes'] for p in posts)}")
+        print(f"💬 Total Comments: {sum(p['commentCount'] for p in posts)}")
+        
+        return output_data  # Return the data instead of file path for testing
+        # return filename  # Uncomment this line if you want to return the filename
+
+    def print_fetch_error(self, e):
+        print(f"❌ Error: {e}")
+        print(f"❌ Error type: {type(e).__name__}")
+        print("\n💡 Troubleshooting checklist:")
+        print("1. ✓ Check if service account key file exists and path is correct")
+        print("2. ✓ Verify the service account has Firestore read permissions")
+        print("3. ✓ Make sure your collection is named 'posts'")
+        print("4. ✓ Check your internet connection")
+        print("5. ✓ Verify Firebase project ID is correct in service account key")
 
     def test_firebase_connection(self):
         """Test Firebase connection and list collections"""
@@ -244,32 +366,82 @@ class FirebaseDataFetcher:
             print(f"❌ Connection test failed: {e}")
             return False
 
-    def fetch_posts(self, curr_lat, curr_long):
-        """Main method to fetch Firebase data with connection testing"""
+    def fetch_posts(self, curr_lat, curr_long, radius_km=50, max_posts=None):
+        """Main method to fetch Firebase data, failing fast if the cached connection health is bad"""
         print("🚀 Firebase Data Fetcher - Python")
         print("⏰ Started at:", datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
-        print("📂 Current directory:", os.getcwd())
         print("-" * 50)
         
-        # First test the connection
-        print("🔍 Testing Firebase connection...")
-        if self.test_firebase_connection():
-            print("✅ Connection test passed! Proceeding with data fetch...")
-            print("-" * 50)
-            
-            result = self.fetch_firebase_data(curr_lat, curr_long, 50)
-            
-            if result:
-                # print(f"\n✨ Success! Check your JSON file: {result}")
-                # print(f"📍 Full path: {os.path.abspath(result)}")
-                # print(result['posts'][:5])  # Print first 5 posts for verification
-                return result
-            else:
-                print("\n💥 Export failed. Please check the error messages above.")
-                return None
+        # The connection is tested in the background, only the cached result is checked here
+        if self.health_monitor is not None and self.health_monitor.is_unhealthy():
+            print(f"❌ Firestore marked unhealthy ({self.health_monitor.last_error}), skipping fetch")
+            return None
+        
+        with span("firestore"):
+            result = self.fetch_firebase_data(curr_lat, curr_long, radius_km, max_posts)
+        
+        if result:
+            # print(f"\n✨ Success! Check your JSON file: {result}")
+            # print(f"📍 Full path: {os.path.abspath(result)}")
+            # print(result['posts'][:5])  # Print first 5 posts for verification
+            return result
         else:
-            print("❌ Connection test failed. Please fix the issues above before proceeding.")
+            print("\n💥 Export failed. Please check the error messages above.")
+            return None
+
+    async def fetch_posts_async(self, curr_lat, curr_long, radius_km=50, max_posts=None):
+        """Async variant of fetch_posts that awaits Firestore instead of blocking the event loop"""
+        if self.health_monitor is not None and self.health_monitor.is_unhealthy():
+            print(f"❌ Firestore marked unhealthy ({self.health_monitor.last_error}), skipping fetch")
+            return None
+        
+        with span("firestore"):
+            result = await self.fetch_firebase_data_async(curr_lat, curr_long, radius_km, max_posts)
+        if not result:
+            print("\n💥 Export failed. Please check the error messages above.")
             return None
+        return result
+
+
+class FirestorePostListener:
+    """Streams changes to live, approved posts from a Firestore snapshot listener"""
+
+    def __init__(self, data_fetcher=None):
+        self.data_fetcher = data_fetcher or FirebaseDataFetcher()
+        self._watch = None
+
+    def start(self, callback):
+        """Subscribe to the posts collection and forward each change batch to callback"""
+        db = self.data_fetcher.get_firestore_client()
+        # Posts that expire later stay in the result set; LivePostCache drops them on read
+        query = (db.collection('posts')
+                 .where(filter=firestore.FieldFilter('verification_status', '==', 'Approved'))
+                 .where(filter=firestore.FieldFilter('expiresAt', '>', datetime.now(timezone.utc))))
+
+        def on_snapshot(col_snapshot, changes, read_time):
+            batch = []
+            for change in changes:
+                doc = change.document
+                if change.type.name == 'REMOVED':
+                    batch.append({'type': 'REMOVED', 'id': doc.id, 'post': None})
+                else:
+                    try:
+                        batch.append({'type': change.type.name, 'id': doc.id, 'post': self.data_fetcher.doc_to_post(doc)})
+                    except Exception as e:
+                        print(f"❌ Skipping malformed post {doc.id}: {e}")
+            try:
+                callback(batch)
+            except Exception as e:
+                print(f"❌ Error applying post changes: {e}")
+
+        print("👂 Starting Firestore listener on posts...")
+        self._watch = query.on_snapshot(on_snapshot)
+
+    def stop(self):
+        if self._watch is not None:
+            self._watch.unsubscribe()
+            self._watch = None
+
 # if __name__ == "__main__":
 #     fetcher = FirebaseDataFetcher()
 #     fetcher.fetch_posts()
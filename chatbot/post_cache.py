@@ -0,0 +1,161 @@
+import json
+import threading
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+import numpy as np
+from geo import nearest_within_radius
+
+
+def parse_expiry(expires_at: str) -> Optional[datetime]:
+    """Parse an ISO formatted expiresAt string, treating naive values as UTC"""
+    if not expires_at:
+        return None
+    try:
+        expiry = datetime.fromisoformat(str(expires_at))
+    except ValueError:
+        return None
+    if expiry.tzinfo is None:
+        expiry = expiry.replace(tzinfo=timezone.utc)
+    return expiry
+
+
+class LivePostCache:
+    """
+    In-memory replica of the live, approved, unexpired posts.
+
+    A listener (FirestorePostListener in production, LocalPostListener for local runs) delivers
+    batches of changes shaped like {'type': 'ADDED' | 'MODIFIED' | 'REMOVED', 'id': ..., 'post': ...}.
+    Each batch is applied to the replica and forwarded to the embedding index, so chat requests
+    read nearby posts from memory and never wait on Firestore or the embedding model.
+    """
+
+    def __init__(self, index=None, index_path: Optional[str] = None):
+        self.posts: Dict[str, Dict] = {}
+        self.expiry: Dict[str, Optional[datetime]] = {}
+        self.index = index
+        self.index_path = index_path
+        # Set once the listener's initial snapshot has been applied
+        self.ready = threading.Event()
+        self.listener = None
+        self._lock = threading.Lock()
+        # (ids, lats, lons) rebuilt lazily after the replica changes
+        self._arrays = None
+
+    def start(self, listener):
+        """Attach a listener and start receiving changes"""
+        self.listener = listener
+        listener.start(self.apply_changes)
+
+    def stop(self):
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+
+    def apply_changes(self, changes: List[Dict]):
+        """Apply one batch of listener changes to the replica and the embedding index"""
+        upserts = []
+        removed_ids = []
+        with self._lock:
+            for change in changes:
+                post_id = change['id']
+                if change['type'] == 'REMOVED':
+                    self.posts.pop(post_id, None)
+                    self.expiry.pop(post_id, None)
+                    removed_ids.append(post_id)
+                else:
+                    post = change['post']
+                    self.posts[post_id] = post
+                    self.expiry[post_id] = parse_expiry(post.get('expiresAt'))
+                    upserts.append(post)
+            self._arrays = None
+
+        if self.index is not None:
+            removed = self.index.remove_posts(removed_ids) if removed_ids else 0
+            stats = self.index.sync_posts(upserts) if upserts else {'embedded': 0, 'removed': 0}
+            if self.index_path and (removed or stats['embedded'] or stats['removed']):
+                self.index.save_vectorstore(self.index_path)
+
+        print(f"Live post cache: {len(upserts)} upserts, {len(removed_ids)} removals, {len(self.posts)} posts")
+        self.ready.set()
+
+    def nearby(self, user_lat: float, user_lon: float, radius_km: float, max_posts: Optional[int] = None) -> List[Dict]:
+        """Unexpired posts within radius_km of the user, closest first, in the fetcher's post format"""
+        now = datetime.now(timezone.utc)
+        with self._lock:
+            if self._arrays is None:
+                ids = list(self.posts)
+                lats = np.fromiter((self.posts[i]['location']['latitude'] for i in ids), dtype=np.float64, count=len(ids))
+                lons = np.fromiter((self.posts[i]['location']['longitude'] for i in ids), dtype=np.float64, count=len(ids))
+                self._arrays = (ids, lats, lons)
+            ids, lats, lons = self._arrays
+            posts = self.posts
+            expiry = self.expiry
+
+            order, distances = nearest_within_radius(user_lat, user_lon, lats, lons, radius_km)
+            nearby_posts = []
+            expired_ids = []
+            for index, distance in zip(order.tolist(), distances.tolist()):
+                post_id = ids[index]
+                expires = expiry.get(post_id)
+                if expires is not None and expires <= now:
+                    expired_ids.append(post_id)
+                    continue
+                post = dict(posts[post_id])
+                post['distanceKm'] = round(distance, 3)
+                nearby_posts.append(post)
+                if max_posts is not None and len(nearby_posts) >= max_posts:
+                    break
+
+            # Expired posts never produce a listener event, so drop them as they are seen
+            for post_id in expired_ids:
+                posts.pop(post_id, None)
+                expiry.pop(post_id, None)
+            if expired_ids:
+                self._arrays = None
+
+        return nearby_posts
+
+    def __len__(self):
+        return len(self.posts)
+
+
+class LocalPostListener:
+    """
+    Stand-in for FirestorePostListener that needs no cloud access.
+
+    Changes pushed with add/modify/remove are delivered to the cache the same way Firestore
+    snapshots are, which makes the live cache usable in local runs and scripts.
+    """
+
+    def __init__(self, posts: Optional[List[Dict]] = None):
+        self.initial_posts = list(posts or [])
+        self._callback = None
+
+    @classmethod
+    def from_json(cls, json_file_path: str) -> "LocalPostListener":
+        """Seed the listener from a {'posts': [...]} export like the fetcher's JSON output"""
+        with open(json_file_path, 'r', encoding='utf-8') as file:
+            data = json.load(file)
+        return cls(data['posts'])
+
+    def start(self, callback):
+        self._callback = callback
+        # Like Firestore, the first snapshot reports every matching post as added
+        callback([{'type': 'ADDED', 'id': post['id'], 'post': post} for post in self.initial_posts])
+
+    def stop(self):
+        self._callback = None
+
+    def add(self, post: Dict):
+        self._emit({'type': 'ADDED', 'id': post['id'], 'post': post})
+
+    def modify(self, post: Dict):
+        self._emit({'type': 'MODIFIED', 'id': post['id'], 'post': post})
+
+    def remove(self, post_id: str):
+        self._emit({'type': 'REMOVED', 'id': post_id, 'post': None})
+
+    def _emit(self, change: Dict):
+        if self._callback is None:
+            raise RuntimeError("Listener is not started")
+        self._callback([change])
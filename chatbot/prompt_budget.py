@@ -0,0 +1,134 @@
+import threading
+from typing import Dict, Iterable, List, Optional, Tuple
+from turn_buffer import gemini_turn
+
+# Per call type limits, in estimated tokens, for the conversation history and the retrieved posts
+DEFAULT_BUDGETS = {
+    "intent": {"history": 300, "posts": 0},
+    "chat": {"history": 1500, "posts": 800},
+    "map": {"history": 600, "posts": 500},
+    "weather": {"history": 400, "posts": 400},
+    "traffic": {"history": 400, "posts": 500},
+}
+# A partially fitting turn or post is only kept if at least this much of it fits
+MIN_FRAGMENT_TOKENS = 24
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count for Gemini models, about four characters per token"""
+    return len(text) // 4 + 1 if text else 0
+
+
+def truncate_to_tokens(text: str, tokens: int) -> str:
+    return text[:max(tokens - 1, 0) * 4].rstrip() + "…"
+
+
+class PromptAssembler:
+    """
+    Fits conversation history and retrieved posts into a token budget per call type.
+
+    History is handed to Gemini once (as chat history, or inlined for single-shot calls), newest
+    turns first until the budget is used, with the oldest fitting turn shortened rather than
+    dropped. The current question is removed from the end of the history since the prompt
+    carries it. Retrieved posts are kept in rank order within their own budget. Every call counts
+    the tokens the old assembly would have sent against what was actually sent. History comes in
+    as (role, text) pairs, such as a TurnBuffer, and goes out in the Gemini chat format.
+    """
+
+    def __init__(self, budgets: Optional[Dict[str, Dict[str, int]]] = None):
+        self.budgets = {kind: dict(limits) for kind, limits in DEFAULT_BUDGETS.items()}
+        for kind, limits in (budgets or {}).items():
+            self.budgets.setdefault(kind, {"history": 0, "posts": 0}).update(limits)
+        self._lock = threading.Lock()
+        self.usage: Dict[str, Dict[str, int]] = {}
+
+    def fit(self, kind: str, user_query: str, history: Iterable[Tuple[str, str]], local_info: str = "",
+            baseline_history_copies: int = 1) -> Tuple[List[Dict], str]:
+        """
+        Budgeted (history, local_info) for one call. baseline_history_copies is how many times
+        the previous assembly sent the full history, for the savings counters.
+        """
+        limits = self.budgets.get(kind, self.budgets["chat"])
+        turns = list(history)
+        fitted_history = self.fit_history(turns, user_query, limits["history"])
+        fitted_info = self.fit_posts(local_info, limits["posts"])
+
+        history_tokens = sum(estimate_tokens(text) for _, text in turns)
+        baseline = history_tokens * baseline_history_copies + estimate_tokens(local_info)
+        sent = self.history_tokens(fitted_history) + estimate_tokens(fitted_info)
+        self.record(kind, baseline, sent)
+        return fitted_history, fitted_info
+
+    def fit_history(self, history: Iterable[Tuple[str, str]], user_query: str, budget: int) -> List[Dict]:
+        turns = list(history)
+        if turns and turns[-1][0] == "user" and turns[-1][1].strip() == user_query.strip():
+            turns.pop()
+
+        fitted = []
+        remaining = budget
+        for role, text in reversed(turns):
+            tokens = estimate_tokens(text)
+            if tokens <= remaining:
+                fitted.append(gemini_turn(role, text))
+                remaining -= tokens
+                continue
+            if remaining >= MIN_FRAGMENT_TOKENS:
+                fitted.append(gemini_turn(role, truncate_to_tokens(text, remaining)))
+            break
+        fitted.reverse()
+
+        # Gemini chat history has to open with a user turn
+        while fitted and fitted[0]["role"] != "user":
+            fitted.pop(0)
+        return fitted
+
+    def fit_posts(self, local_info: str, budget: int) -> str:
+        """Keep the highest ranked posts (one per line) that fit the budget"""
+        if not local_info or budget <= 0:
+            return ""
+        if estimate_tokens(local_info) <= budget:
+            return local_info
+
+        kept = []
+        remaining = budget
+        for line in local_info.splitlines():
+            tokens = estimate_tokens(line)
+            if tokens <= remaining:
+                kept.append(line)
+                remaining -= tokens
+            elif remaining >= MIN_FRAGMENT_TOKENS:
+                kept.append(truncate_to_tokens(line, remaining))
+                break
+            else:
+                break
+        return "\n".join(kept) + "\n" if kept else ""
+
+    def history_text(self, history: List[Dict]) -> str:
+        """Fitted history serialized for prompts that are not sent as a chat"""
+        return "\n".join(f"{turn['role']}: {self.turn_text(turn)}" for turn in history)
+
+    @staticmethod
+    def turn_text(turn: Dict) -> str:
+        return turn["parts"][0]["text"]
+
+    def history_tokens(self, history: List[Dict]) -> int:
+        return sum(estimate_tokens(self.turn_text(turn)) for turn in history)
+
+    def record(self, kind: str, baseline: int, sent: int):
+        with self._lock:
+            usage = self.usage.setdefault(kind, {"calls": 0, "baseline_tokens": 0, "sent_tokens": 0})
+            usage["calls"] += 1
+            usage["baseline_tokens"] += baseline
+            usage["sent_tokens"] += sent
+
+    def stats(self) -> Dict:
+        with self._lock:
+            by_kind = {
+                kind: {**usage, "saved_tokens": usage["baseline_tokens"] - usage["sent_tokens"]}
+                for kind, usage in self.usage.items()
+            }
+        return {
+            "budgets": self.budgets,
+            "saved_tokens": sum(usage["saved_tokens"] for usage in by_kind.values()),
+            "by_kind": by_kind,
+        }
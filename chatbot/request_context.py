@@ -0,0 +1,32 @@
+from turn_buffer import TurnBuffer
+
+
+class RequestContext:
+    """
+    Everything one conversation turn reads and writes: the user's location, their history,
+    the retrieved local posts and the model that answered.
+
+    Each ChatbotLocal session owns exactly one, so turns running in parallel threads or tasks
+    never see each other's state. Shared components (models, caches, ContextFetch) stay on the
+    ChatbotLocal instance that the sessions are copied from.
+    """
+
+    def __init__(self):
+        self.curr_lat = None
+        self.curr_long = None
+        self.conversation_history = TurnBuffer()
+        self.local_information_string = ""
+        self.local_posts = []  # Posts behind local_information_string, reported to streaming clients
+        self.served_model = None  # Model that produced the last answer of this session
+
+
+def request_attribute(name):
+    """ChatbotLocal attribute stored on the session's RequestContext instead of the shared instance"""
+
+    def get(chatbot):
+        return getattr(chatbot.request, name)
+
+    def set(chatbot, value):
+        setattr(chatbot.request, name, value)
+
+    return property(get, set)
@@ -0,0 +1,72 @@
+import time
+from typing import Dict, Iterable, List, Tuple
+
+# One Prometheus metric family: (name, type, help, samples). A sample is (labels, value), or
+# (suffix, labels, value) for the _bucket, _sum and _count series of a histogram.
+MetricFamily = Tuple[str, str, str, List[tuple]]
+
+
+class RequestMetrics:
+    """
+    Request, error and in-flight counts per endpoint, updated as each request finishes.
+
+    Every update and read happens on the event loop (the HTTP middleware, the streaming
+    generators and the /health, /stats and /metrics handlers), so the counters are plain ints
+    with no lock for health probes to wait on, and reading them is O(1) however busy the
+    service is. Endpoints are route templates, never raw URLs, so the label set stays small.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.requests: Dict[str, int] = {}
+        self.errors: Dict[str, int] = {}
+        self.in_flight = 0
+
+    def request(self, endpoint: str):
+        self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+
+    def error(self, endpoint: str):
+        """Count a failed request, including streams that failed after answering 200"""
+        self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+
+    def stats(self) -> Dict:
+        return {
+            "uptime_seconds": round(time.time() - self.started, 1),
+            "requests": sum(self.requests.values()),
+            "errors": sum(self.errors.values()),
+            "in_flight": self.in_flight,
+            "by_endpoint": {
+                endpoint: {"requests": count, "errors": self.errors.get(endpoint, 0)}
+                for endpoint, count in self.requests.items()
+            },
+        }
+
+    def families(self) -> List[MetricFamily]:
+        return [
+            ("chatbot_requests_total", "counter", "Requests served, by endpoint",
+             [({"endpoint": endpoint}, count) for endpoint, count in self.requests.items()]),
+            ("chatbot_request_errors_total", "counter", "Requests that failed, by endpoint",
+             [({"endpoint": endpoint}, count) for endpoint, count in self.errors.items()]),
+            ("chatbot_requests_in_flight", "gauge", "Requests currently being handled",
+             [({}, self.in_flight)]),
+            ("chatbot_uptime_seconds", "gauge", "Seconds since this worker started",
+             [({}, time.time() - self.started)]),
+        ]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def prometheus_text(families: Iterable[MetricFamily]) -> str:
+    """Render metric families in the Prometheus text exposition format (version 0.0.4)"""
+    lines = []
+    for name, kind, help_text, samples in families:
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for sample in samples:
+            suffix, labels, value = sample if len(sample) == 3 else ("",) + tuple(sample)
+            label_text = ",".join(f'{key}="{_escape(str(label))}"' for key, label in labels.items())
+            series = f"{name}{suffix}{{{label_text}}}" if label_text else f"{name}{suffix}"
+            lines.append(f"{series} {value}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,185 @@
+import asyncio
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+import shared_sqlite
+from shared_sqlite import transaction
+
+
+class ResponseCache:
+    """
+    Two-tier TTL cache for raw upstream payloads (OpenWeather, Places Text Search).
+
+    The first tier is an in-process LRU dict bounded to `max_entries`; the optional second tier
+    is a SQLite table shared by the workers on the host, so a neighbour's lookup made by another
+    worker is still a hit. Entries carry their own TTL. Keys are built from the intent, the place
+    type and either a geohash cell or a normalized location name. The shared table is trimmed
+    (expired rows, then rows beyond `max_shared_entries`) every `trim_every` writes rather than
+    on each one, so it may briefly hold up to that many extra rows.
+
+    The tiers have separate locks, so a memory lookup never waits behind a shared write that is
+    itself waiting for another worker. Async callers use get_async(), which answers memory hits
+    on the event loop and reads the shared tier in a worker thread.
+    """
+
+    def __init__(self, max_entries: int = 1024, path: Optional[str] = None, max_shared_entries: int = 50000,
+                 trim_every: int = 100):
+        self.max_entries = max_entries
+        self.max_shared_entries = max_shared_entries
+        self.trim_every = trim_every
+        self._writes_since_trim = 0
+        self._lock = threading.Lock()
+        self._shared_lock = threading.Lock()
+        # key -> (expires_at, value), oldest use first
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+        self.conn = None
+        if path:
+            self.conn = shared_sqlite.connect(path)
+            # Totals seeded from a database written before the triggers existed must not miss a concurrent write
+            with transaction(self.conn):
+                self.conn.execute(
+                    "CREATE TABLE IF NOT EXISTS responses ("
+                    " key TEXT PRIMARY KEY,"
+                    " payload TEXT NOT NULL,"
+                    " expires_at REAL NOT NULL)"
+                )
+                self.conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_expires_at ON responses (expires_at)")
+                self.conn.execute(
+                    "CREATE TABLE IF NOT EXISTS response_totals ("
+                    " id INTEGER PRIMARY KEY CHECK (id = 0),"
+                    " entries INTEGER NOT NULL)"
+                )
+                self.conn.execute(
+                    "INSERT OR IGNORE INTO response_totals (id, entries) SELECT 0, COUNT(*) FROM responses"
+                )
+                self.conn.execute(
+                    "CREATE TRIGGER IF NOT EXISTS responses_totals_insert AFTER INSERT ON responses BEGIN"
+                    " UPDATE response_totals SET entries = entries + 1 WHERE id = 0; END"
+                )
+                self.conn.execute(
+                    "CREATE TRIGGER IF NOT EXISTS responses_totals_delete AFTER DELETE ON responses BEGIN"
+                    " UPDATE response_totals SET entries = entries - 1 WHERE id = 0; END"
+                )
+            # Used only by stats(), so /stats never waits on the shared tier's lock
+            self.stats_conn = shared_sqlite.connect_read_only(path)
+
+    @staticmethod
+    def make_key(intent: str, place_type: Optional[str], area: str) -> str:
+        """Cache key for one upstream lookup; `area` is a geohash cell or a normalized location"""
+        return f"{intent}:{place_type or ''}:{area}"
+
+    def get(self, key: str) -> Optional[Any]:
+        found, value = self._get_local(key)
+        if found:
+            return value
+        return self._get_shared(key)
+
+    async def get_async(self, key: str) -> Optional[Any]:
+        found, value = self._get_local(key)
+        if found:
+            return value
+        if self.conn is None:
+            return self._get_shared(key)
+        return await asyncio.to_thread(self._get_shared, key)
+
+    def _get_local(self, key: str):
+        """(True, value) for a live entry in this process, (False, None) otherwise"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return False, None
+            if entry[0] > time.time():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return True, entry[1]
+            del self._entries[key]
+            self.expirations += 1
+            return False, None
+
+    def _get_shared(self, key: str) -> Optional[Any]:
+        row = None
+        if self.conn is not None:
+            with self._shared_lock:
+                row = self.conn.execute(
+                    "SELECT payload, expires_at FROM responses WHERE key = ? AND expires_at > ?", (key, time.time())
+                ).fetchone()
+        with self._lock:
+            if row is None:
+                self.misses += 1
+                return None
+            value = json.loads(row[0])
+            self._remember(key, value, row[1])
+            self.shared_hits += 1
+            return value
+
+    def put(self, key: str, value: Any, ttl_seconds: float):
+        """Store in both tiers; async callers run this in a worker thread when there is a shared tier"""
+        expires_at = time.time() + ttl_seconds
+        with self._lock:
+            self._remember(key, value, expires_at)
+        if self.conn is None:
+            return
+        payload = json.dumps(value)
+        with self._shared_lock:
+            # An upsert rather than INSERT OR REPLACE, whose implicit delete would skip the totals trigger
+            self.conn.execute(
+                "INSERT INTO responses (key, payload, expires_at) VALUES (?, ?, ?)"
+                " ON CONFLICT (key) DO UPDATE SET payload = excluded.payload, expires_at = excluded.expires_at",
+                (key, payload, expires_at)
+            )
+            self._writes_since_trim += 1
+            if self._writes_since_trim >= self.trim_every:
+                self._writes_since_trim = 0
+                self._trim_shared()
+
+    def _remember(self, key, value, expires_at):
+        self._entries[key] = (expires_at, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def _trim_shared(self):
+        """Drop expired rows, then the soonest to expire if the table is over its size limit"""
+        expired = self.conn.execute("DELETE FROM responses WHERE expires_at <= ?", (time.time(),)).rowcount
+        count = self.conn.execute("SELECT entries FROM response_totals WHERE id = 0").fetchone()[0]
+        evicted = 0
+        if count > self.max_shared_entries:
+            evicted = self.conn.execute(
+                "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY expires_at LIMIT ?)",
+                (count - self.max_shared_entries,)
+            ).rowcount
+        with self._lock:
+            self.expirations += expired
+            self.evictions += evicted
+
+    def stats(self) -> Dict[str, int]:
+        """Entry counts and hit/miss/eviction counters for this process"""
+        shared_entries = None
+        if self.conn is not None:
+            shared_entries = self.stats_conn.execute("SELECT entries FROM response_totals WHERE id = 0").fetchone()[0]
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'shared_entries': shared_entries,
+                'hits': self.hits,
+                'shared_hits': self.shared_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+            }
+
+    def close(self):
+        if self.conn is not None:
+            with self._shared_lock:
+                self.conn.close()
+            self.stats_conn.close()
@@ -1,5 +1,6 @@
 import json
 import os
+import asyncio
 from typing import List, Dict, Any
 import vertexai
 from vertexai.language_models import TextEmbeddingModel, TextEmbeddingInput
@@ -14,7 +15,7 @@ from dotenv import load_dotenv
 class ContextFetch:
     """Class-based context fetching system for post embeddings and search"""
     
-    def __init__(self):
+    def __init__(self, post_cache=None):
         """Initialize the ContextFetch system with configuration"""
         load_dotenv()
         # Configuration
@@ -27,38 +28,107 @@ class ContextFetch:
         os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = 'localgram-461614-74f492642d25.json'
         vertexai.init(project=self.PROJECT_ID, location=self.REGION)
         
+        # Nearby posts are fetched within this radius of the user
+        self.SEARCH_RADIUS_KM = 50
+        # Only the closest posts are considered for retrieval
+        self.MAX_NEARBY_POSTS = 500
+        self.VECTORSTORE_PATH = "post_vectorstore"
+        
         # Initialize components
         self.data_fetcher = FirebaseDataFetcher()
-        self.system = PostEmbeddingSystem()
+        self.post_cache = post_cache
+        if post_cache is not None:
+            # The live cache keeps its own index in sync with Firestore changes
+            self.system = post_cache.index
+        else:
+            self.system = PostEmbeddingSystem()
+            # Reuse the persisted index so only new or edited posts get embedded
+            self.system.load_vectorstore(self.VECTORSTORE_PATH)
     
     def load_json_data(self, file_path: str) -> Dict:
         """Load JSON data from file"""
         with open(file_path, 'r', encoding='utf-8') as file:
             return json.load(file)
     
-    def main_with_your_data(self, my_question: str, curr_lat, curr_long):
-        """Main function to run with your actual JSON data"""
+    def fetch_and_sync(self, curr_lat, curr_long):
+        """Fetch nearby posts from Firestore and bring the vector index up to date with them"""
         
         # Load data from firebase
-        data = self.data_fetcher.fetch_posts(curr_lat, curr_long)
+        data = self.data_fetcher.fetch_posts(curr_lat, curr_long, self.SEARCH_RADIUS_KM, self.MAX_NEARBY_POSTS)
+        return self.sync_fetched(data, curr_lat, curr_long)
+    
+    async def fetch_and_sync_async(self, curr_lat, curr_long):
+        """Async variant of fetch_and_sync: Firestore is awaited, embedding and indexing run in a worker thread"""
+        data = await self.data_fetcher.fetch_posts_async(curr_lat, curr_long, self.SEARCH_RADIUS_KM, self.MAX_NEARBY_POSTS)
+        return await asyncio.to_thread(self.sync_fetched, data, curr_lat, curr_long)
+    
+    def sync_fetched(self, data, curr_lat, curr_long):
+        """Bring the vector index up to date with a fetch_posts result and return its posts"""
+        if data is None:
+            # Firestore is unavailable: answer without local posts and leave the index untouched
+            print("Could not load posts from Firebase")
+            return []
         
         # Load your JSON data
         # json_data = data  # Your JSON file
         posts = data['posts']
         if posts == 'no matched post':
-            return "answer based on the user given query only"
+            posts = []
 
         print(f"Loaded {len(posts)} posts from Firebase")
 
-        # Initialize the system
-        self.system.load_posts_from_data(posts)
+        # The fetch returns every live post around the user, so indexed posts in that
+        # radius which did not come back have been deleted, rejected or have expired.
+        # Posts come back closest first, so a capped result only covers up to the last one.
+        scope_radius_km = self.SEARCH_RADIUS_KM
+        if len(posts) >= self.MAX_NEARBY_POSTS:
+            scope_radius_km = posts[-1]['distanceKm']
+        
+        def in_scope(entry):
+            if entry.get('latitude') is None or entry.get('longitude') is None:
+                return False
+            distance = self.data_fetcher.calculate_distance(curr_lat, curr_long, entry['latitude'], entry['longitude'])
+            return distance < scope_radius_km
         
-        # Create vector store
-        print("Creating embeddings and vector store...")
-        self.system.create_vectorstore()
+        # Update the vector store, embedding only new or edited posts
+        print("Syncing embeddings and vector store...")
+        stats = self.system.sync_posts(posts, in_scope=in_scope)
         
         # Save for future use
-        self.system.save_vectorstore("post_vectorstore")
+        if stats['embedded'] or stats['removed']:
+            self.system.save_vectorstore(self.VECTORSTORE_PATH)
+        
+        return posts
+    
+    def main_with_your_data(self, my_question: str, curr_lat, curr_long):
+        """Main function to run with your actual JSON data"""
+        
+        if self.post_cache is not None and self.post_cache.ready.is_set():
+            # Served from memory, the listener has already embedded these posts
+            posts = self.post_cache.nearby(curr_lat, curr_long, self.SEARCH_RADIUS_KM, self.MAX_NEARBY_POSTS)
+            print(f"Loaded {len(posts)} posts from the live post cache")
+        else:
+            posts = self.fetch_and_sync(curr_lat, curr_long)
+        
+        return self.search_posts(my_question, posts)
+    
+    async def main_with_your_data_async(self, my_question: str, curr_lat, curr_long):
+        """Async variant of main_with_your_data for use from the event loop"""
+        
+        if self.post_cache is not None and self.post_cache.ready.is_set():
+            posts = self.post_cache.nearby(curr_lat, curr_long, self.SEARCH_RADIUS_KM, self.MAX_NEARBY_POSTS)
+            print(f"Loaded {len(posts)} posts from the live post cache")
+        else:
+            posts = await self.fetch_and_sync_async(curr_lat, curr_long)
+        
+        # Embedding the question and the FAISS search are blocking, keep them off the event loop
+        return await asyncio.to_thread(self.search_posts, my_question, posts)
+    
+    def search_posts(self, my_question: str, posts):
+        """Find the nearby posts most similar to the question"""
+        if not posts:
+            return "answer based on the user given query only"
+        nearby_ids = {post['id'] for post in posts}
         
         # Example search queries based on your data
         # test_queries = [
@@ -77,7 +147,7 @@ class ContextFetch:
         
         for query in test_queries:
             print(f"\n🔍 SEARCHING FOR: '{query}'")
-            results = self.system.search_similar_posts(query, top_k=3)
+            results = self.system.search_similar_posts(query, top_k=3, post_ids=nearby_ids)
             
             print(f"\n📋 TOP {len(results)} RESULTS:")
             print("-" * 60)
@@ -0,0 +1,397 @@
+import asyncio
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict
+import shared_sqlite
+from shared_sqlite import transaction
+from turn_buffer import DEFAULT_CAPACITY, TurnBuffer
+
+logger = logging.getLogger(__name__)
+
+# Every backend offers get, append, discard_last, put, delete, expire, start, stop and stats.
+# Histories are TurnBuffers holding the newest `max_turns` turns, returned as copies callers may
+# keep or modify. `blocking` says whether a call can wait on another process, and so must be
+# kept off the event loop; AsyncSessionStore does that for the async handlers.
+
+
+class _Sweeper:
+    """Runs the store's expire() on a background thread every `sweep_interval_seconds`"""
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name="session-sweeper", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.sweep_interval_seconds):
+            try:
+                self.expire()
+            except Exception as e:
+                logger.error(f"Session sweep failed: {e}")
+
+
+class MemorySessionStore(_Sweeper):
+    """
+    Per-user conversation histories in this process, expiring after `ttl_seconds` without activity.
+
+    Sessions are kept in an OrderedDict ordered by last write, so the oldest session is always
+    first: expiry pops from the front until it meets a live session, and the LRU session is the
+    one evicted once `max_sessions` is reached. Reads and writes for one user are O(1) however
+    many sessions are live. Expired sessions are dropped lazily when read and by a background
+    sweeper every `sweep_interval_seconds`. Session, turn and byte totals are adjusted on every
+    write and drop, so they can be reported without walking every session.
+    """
+
+    blocking = False
+
+    def __init__(self, ttl_seconds: float = 24 * 3600, max_sessions: int = 100000,
+                 sweep_interval_seconds: float = 60, max_turns: int = DEFAULT_CAPACITY):
+        self.ttl_seconds = ttl_seconds
+        self.max_turns = max_turns
+        self.max_sessions = max_sessions
+        self.sweep_interval_seconds = sweep_interval_seconds
+        self._lock = threading.Lock()
+        # user_id -> (last_activity, history, turns, nbytes) as of the last write, least recently active first
+        self._sessions: "OrderedDict[str, tuple]" = OrderedDict()
+        self.total_turns = 0
+        self.total_bytes = 0
+        self.expired = 0
+        self.evicted = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def get(self, user_id: str) -> TurnBuffer:
+        """The user's history, empty if they have none or it expired"""
+        with self._lock:
+            history = self._live_history(user_id, time.monotonic())
+            return history.copy() if history is not None else TurnBuffer(self.max_turns)
+
+    def append(self, user_id: str, role: str, text: str) -> TurnBuffer:
+        """Add a turn to the user's history, dropping the oldest beyond `max_turns`, and return the result"""
+        with self._lock:
+            history = self._live_history(user_id, time.monotonic())
+            if history is None:
+                history = TurnBuffer(self.max_turns)
+            history.append(role, text)
+            self._store(user_id, history)
+            return history.copy()
+
+    def discard_last(self, user_id: str, role: str, text: str) -> bool:
+        """Remove the user's newest turn if it is still (role, text), e.g. a question left unanswered"""
+        with self._lock:
+            history = self._live_history(user_id, time.monotonic())
+            if history is None or not len(history):
+                return False
+            if history.pop() != (role, text):
+                history.append(role, text)
+                return False
+            if len(history):
+                self._store(user_id, history)
+            else:
+                self._drop(user_id)
+            return True
+
+    def put(self, user_id: str, history: TurnBuffer):
+        """Replace the user's history and mark them active now"""
+        with self._lock:
+            self._store(user_id, TurnBuffer.from_turns(history, self.max_turns))
+
+    def delete(self, user_id: str) -> bool:
+        with self._lock:
+            if user_id not in self._sessions:
+                return False
+            self._drop(user_id)
+            return True
+
+    def expire(self) -> int:
+        """Drop every expired session; only touches the expired ones at the front"""
+        now = time.monotonic()
+        removed = 0
+        with self._lock:
+            while self._sessions:
+                user_id, (last_activity, *_) = next(iter(self._sessions.items()))
+                if not self._is_expired(last_activity, now):
+                    break
+                self._drop(user_id)
+                removed += 1
+            self.expired += removed
+        if removed:
+            logger.info(f"Cleaned up {removed} expired user histories")
+        return removed
+
+    def _live_history(self, user_id: str, now: float):
+        """The stored (not copied) history, or None if there is no live session"""
+        session = self._sessions.get(user_id)
+        if session is None:
+            return None
+        if self._is_expired(session[0], now):
+            self._drop(user_id)
+            self.expired += 1
+            logger.info(f"Cleaned up expired history for user: {user_id}")
+            return None
+        return session[1]
+
+    def _store(self, user_id: str, history: TurnBuffer):
+        if user_id in self._sessions:
+            self._drop(user_id)
+        nbytes = history.nbytes()
+        self._sessions[user_id] = (time.monotonic(), history, len(history), nbytes)
+        self.total_turns += len(history)
+        self.total_bytes += nbytes
+        while len(self._sessions) > self.max_sessions:
+            oldest = next(iter(self._sessions))
+            self._drop(oldest)
+            self.evicted += 1
+            logger.info(f"Evicted history for user {oldest}: session limit of {self.max_sessions} reached")
+
+    def _is_expired(self, last_activity: float, now: float) -> bool:
+        return now - last_activity > self.ttl_seconds
+
+    def _drop(self, user_id: str):
+        _, _, turns, nbytes = self._sessions.pop(user_id)
+        self.total_turns -= turns
+        self.total_bytes -= nbytes
+
+    def stats(self) -> Dict:
+        # Plain reads of the running totals, without the lock: health probes never wait on a
+        # sweep or a burst of chat writes, at the cost of figures that may be one write apart
+        sessions = len(self._sessions)
+        return {
+            "backend": "memory",
+            "sessions": sessions,
+            "max_sessions": self.max_sessions,
+            "total_turns": self.total_turns,
+            "bytes_total": self.total_bytes,
+            "bytes_per_session": round(self.total_bytes / sessions) if sessions else 0,
+            "expired": self.expired,
+            "evicted": self.evicted,
+        }
+
+
+class SqliteSessionStore(_Sweeper):
+    """
+    Conversation histories in a SQLite database shared by every worker on the host.
+
+    Any uvicorn worker can serve any user without sticky sessions. Each history is one row
+    holding a JSON list of [role, text] pairs, so a read is a single primary key lookup and an
+    append (read, add, trim, write) is a single immediate transaction that concurrent workers
+    cannot interleave. Rows are indexed by last activity: expired sessions are deleted lazily
+    when read and by range deletes in the sweeper, and a write that adds a session drops the
+    least recently active users beyond `max_sessions` in the same transaction. Triggers keep the
+    session, turn and byte totals in a one-row table inside the same transactions, so stats() is
+    a single row read rather than a scan of every session. It reads through its own read-only
+    connection without taking the store's lock, so it sees the last committed totals and never
+    waits for an append or a sweep.
+    """
+
+    blocking = True
+
+    def __init__(self, path: str = "sessions.db", ttl_seconds: float = 24 * 3600,
+                 max_sessions: int = 100000, sweep_interval_seconds: float = 60,
+                 max_turns: int = DEFAULT_CAPACITY):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_turns = max_turns
+        self.max_sessions = max_sessions
+        self.sweep_interval_seconds = sweep_interval_seconds
+        self._lock = threading.Lock()
+        self.expired = 0
+        self.evicted = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+        self.conn = shared_sqlite.connect(path)
+        # Schema, triggers and the totals row are created in one transaction, so totals seeded
+        # from a database written before the triggers existed cannot miss a concurrent write
+        with transaction(self.conn):
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS sessions ("
+                " user_id TEXT PRIMARY KEY,"
+                " history TEXT NOT NULL,"
+                " turns INTEGER NOT NULL,"
+                " last_activity REAL NOT NULL)"
+            )
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_sessions_last_activity ON sessions (last_activity)")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS session_totals ("
+                " id INTEGER PRIMARY KEY CHECK (id = 0),"
+                " sessions INTEGER NOT NULL,"
+                " turns INTEGER NOT NULL,"
+                " bytes INTEGER NOT NULL)"
+            )
+            self.conn.execute(
+                "INSERT OR IGNORE INTO session_totals (id, sessions, turns, bytes)"
+                " SELECT 0, COUNT(*), COALESCE(SUM(turns), 0), COALESCE(SUM(LENGTH(CAST(history AS BLOB))), 0)"
+                " FROM sessions"
+            )
+            self.conn.execute(
+                "CREATE TRIGGER IF NOT EXISTS sessions_totals_insert AFTER INSERT ON sessions BEGIN"
+                " UPDATE session_totals SET sessions = sessions + 1, turns = turns + NEW.turns,"
+                " bytes = bytes + LENGTH(CAST(NEW.history AS BLOB)) WHERE id = 0; END"
+            )
+            self.conn.execute(
+                "CREATE TRIGGER IF NOT EXISTS sessions_totals_update AFTER UPDATE ON sessions BEGIN"
+                " UPDATE session_totals SET turns = turns - OLD.turns + NEW.turns,"
+                " bytes = bytes - LENGTH(CAST(OLD.history AS BLOB)) + LENGTH(CAST(NEW.history AS BLOB))"
+                " WHERE id = 0; END"
+            )
+            self.conn.execute(
+                "CREATE TRIGGER IF NOT EXISTS sessions_totals_delete AFTER DELETE ON sessions BEGIN"
+                " UPDATE session_totals SET sessions = sessions - 1, turns = turns - OLD.turns,"
+                " bytes = bytes - LENGTH(CAST(OLD.history AS BLOB)) WHERE id = 0; END"
+            )
+        # Used only by stats(), from the event loop
+        self.stats_conn = shared_sqlite.connect_read_only(path)
+
+    def get(self, user_id: str) -> TurnBuffer:
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT history, last_activity FROM sessions WHERE user_id = ?", (user_id,)
+            ).fetchone()
+            if row is None:
+                return TurnBuffer(self.max_turns)
+            if row[1] <= time.time() - self.ttl_seconds:
+                self.conn.execute("DELETE FROM sessions WHERE user_id = ? AND last_activity = ?", (user_id, row[1]))
+                self.expired += 1
+                logger.info(f"Cleaned up expired history for user: {user_id}")
+                return TurnBuffer(self.max_turns)
+        return TurnBuffer.from_turns(json.loads(row[0]), self.max_turns)
+
+    def append(self, user_id: str, role: str, text: str) -> TurnBuffer:
+        now = time.time()
+        with self._lock:
+            with transaction(self.conn):
+                row = self.conn.execute(
+                    "SELECT history, last_activity FROM sessions WHERE user_id = ?", (user_id,)
+                ).fetchone()
+                history = TurnBuffer(self.max_turns)
+                if row is not None and row[1] > now - self.ttl_seconds:
+                    history = TurnBuffer.from_turns(json.loads(row[0]), self.max_turns)
+                history.append(role, text)
+                self._write(user_id, history, now)
+                if row is None:
+                    self._evict_over_limit()
+        return history
+
+    def discard_last(self, user_id: str, role: str, text: str) -> bool:
+        with self._lock:
+            with transaction(self.conn):
+                row = self.conn.execute("SELECT history FROM sessions WHERE user_id = ?", (user_id,)).fetchone()
+                history = TurnBuffer.from_turns(json.loads(row[0]), self.max_turns) if row else None
+                discarded = bool(history) and history.pop() == (role, text)
+                if discarded and len(history):
+                    self._write(user_id, history, time.time())
+                elif discarded:
+                    self.conn.execute("DELETE FROM sessions WHERE user_id = ?", (user_id,))
+        return discarded
+
+    def put(self, user_id: str, history: TurnBuffer):
+        with self._lock:
+            with transaction(self.conn):
+                self._write(user_id, TurnBuffer.from_turns(history, self.max_turns), time.time())
+                self._evict_over_limit()
+
+    def _write(self, user_id: str, history: TurnBuffer, now: float):
+        # An upsert rather than INSERT OR REPLACE, whose implicit delete would skip the totals trigger
+        self.conn.execute(
+            "INSERT INTO sessions (user_id, history, turns, last_activity) VALUES (?, ?, ?, ?)"
+            " ON CONFLICT (user_id) DO UPDATE SET history = excluded.history,"
+            " turns = excluded.turns, last_activity = excluded.last_activity",
+            (user_id, json.dumps(history.pairs(), separators=(",", ":")), len(history), now)
+        )
+
+    def _evict_over_limit(self):
+        """Drop the least recently active sessions beyond `max_sessions`; call inside a write transaction"""
+        count = self.conn.execute("SELECT sessions FROM session_totals WHERE id = 0").fetchone()[0]
+        if count > self.max_sessions:
+            evicted = self.conn.execute(
+                "DELETE FROM sessions WHERE user_id IN"
+                " (SELECT user_id FROM sessions ORDER BY last_activity LIMIT ?)",
+                (count - self.max_sessions,)
+            ).rowcount
+            self.evicted += evicted
+            logger.info(f"Evicted {evicted} user histories: session limit of {self.max_sessions} reached")
+
+    def delete(self, user_id: str) -> bool:
+        with self._lock:
+            return self.conn.execute("DELETE FROM sessions WHERE user_id = ?", (user_id,)).rowcount > 0
+
+    def expire(self) -> int:
+        """Delete every expired session with one range delete on the last activity index"""
+        with self._lock:
+            removed = self.conn.execute(
+                "DELETE FROM sessions WHERE last_activity <= ?", (time.time() - self.ttl_seconds,)
+            ).rowcount
+            self.expired += removed
+        if removed:
+            logger.info(f"Cleaned up {removed} expired user histories")
+        return removed
+
+    def stats(self) -> Dict:
+        sessions, total_turns, total_bytes = self.stats_conn.execute(
+            "SELECT sessions, turns, bytes FROM session_totals WHERE id = 0"
+        ).fetchone()
+        return {
+            "backend": "sqlite",
+            "sessions": sessions,
+            "max_sessions": self.max_sessions,
+            "total_turns": total_turns,
+            # Serialized size in the shared database; nothing is held in this process's memory
+            "bytes_total": total_bytes,
+            "bytes_per_session": round(total_bytes / sessions) if sessions else 0,
+            "expired": self.expired,
+            "evicted": self.evicted,
+        }
+
+    def stop(self):
+        super().stop()
+        with self._lock:
+            self.conn.close()
+        self.stats_conn.close()
+
+
+class AsyncSessionStore:
+    """
+    Awaitable get, append, discard_last, put and delete over a session store. A SQLite write can
+    wait up to its 30s busy timeout for another worker's transaction, so blocking stores are
+    called in a worker thread; the memory store's calls are O(1) under its own lock and run inline.
+    """
+
+    def __init__(self, store):
+        self.store = store
+
+    async def _call(self, method, *args):
+        if self.store.blocking:
+            return await asyncio.to_thread(method, *args)
+        return method(*args)
+
+    async def get(self, user_id: str) -> TurnBuffer:
+        return await self._call(self.store.get, user_id)
+
+    async def append(self, user_id: str, role: str, text: str) -> TurnBuffer:
+        return await self._call(self.store.append, user_id, role, text)
+
+    async def discard_last(self, user_id: str, role: str, text: str) -> bool:
+        return await self._call(self.store.discard_last, user_id, role, text)
+
+    async def put(self, user_id: str, history: TurnBuffer):
+        return await self._call(self.store.put, user_id, history)
+
+    async def delete(self, user_id: str) -> bool:
+        return await self._call(self.store.delete, user_id)
+
+
+def create_session_store(backend: str = "memory", path: str = "sessions.db", **kwargs):
+    """Session store for the SESSION_BACKEND setting: 'memory' (one process) or 'sqlite' (shared)"""
+    if backend == "memory":
+        return MemorySessionStore(**kwargs)
+    if backend == "sqlite":
+        return SqliteSessionStore(path, **kwargs)
+    raise ValueError(f"Unknown session backend: {backend}")
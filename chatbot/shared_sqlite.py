@@ -0,0 +1,37 @@
+import sqlite3
+from contextlib import contextmanager
+from pathlib import Path
+
+# The embedding, geocode and response caches and the SQLite session store each keep one file per
+# host that every uvicorn worker opens. In WAL mode readers never wait for a writer and a commit
+# only appends to the log, so workers share the file without a server in front of it; writers
+# from different processes queue for up to `timeout` seconds instead of failing with "locked".
+# Each connection is used from several threads, so its owner serializes calls with its own lock.
+
+
+def connect(path: str, timeout: float = 30) -> sqlite3.Connection:
+    """Autocommit connection to a database shared by the workers on this host"""
+    conn = sqlite3.connect(path, timeout=timeout, check_same_thread=False, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+def connect_read_only(path: str, timeout: float = 1) -> sqlite3.Connection:
+    """Read-only connection for figures that must not wait behind the owner's lock or writes"""
+    return sqlite3.connect(
+        f"{Path(path).resolve().as_uri()}?mode=ro", uri=True, timeout=timeout,
+        check_same_thread=False, isolation_level=None
+    )
+
+
+@contextmanager
+def transaction(conn: sqlite3.Connection):
+    """BEGIN IMMEDIATE ... COMMIT, rolled back if the block raises; hold the owner's lock around it"""
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
@@ -0,0 +1,169 @@
+import asyncio
+import hashlib
+import json
+import re
+import threading
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict
+
+
+def normalize_question(text: str) -> str:
+    """Question text with case, punctuation and spacing differences removed"""
+    text = re.sub(r"[^\w\s]", "", text.lower())
+    return re.sub(r"\s+", " ", text).strip()
+
+
+class _Call:
+    """One in-flight sync computation and the threads waiting on it"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class _AsyncCall:
+    """One in-flight async computation, cancelled when every caller has given up on it"""
+
+    def __init__(self, task):
+        self.task = task
+        self.waiters = 0
+
+
+class _SharedStream:
+    """Chunks of an in-flight stream, replayed to every consumer from the start"""
+
+    def __init__(self):
+        self.chunks = []
+        self.finished = False
+        self.error = None
+        self.consumers = 0
+        self.task = None
+        self.changed = asyncio.Event()
+
+    def notify(self):
+        changed, self.changed = self.changed, asyncio.Event()
+        changed.set()
+
+
+class SingleFlight:
+    """
+    Lets concurrent callers asking for the same key share one computation.
+
+    The first caller for a key (the leader) runs it; callers arriving while it is in flight get
+    the same result or exception, and the key is forgotten as soon as it completes, so nothing is
+    cached past the burst. `do` serves threads, `do_async` coroutines and `stream` async
+    generators, whose chunks are replayed to late joiners. Async work runs in its own task so one
+    caller going away does not cancel it for the others; it is cancelled once all have left.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: Dict[str, _Call] = {}
+        self._async_calls: Dict[str, _AsyncCall] = {}
+        self._streams: Dict[str, _SharedStream] = {}
+        self.usage: Dict[str, Dict[str, int]] = {}
+
+    @staticmethod
+    def make_key(stage: str, *parts: Any) -> str:
+        """Key for one stage of a request; parts may be any JSON serializable values"""
+        digest = hashlib.sha1(json.dumps(parts, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+        return f"{stage}:{digest}"
+
+    def _count(self, key: str, shared: bool):
+        usage = self.usage.setdefault(key.split(":", 1)[0], {"leaders": 0, "shared": 0})
+        usage["shared" if shared else "leaders"] += 1
+
+    def do(self, key: str, fn: Callable[[], Any]) -> Any:
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            self._count(key, shared=not leader)
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    async def do_async(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        with self._lock:
+            call = self._async_calls.get(key)
+            shared = call is not None
+            if not shared:
+                call = self._async_calls[key] = _AsyncCall(asyncio.ensure_future(fn()))
+                call.task.add_done_callback(lambda _: self._forget(self._async_calls, key, call))
+            call.waiters += 1
+            self._count(key, shared)
+
+        try:
+            return await asyncio.shield(call.task)
+        finally:
+            call.waiters -= 1
+            if call.waiters == 0 and not call.task.done():
+                self._forget(self._async_calls, key, call)
+                call.task.cancel()
+
+    async def stream(self, key: str, fn: Callable[[], AsyncIterator[Any]]) -> AsyncIterator[Any]:
+        with self._lock:
+            shared_stream = self._streams.get(key)
+            shared = shared_stream is not None
+            if not shared:
+                shared_stream = self._streams[key] = _SharedStream()
+                shared_stream.task = asyncio.ensure_future(self._pump(shared_stream, fn))
+                shared_stream.task.add_done_callback(lambda _: self._forget(self._streams, key, shared_stream))
+            shared_stream.consumers += 1
+            self._count(key, shared)
+
+        try:
+            index = 0
+            while True:
+                while index < len(shared_stream.chunks):
+                    yield shared_stream.chunks[index]
+                    index += 1
+                if shared_stream.finished:
+                    if shared_stream.error is not None:
+                        raise shared_stream.error
+                    return
+                await shared_stream.changed.wait()
+        finally:
+            shared_stream.consumers -= 1
+            if shared_stream.consumers == 0 and not shared_stream.task.done():
+                self._forget(self._streams, key, shared_stream)
+                shared_stream.task.cancel()
+
+    @staticmethod
+    async def _pump(shared_stream: _SharedStream, fn: Callable[[], AsyncIterator[Any]]):
+        try:
+            async for chunk in fn():
+                shared_stream.chunks.append(chunk)
+                shared_stream.notify()
+        except Exception as e:
+            shared_stream.error = e
+        finally:
+            shared_stream.finished = True
+            shared_stream.notify()
+
+    def _forget(self, calls: Dict, key: str, call: Any):
+        with self._lock:
+            if calls.get(key) is call:
+                del calls[key]
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "in_flight": len(self._calls) + len(self._async_calls) + len(self._streams),
+                "by_stage": {stage: dict(usage) for stage, usage in self.usage.items()},
+            }
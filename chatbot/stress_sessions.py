@@ -0,0 +1,190 @@
+"""
+Concurrency stress test: many ChatbotLocal sessions answering at once must never see each
+other's location, history or local posts.
+
+Gemini and the post retrieval are replaced by stand-ins that echo back what they were given
+(with random delays to shuffle the interleaving), so every answer can be checked against the
+request that produced it. Runs the sync conversation from a thread pool and the async
+conversation on one event loop. Run with `python stress_sessions.py` from the chatbot directory.
+"""
+import asyncio
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+REQUESTS = 400
+THREADS = 32
+MAX_DELAY_SECONDS = 0.02
+
+workdir = tempfile.mkdtemp(prefix="stress_sessions_")
+os.environ.setdefault("GEMINI_API_KEY", "stress-test")
+os.environ["GEOCODE_CACHE_PATH"] = os.path.join(workdir, "geocode_cache.db")
+os.environ["RESPONSE_CACHE_PATH"] = ""
+# Every request asks the stand-in Gemini for its intent, and nothing is shared between requests
+os.environ["INTENT_CONFIDENCE_THRESHOLD"] = "2"
+os.environ["INTENT_SHADOW_RATE"] = "0"
+os.environ["COALESCE_WINDOW_SECONDS"] = "0"
+
+from llm_working import ChatbotLocal  # noqa: E402
+from turn_buffer import TurnBuffer  # noqa: E402
+
+
+class Reply:
+    def __init__(self, text):
+        self.text = text
+
+
+class ReplyStream:
+    def __init__(self, text):
+        self.words = text.split(" ")
+
+    async def __aiter__(self):
+        for word in self.words:
+            await asyncio.sleep(random.uniform(0, MAX_DELAY_SECONDS / 4))
+            yield Reply(word + " ")
+
+
+def echo(prompt, history):
+    """What the stand-in model answers: the location and posts from the prompt and the history size"""
+    location = re.search(r"lattitude: (\S+) longitude:(\S+)", prompt)
+    posts = re.findall(r"post at \S+", prompt)
+    return f"location={location.group(1)},{location.group(2)} posts={'|'.join(posts)} history={len(history or [])}"
+
+
+class EchoChat:
+    def __init__(self, history):
+        self.history = history
+
+    def send_message(self, prompt, request_options=None):
+        time.sleep(random.uniform(0, MAX_DELAY_SECONDS))
+        return Reply(echo(prompt, self.history))
+
+    async def send_message_async(self, prompt, stream=False):
+        await asyncio.sleep(random.uniform(0, MAX_DELAY_SECONDS))
+        return ReplyStream(echo(prompt, self.history))
+
+
+class EchoModel:
+    def generate_content(self, prompt):
+        time.sleep(random.uniform(0, MAX_DELAY_SECONDS))
+        return Reply('{"intent": "chat"}')
+
+    async def generate_content_async(self, prompt):
+        await asyncio.sleep(random.uniform(0, MAX_DELAY_SECONDS))
+        return Reply('{"intent": "chat"}')
+
+    def start_chat(self, history=None):
+        return EchoChat(history)
+
+
+class LocationContextFetch:
+    """Returns one post named after the coordinates it was asked about"""
+
+    @staticmethod
+    def posts(lat, lon):
+        return [{
+            "combined_text": f"post at {lat},{lon}",
+            "post_id": f"{lat},{lon}",
+            "similarity_score": 1.0,
+            "created_at": None,
+        }]
+
+    def main_with_your_data(self, my_question, curr_lat, curr_long):
+        time.sleep(random.uniform(0, MAX_DELAY_SECONDS))
+        return self.posts(curr_lat, curr_long)
+
+    async def main_with_your_data_async(self, my_question, curr_lat, curr_long):
+        await asyncio.sleep(random.uniform(0, MAX_DELAY_SECONDS))
+        return self.posts(curr_lat, curr_long)
+
+
+def build_chatbot():
+    chatbot = ChatbotLocal()
+    model = EchoModel()
+    chatbot.model_flash = chatbot.model_pro = model
+    chatbot.models = {name: model for name in chatbot.models}
+    chatbot.context_fetch = LocationContextFetch()
+    return chatbot
+
+
+def make_request(i):
+    """A distinct location (far apart, so no two share a geohash cell) and history length per request"""
+    lat = round(-60 + i * 0.29, 4)
+    lon = round(-170 + i * 0.83, 4)
+    history = []
+    for turn in range(i % 4):
+        history.append(("user", f"question {turn} from {lat},{lon}"))
+        history.append(("model", f"answer {turn}"))
+    return lat, lon, history
+
+
+def check(i, session, answer):
+    """Returns a description of anything in the answer or session that belongs to another request"""
+    lat, lon, history = make_request(i)
+    expected = f"location={lat},{lon} posts=post at {lat},{lon} history={len(history)}"
+    problems = []
+    if answer.strip() != expected:
+        problems.append(f"answer {answer.strip()!r} != {expected!r}")
+    if session.local_posts[0]["post_id"] != f"{lat},{lon}":
+        problems.append(f"local posts {session.local_posts[0]['post_id']} != {lat},{lon}")
+    if session.conversation_history.pairs() != history:
+        problems.append("conversation history changed")
+    return problems
+
+
+def run_sync(chatbot, i):
+    lat, lon, history = make_request(i)
+    session = chatbot.new_session()
+    session.conversation_history = TurnBuffer.from_turns(history)
+    answer = session.conversation(f"anything happening near me? ({i})", lat, lon)
+    return check(i, session, answer)
+
+
+async def run_async(chatbot, i):
+    lat, lon, history = make_request(i)
+    session = chatbot.new_session()
+    session.conversation_history = TurnBuffer.from_turns(history)
+    answer = await session.conversation_async(f"anything happening near me? ({i})", lat, lon)
+    return check(i, session, answer)
+
+
+async def run_all_async(chatbot):
+    return await asyncio.gather(*[run_async(chatbot, i) for i in range(REQUESTS)])
+
+
+def report(name, results, seconds):
+    leaks = [(i, problems) for i, problems in enumerate(results) if problems]
+    print(f"{name:>8}: {REQUESTS} conversations in {seconds:.2f}s, {len(leaks)} with leaked state")
+    for i, problems in leaks[:5]:
+        print(f"          request {i}: {'; '.join(problems)}")
+    return not leaks
+
+
+def main():
+    chatbot = build_chatbot()
+    # The echoed answers go to stdout too; only the summary is of interest here
+    stdout, sys.stdout = sys.stdout, open(os.devnull, "w")
+    try:
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=THREADS) as pool:
+            sync_results = list(pool.map(lambda i: run_sync(chatbot, i), range(REQUESTS)))
+        sync_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        async_results = asyncio.run(run_all_async(chatbot))
+        async_seconds = time.perf_counter() - start
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+    ok = report("threads", sync_results, sync_seconds)
+    ok = report("asyncio", async_results, async_seconds) and ok
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
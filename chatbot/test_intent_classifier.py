@@ -0,0 +1,53 @@
+"""
+Labelled queries for the local intent classifier. Run with `python -m pytest test_intent_classifier.py`
+from the chatbot directory.
+
+Each row is (query, intent, location, place_type, confident): `confident` says whether the
+local answer should clear the default threshold, or the query should go on to Gemini.
+"""
+import pytest
+
+from intent_classifier import IntentClassifier
+
+LABELLED_QUERIES = [
+    # Lookups the rules should answer on their own
+    ("find restaurants in Salt Lake", "map", "Salt Lake", "restaurant", True),
+    ("hospitals near Behala", "map", "Behala", "hospital", True),
+    ("Where is the nearest ATM in Park Street", "map", "Park Street", "atm", True),
+    ("show me coffee shops in Kolkata", "map", "Kolkata", "coffee shop", True),
+    ("what is the weather in Kolkata", "weather", "Kolkata", None, True),
+    ("how hot is it in Delhi today", "weather", "Delhi", None, True),
+    ("traffic from Howrah to Esplanade", "map", "Howrah", "traffic", True),
+    ("hello", "chat", None, None, True),
+    ("weather tomorrow in Delhi", "chat", None, None, True),
+    # Unrecognised map and weather phrasings must reach Gemini rather than be taken for chat
+    ("Show me ice cream parlours in Salt Lake", None, None, None, False),
+    ("Where can I buy medicines in Behala", None, None, None, False),
+    ("Is it pouring in Delhi right now", None, None, None, False),
+    # A place type and a location without a request to find anything is not a lookup
+    ("write a poem about a park in Paris", None, None, None, False),
+    ("Recommend a movie to watch in the cinema", None, None, None, False),
+    # Weather words with an 'in/at ...' phrase that is not a place
+    ("why is it so cold in winter", None, None, None, False),
+    ("what is the temperature at which water boils", None, None, None, False),
+    ("what is hot in fashion in Paris", None, None, None, False),
+    ("what's the weather in Shimla", "weather", "Shimla", None, True),
+    # Slots that only the history or the user's coordinates can fill
+    ("restaurants near me", None, None, None, False),
+    ("is it raining", None, None, None, False),
+]
+
+
+@pytest.fixture(scope="module")
+def classifier():
+    return IntentClassifier(threshold=0.8)
+
+
+@pytest.mark.parametrize("query, intent, location, place_type, confident", LABELLED_QUERIES)
+def test_classify(classifier, query, intent, location, place_type, confident):
+    params, confidence = classifier.classify(query)
+    assert (confidence >= classifier.threshold) == confident, (params, confidence)
+    if confident:
+        assert params["intent"] == intent
+        assert params.get("location") == location
+        assert params.get("place_type") == place_type
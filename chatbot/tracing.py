@@ -0,0 +1,257 @@
+import contextvars
+import logging
+import threading
+import time
+import uuid
+from bisect import bisect_left
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Histogram upper bounds in seconds, from a cached embedding up to a Gemini Pro timeout
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 0.75, 1, 1.5, 2, 3, 5, 8, 13, 20, 30, 60)
+QUANTILES = (0.5, 0.95, 0.99)
+
+# Id of the request being served, for log lines; asyncio tasks and to_thread calls inherit it
+request_id_var = contextvars.ContextVar("request_id", default="-")
+_current_trace = contextvars.ContextVar("trace", default=None)
+
+
+def new_request_id() -> str:
+    return uuid.uuid4().hex[:16]
+
+
+def incoming_request_id(headers) -> str:
+    """The caller's X-Request-ID, else the Cloud Run trace id, else a fresh id"""
+    request_id = headers.get("x-request-id")
+    if request_id:
+        return request_id[:64]
+    # X-Cloud-Trace-Context: TRACE_ID/SPAN_ID;o=OPTIONS
+    cloud_trace = headers.get("x-cloud-trace-context")
+    if cloud_trace:
+        return cloud_trace.split("/", 1)[0][:64]
+    return new_request_id()
+
+
+class RequestIdFilter(logging.Filter):
+    """Adds the current request id to every record as %(request_id)s"""
+
+    def filter(self, record):
+        record.request_id = request_id_var.get()
+        return True
+
+
+class _NoopSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NOOP = _NoopSpan()
+
+
+class _Span:
+    __slots__ = ("trace", "stage", "started")
+
+    def __init__(self, trace: "Trace", stage: str):
+        self.trace = trace
+        self.stage = stage
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        # list.append is atomic, so spans from worker threads need no lock
+        self.trace.spans.append((self.stage, time.perf_counter() - self.started))
+        return False
+
+
+def span(stage: str):
+    """
+    Times the enclosed block as `stage` of the chat turn being traced. Outside a trace, or with
+    tracing disabled, this is one context variable read returning a shared no-op.
+    """
+    trace = _current_trace.get()
+    if trace is None:
+        return _NOOP
+    return _Span(trace, stage)
+
+
+def set_intent(intent: str):
+    """Labels the current trace's stages with the intent the turn was answered as"""
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.intent = intent
+
+
+class Trace:
+    """The spans of one chat turn, folded into the tracer's histograms when the turn ends"""
+
+    __slots__ = ("tracer", "intent", "spans", "started", "_previous")
+
+    def __init__(self, tracer: "Tracer"):
+        self.tracer = tracer
+        self.intent = "unknown"
+        self.spans: List[Tuple[str, float]] = []
+
+    def __enter__(self):
+        self._previous = _current_trace.get()
+        _current_trace.set(self)
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        # set rather than reset: a streamed turn may be closed from another context
+        _current_trace.set(self._previous)
+        self.tracer.finish(self, time.perf_counter() - self.started)
+        return False
+
+
+class LatencyHistogram:
+    """Counts of durations per bucket, cumulative only when exported, like a Prometheus histogram"""
+
+    __slots__ = ("bounds", "counts", "count", "total", "min", "max")
+
+    def __init__(self, bounds: Tuple[float, ...]):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # The last bucket holds everything above bounds[-1]
+        self.count = 0
+        self.total = 0.0
+        self.min = float("inf")
+        self.max = 0.0
+
+    def observe(self, seconds: float):
+        self.counts[bisect_left(self.bounds, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        self.min = min(self.min, seconds)
+        self.max = max(self.max, seconds)
+
+    def merge(self, other: "LatencyHistogram"):
+        for i, count in enumerate(other.counts):
+            self.counts[i] += count
+        self.count += other.count
+        self.total += other.total
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def quantile(self, q: float) -> Optional[float]:
+        """
+        Interpolated within the bucket holding the q-th observation, as histogram_quantile() does,
+        then clamped to the observed range so sparse stages do not report a bucket's midpoint
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        cumulative = 0
+        estimate = self.max
+        for i, count in enumerate(self.counts):
+            if count and cumulative + count >= rank:
+                if i < len(self.bounds):
+                    lower = self.bounds[i - 1] if i else 0.0
+                    estimate = lower + (self.bounds[i] - lower) * (rank - cumulative) / count
+                break
+            cumulative += count
+        return min(max(estimate, self.min), self.max)
+
+    def summary(self) -> Dict:
+        summary = {"count": self.count, "mean": round(self.total / self.count, 4) if self.count else None}
+        for q in QUANTILES:
+            value = self.quantile(q)
+            summary[f"p{round(q * 100)}"] = round(value, 4) if value is not None else None
+        return summary
+
+
+class Tracer:
+    """
+    Per-stage latency of chat turns, by stage and intent.
+
+    A turn runs inside `tracer.trace()`; the Firestore fetch, embedding, FAISS search, intent
+    extraction, Places/OpenWeather calls and the Gemini answer each time themselves with
+    `span(stage)`, found through a context variable so nothing has to be passed down the call
+    chain. When the turn ends its time per stage (summed if a stage ran more than once) and its
+    total go into one histogram per (stage, intent), under a lock taken once per turn rather
+    than once per span. Turns slower than `slow_seconds` are logged with their breakdown.
+    """
+
+    def __init__(self, enabled: bool = True, slow_seconds: Optional[float] = None,
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.enabled = enabled
+        self.slow_seconds = slow_seconds
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self.histograms: Dict[Tuple[str, str], LatencyHistogram] = {}
+        self.traces = 0
+
+    def trace(self):
+        """Context manager tracing one chat turn; a shared no-op when tracing is disabled"""
+        if not self.enabled:
+            return _NOOP
+        return Trace(self)
+
+    def finish(self, trace: Trace, total: float):
+        durations: Dict[str, float] = {}
+        for stage, seconds in list(trace.spans):
+            durations[stage] = durations.get(stage, 0.0) + seconds
+        durations["total"] = total
+        with self._lock:
+            self.traces += 1
+            for stage, seconds in durations.items():
+                histogram = self.histograms.get((stage, trace.intent))
+                if histogram is None:
+                    histogram = self.histograms[(stage, trace.intent)] = LatencyHistogram(self.buckets)
+                histogram.observe(seconds)
+        if self.slow_seconds and total >= self.slow_seconds:
+            breakdown = ", ".join(f"{stage}={seconds:.2f}s" for stage, seconds in durations.items() if stage != "total")
+            logger.warning(f"Slow {trace.intent} chat took {total:.2f}s: {breakdown}")
+
+    def _by_stage(self) -> Dict[str, LatencyHistogram]:
+        """Histograms merged across intents; call with the lock held"""
+        merged: Dict[str, LatencyHistogram] = {}
+        for (stage, _), histogram in self.histograms.items():
+            if stage not in merged:
+                merged[stage] = LatencyHistogram(self.buckets)
+            merged[stage].merge(histogram)
+        return merged
+
+    def stats(self) -> Dict:
+        with self._lock:
+            by_intent: Dict[str, Dict] = {}
+            for (stage, intent), histogram in sorted(self.histograms.items()):
+                by_intent.setdefault(intent, {})[stage] = histogram.summary()
+            return {
+                "enabled": self.enabled,
+                "traces": self.traces,
+                "by_stage": {stage: histogram.summary() for stage, histogram in sorted(self._by_stage().items())},
+                "by_intent": by_intent,
+            }
+
+    def families(self) -> List:
+        """Prometheus families: a histogram per (stage, intent) and its estimated p50/p95/p99"""
+        buckets, quantiles = [], []
+        with self._lock:
+            for (stage, intent), histogram in sorted(self.histograms.items()):
+                labels = {"stage": stage, "intent": intent}
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float("inf"),), histogram.counts):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else repr(float(bound))
+                    buckets.append(("_bucket", {**labels, "le": le}, cumulative))
+                buckets.append(("_sum", labels, histogram.total))
+                buckets.append(("_count", labels, histogram.count))
+            rows = sorted(self.histograms.items())
+            rows += [((stage, "all"), histogram) for stage, histogram in sorted(self._by_stage().items())]
+            for (stage, intent), histogram in rows:
+                for q in QUANTILES:
+                    quantiles.append(({"stage": stage, "intent": intent, "quantile": str(q)}, histogram.quantile(q)))
+        return [
+            ("chatbot_stage_duration_seconds", "histogram", "Time spent in each stage of a chat turn, by intent", buckets),
+            ("chatbot_stage_duration_quantile_seconds", "gauge",
+             "p50/p95/p99 stage time estimated from the histogram buckets; intent=\"all\" merges every intent",
+             quantiles),
+        ]
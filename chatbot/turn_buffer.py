@@ -0,0 +1,96 @@
+import sys
+from typing import Dict, Iterable, Iterator, List, Tuple
+
+ROLES = ("user", "model")
+ROLE_CODES = {role: code for code, role in enumerate(ROLES)}
+# Five exchanges of a user turn and a model turn
+DEFAULT_CAPACITY = 10
+
+
+def gemini_turn(role: str, text: str) -> Dict:
+    """One history entry in the shape Gemini's start_chat expects"""
+    return {"role": role, "parts": [{"text": text}]}
+
+
+class TurnBuffer:
+    """
+    Fixed-capacity ring buffer of conversation turns.
+
+    Roles are one byte each in a bytearray and texts sit in a preallocated list, so a session
+    costs two small arrays plus its strings instead of three containers per turn in the nested
+    Gemini format. Appending past `capacity` overwrites the oldest turn in O(1). Iterating yields
+    (role, text) pairs, oldest first; to_gemini() builds the Gemini shape when a prompt needs it.
+    """
+
+    __slots__ = ("capacity", "_roles", "_texts", "_start", "_size")
+
+    def __init__(self, capacity: int = DEFAULT_CAPACITY):
+        self.capacity = capacity
+        self._roles = bytearray(capacity)
+        self._texts: List = [None] * capacity
+        self._start = 0
+        self._size = 0
+
+    @classmethod
+    def from_turns(cls, turns: Iterable, capacity: int = DEFAULT_CAPACITY) -> "TurnBuffer":
+        """Buffer holding the newest `capacity` of (role, text) pairs or Gemini-shaped dicts"""
+        buffer = cls(capacity)
+        for turn in turns:
+            if isinstance(turn, dict):
+                buffer.append(turn["role"], turn["parts"][0]["text"])
+            else:
+                buffer.append(*turn)
+        return buffer
+
+    def append(self, role: str, text: str):
+        index = (self._start + self._size) % self.capacity
+        self._roles[index] = ROLE_CODES[role]
+        self._texts[index] = text
+        if self._size < self.capacity:
+            self._size += 1
+        else:
+            self._start = (self._start + 1) % self.capacity
+
+    def pop(self) -> Tuple[str, str]:
+        """Remove and return the newest turn"""
+        if not self._size:
+            raise IndexError("pop from an empty TurnBuffer")
+        self._size -= 1
+        index = (self._start + self._size) % self.capacity
+        text, self._texts[index] = self._texts[index], None
+        return ROLES[self._roles[index]], text
+
+    def clear(self):
+        self._texts = [None] * self.capacity
+        self._start = 0
+        self._size = 0
+
+    def copy(self) -> "TurnBuffer":
+        """Independent buffer with the same turns; the strings themselves are shared"""
+        buffer = TurnBuffer(self.capacity)
+        buffer._roles[:] = self._roles
+        buffer._texts[:] = self._texts
+        buffer._start = self._start
+        buffer._size = self._size
+        return buffer
+
+    def __len__(self):
+        return self._size
+
+    def __iter__(self) -> Iterator[Tuple[str, str]]:
+        for offset in range(self._size):
+            index = (self._start + offset) % self.capacity
+            yield ROLES[self._roles[index]], self._texts[index]
+
+    def pairs(self) -> List[Tuple[str, str]]:
+        return list(self)
+
+    def to_gemini(self) -> List[Dict]:
+        return [gemini_turn(role, text) for role, text in self]
+
+    def nbytes(self) -> int:
+        """Approximate memory held by this buffer and its texts"""
+        return (
+            sys.getsizeof(self) + sys.getsizeof(self._roles) + sys.getsizeof(self._texts)
+            + sum(sys.getsizeof(text) for text in self._texts if text is not None)
+        )
@@ -1,13 +1,23 @@
 import json
 import os
-from typing import List, Dict, Any
+import hashlib
+import random
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import List, Dict, Any, Callable, Optional
 import vertexai
 from vertexai.language_models import TextEmbeddingModel, TextEmbeddingInput
 from langchain.vectorstores import FAISS
 from langchain.embeddings.base import Embeddings
 from langchain.docstore.document import Document
+import faiss
 import numpy as np
 from dotenv import load_dotenv
+from embedding_cache import EmbeddingCache
+from tracing import span
 
 load_dotenv()
 # Configuration
@@ -16,6 +26,14 @@ REGION = "us-central1"
 MODEL_ID = "text-embedding-005"
 DIMENSIONALITY = 512
 
+# Per-request limits of the Vertex AI text embedding API
+MAX_BATCH_INSTANCES = 250
+MAX_BATCH_TOKENS = 20000
+
+# On-disk embedding cache shared by all workers on the host
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", "embedding_cache.db")
+EMBEDDING_CACHE_MAX_MB = int(os.getenv("EMBEDDING_CACHE_MAX_MB", "256"))
+
 # Set up authentication
 os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = 'localgram-461614-74f492642d25.json'
 vertexai.init(project=PROJECT_ID, location=REGION)
@@ -23,30 +41,129 @@ vertexai.init(project=PROJECT_ID, location=REGION)
 class VertexAIEmbeddings(Embeddings):
     """Custom LangChain Embeddings wrapper for Vertex AI"""
     
-    def __init__(self, model_id: str = MODEL_ID, dimensionality: int = DIMENSIONALITY):
+    def __init__(self, model_id: str = MODEL_ID, dimensionality: int = DIMENSIONALITY,
+                 batch_mode: bool = True, max_workers: int = 4, max_retries: int = 3,
+                 cache: Optional[EmbeddingCache] = None):
         self.model = TextEmbeddingModel.from_pretrained(model_id)
+        self.model_id = model_id
         self.dimensionality = dimensionality
+        self.cache = cache
+        # Batch mode packs many texts into one request and runs several requests at once
+        self.batch_mode = batch_mode
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+    
+    @staticmethod
+    def estimate_tokens(text: str) -> int:
+        """Conservative token estimate (about 3 characters per token) used for batch packing"""
+        return len(text) // 3 + 1
+    
+    def make_batches(self, texts: List[str]) -> List[List[int]]:
+        """Group text indices into batches within the API's instance and token limits"""
+        batches = []
+        current = []
+        current_tokens = 0
+        for i, text in enumerate(texts):
+            tokens = self.estimate_tokens(text)
+            if current and (len(current) >= MAX_BATCH_INSTANCES or current_tokens + tokens > MAX_BATCH_TOKENS):
+                batches.append(current)
+                current = []
+                current_tokens = 0
+            current.append(i)
+            current_tokens += tokens
+        if current:
+            batches.append(current)
+        return batches
+    
+    def _embed_batch(self, texts: List[str], task_type: str) -> List[List[float]]:
+        """Embed one batch of texts in a single API call"""
+        text_inputs = [TextEmbeddingInput(text, task_type) for text in texts]
+        result = self.model.get_embeddings(text_inputs, output_dimensionality=self.dimensionality)
+        return [embedding.values for embedding in result]
+    
+    def _embed_with_cache(self, texts: List[str], task_type: str) -> List[List[float]]:
+        """Serve texts from the cache where possible and embed only the misses"""
+        with span("embedding"):
+            if self.cache is None:
+                return self._embed_uncached(texts, task_type)
+            
+            keys = [EmbeddingCache.make_key(self.model_id, self.dimensionality, task_type, text) for text in texts]
+            cached = self.cache.get_many(keys)
+            
+            # Embed each missing text once, even if it appears several times
+            missing = {}
+            for key, text in zip(keys, texts):
+                if key not in cached and key not in missing:
+                    missing[key] = text
+            if missing:
+                print(f"Embedding cache: {len(texts) - len(missing)} hits, {len(missing)} misses")
+                fresh = dict(zip(missing.keys(), self._embed_uncached(list(missing.values()), task_type)))
+                self.cache.put_many(fresh)
+                cached.update(fresh)
+            
+            return [cached[key] for key in keys]
     
     def embed_documents(self, texts: List[str]) -> List[List[float]]:
         """Embed search docs."""
-        embeddings = []
-        for text in texts:
-            text_input = TextEmbeddingInput(text, "RETRIEVAL_DOCUMENT")
-            result = self.model.get_embeddings([text_input], output_dimensionality=self.dimensionality)
-            embeddings.append(result[0].values)
-        return embeddings
+        return self._embed_with_cache(texts, "RETRIEVAL_DOCUMENT")
+    
+    def _embed_uncached(self, texts: List[str], task_type: str) -> List[List[float]]:
+        """Embed texts through the Vertex AI API"""
+        if not self.batch_mode:
+            embeddings = []
+            for text in texts:
+                text_input = TextEmbeddingInput(text, task_type)
+                result = self.model.get_embeddings([text_input], output_dimensionality=self.dimensionality)
+                embeddings.append(result[0].values)
+            return embeddings
+        
+        embeddings = [None] * len(texts)
+        pending = self.make_batches(texts)
+        
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for attempt in range(self.max_retries + 1):
+                if attempt:
+                    # Exponential backoff with jitter before retrying the failed batches only
+                    time.sleep(min(2 ** attempt, 30) * random.uniform(0.5, 1.0))
+                futures = [
+                    (batch, executor.submit(self._embed_batch, [texts[i] for i in batch], task_type))
+                    for batch in pending
+                ]
+                failed = []
+                last_error = None
+                for batch, future in futures:
+                    try:
+                        for i, values in zip(batch, future.result()):
+                            embeddings[i] = values
+                    except Exception as e:
+                        print(f"Embedding batch of {len(batch)} texts failed (attempt {attempt + 1}): {e}")
+                        failed.append(batch)
+                        last_error = e
+                if not failed:
+                    return embeddings
+                pending = failed
+        
+        raise RuntimeError(f"{len(pending)} embedding batches still failing after {self.max_retries} retries") from last_error
     
     def embed_query(self, text: str) -> List[float]:
         """Embed query text."""
-        text_input = TextEmbeddingInput(text, "RETRIEVAL_QUERY")
-        result = self.model.get_embeddings([text_input], output_dimensionality=self.dimensionality)
-        return result[0].values
+        return self._embed_with_cache([text], "RETRIEVAL_QUERY")[0]
 
 class PostEmbeddingSystem:
+    MANIFEST_FILE = "index_manifest.json"
+    # Saved versions younger than this are kept, another worker may still be switching to one
+    VERSION_GRACE_SECONDS = 600
+
     def __init__(self):
-        self.embeddings = VertexAIEmbeddings()
+        cache = EmbeddingCache(EMBEDDING_CACHE_PATH, max_bytes=EMBEDDING_CACHE_MAX_MB * 1024 * 1024)
+        self.embeddings = VertexAIEmbeddings(cache=cache)
         self.vectorstore = None
         self.posts_data = []
+        # post_id -> {'content_hash', 'latitude', 'longitude', 'expires_at'} for every embedded post
+        self.indexed_posts: Dict[str, Dict[str, Any]] = {}
+        # post_id -> FAISS row, rebuilt on the first filtered search after the index changes
+        self._rows: Optional[Dict[str, int]] = None
+        self._lock = threading.RLock()
     
     def load_posts_from_json(self, json_file_path: str):
         """Load posts from JSON file"""
@@ -71,6 +188,8 @@ class PostEmbeddingSystem:
             # Create combined text for embedding
             combined_text = f"Title: {title}\nCaption: {caption}\nTags: {tags}".strip()
             
+            location = post.get('location') or {}
+            
             # Create metadata
             metadata = {
                 'post_id': post.get('id', ''),
@@ -82,6 +201,10 @@ class PostEmbeddingSystem:
                 'comment_count': post.get('commentCount', 0),
                 'created_at': post.get('createdAt', ''),
                 'image_url': post.get('imageUrl', ''),
+                'expires_at': post.get('expiresAt', ''),
+                'latitude': location.get('latitude'),
+                'longitude': location.get('longitude'),
+                'content_hash': self.content_hash(combined_text),
                 'combined_text': combined_text
             }
             
@@ -104,24 +227,209 @@ class PostEmbeddingSystem:
             documents=documents,
             embedding=self.embeddings
         )
+        self._rows = None
         print("Vector store created successfully!")
     
+    @staticmethod
+    def content_hash(combined_text: str) -> str:
+        """Hash of the text that gets embedded; a post is only re-embedded when this changes"""
+        return hashlib.sha256(combined_text.encode('utf-8')).hexdigest()
+    
+    @staticmethod
+    def is_expired(expires_at: str, now: Optional[datetime] = None) -> bool:
+        """Check an ISO formatted expiresAt string against the current UTC time"""
+        if not expires_at:
+            return False
+        try:
+            expiry = datetime.fromisoformat(str(expires_at))
+        except ValueError:
+            return False
+        if expiry.tzinfo is None:
+            expiry = expiry.replace(tzinfo=timezone.utc)
+        return expiry <= (now or datetime.now(timezone.utc))
+    
+    def sync_posts(self, posts_data: List[Dict], in_scope: Optional[Callable[[Dict], bool]] = None) -> Dict[str, int]:
+        """
+        Incrementally bring the vector store in line with the given live posts.
+        
+        Only new posts and posts whose embedded text changed are sent to the embedding
+        model. Expired posts are always dropped. When `in_scope` is given, `posts_data`
+        is treated as the complete live set for that scope, so any indexed post for which
+        `in_scope(entry)` is true but which is missing from `posts_data` (deleted or no
+        longer approved) is removed as well.
+        
+        The new and edited posts are embedded without holding the lock, so searches are not held
+        up by the Vertex AI calls; the index is then updated under the lock with the vectors.
+        """
+        with self._lock:
+            self.posts_data = posts_data
+            documents = self.prepare_documents()
+            pending = [doc for doc in documents if self._needs_embedding(doc)]
+        vectors = self._embed_posts(pending)
+        
+        with self._lock:
+            live_ids = set()
+            expired_ids = set()
+            to_embed = []
+            refreshed = 0
+            
+            for doc in documents:
+                metadata = doc.metadata
+                post_id = metadata['post_id']
+                if not post_id:
+                    continue
+                if self.is_expired(metadata['expires_at']):
+                    expired_ids.add(post_id)
+                    continue
+                live_ids.add(post_id)
+                entry = self.indexed_posts.get(post_id)
+                if entry and entry['content_hash'] == metadata['content_hash']:
+                    # Same embedded text: just refresh likes, comment counts etc. in place
+                    self.vectorstore.docstore.search(post_id).metadata.update(metadata)
+                    refreshed += 1
+                else:
+                    to_embed.append(doc)
+            
+            now = datetime.now(timezone.utc)
+            stale_ids = [
+                post_id for post_id, entry in self.indexed_posts.items()
+                if post_id not in live_ids and (
+                    post_id in expired_ids
+                    or self.is_expired(entry['expires_at'], now)
+                    or (in_scope is not None and in_scope(entry))
+                )
+            ]
+            # Edited posts are deleted and re-added under the same id
+            edited_ids = [doc.metadata['post_id'] for doc in to_embed if doc.metadata['post_id'] in self.indexed_posts]
+            
+            if stale_ids or edited_ids or to_embed:
+                self._rows = None
+            if stale_ids or edited_ids:
+                self.vectorstore.delete(stale_ids + edited_ids)
+                for post_id in stale_ids + edited_ids:
+                    del self.indexed_posts[post_id]
+            
+            if to_embed:
+                # Only a concurrent sync or removal can leave a post here without a vector
+                vectors.update(self._embed_posts([doc for doc in to_embed if doc.metadata['content_hash'] not in vectors]))
+                ids = [doc.metadata['post_id'] for doc in to_embed]
+                text_embeddings = [(doc.page_content, vectors[doc.metadata['content_hash']]) for doc in to_embed]
+                metadatas = [doc.metadata for doc in to_embed]
+                if self.vectorstore is None:
+                    self.vectorstore = FAISS.from_embeddings(text_embeddings, self.embeddings, metadatas=metadatas, ids=ids)
+                else:
+                    self.vectorstore.add_embeddings(text_embeddings, metadatas=metadatas, ids=ids)
+                for doc in to_embed:
+                    metadata = doc.metadata
+                    self.indexed_posts[metadata['post_id']] = {
+                        'content_hash': metadata['content_hash'],
+                        'latitude': metadata['latitude'],
+                        'longitude': metadata['longitude'],
+                        'expires_at': metadata['expires_at'],
+                    }
+            
+            stats = {
+                'embedded': len(to_embed),
+                'removed': len(stale_ids),
+                'unchanged': refreshed,
+                'total': len(self.indexed_posts),
+            }
+            print(f"Index sync: {stats}")
+            return stats
+    
+    def _needs_embedding(self, doc: Document) -> bool:
+        """A live post that is not indexed yet or whose text changed; call with the lock held"""
+        metadata = doc.metadata
+        if not metadata['post_id'] or self.is_expired(metadata['expires_at']):
+            return False
+        entry = self.indexed_posts.get(metadata['post_id'])
+        return not entry or entry['content_hash'] != metadata['content_hash']
+    
+    def _embed_posts(self, documents: List[Document]) -> Dict[str, List[float]]:
+        """Vectors of the given documents keyed by content hash"""
+        if not documents:
+            return {}
+        print(f"Embedding {len(documents)} new or edited posts...")
+        embedded = self.embeddings.embed_documents([doc.page_content for doc in documents])
+        return {doc.metadata['content_hash']: vector for doc, vector in zip(documents, embedded)}
+    
+    def remove_posts(self, post_ids: List[str]) -> int:
+        """Drop the given posts from the vector store, ignoring ids that are not indexed"""
+        with self._lock:
+            indexed_ids = [post_id for post_id in post_ids if post_id in self.indexed_posts]
+            if indexed_ids:
+                self._rows = None
+                self.vectorstore.delete(indexed_ids)
+                for post_id in indexed_ids:
+                    del self.indexed_posts[post_id]
+            return len(indexed_ids)
+    
     def save_vectorstore(self, path: str = "post_vectorstore"):
-        """Save the vector store to disk"""
-        if self.vectorstore:
-            self.vectorstore.save_local(path)
+        """
+        Save the vector store and its manifest of indexed posts to disk.
+        
+        The workers share `path`, so each save goes to a new sibling directory and `path`, a
+        symlink, is switched over to it with one os.replace: a worker loading the store sees
+        either the previous save or this one, never a half-written index. Versions older than
+        the previous one are pruned once no save can still be switching to them.
+        """
+        with self._lock:
+            if not self.vectorstore:
+                return
+            path = os.path.abspath(path)
+            version = f"{path}.{time.time_ns()}-{os.getpid()}"
+            self.vectorstore.save_local(version)
+            with open(os.path.join(version, self.MANIFEST_FILE), 'w', encoding='utf-8') as file:
+                json.dump(self.indexed_posts, file)
+            
+            previous = os.path.realpath(path) if os.path.islink(path) else None
+            if os.path.isdir(path) and not os.path.islink(path):
+                # A store saved in place before saves were versioned
+                shutil.rmtree(path)
+            link = f"{version}.link"
+            os.symlink(os.path.basename(version), link)
+            os.replace(link, path)
+            self._prune_versions(path, keep={version, previous})
             print(f"Vector store saved to {path}")
     
+    def _prune_versions(self, path: str, keep: set):
+        """Remove saved versions of `path` other than `keep` that are old enough to be unused"""
+        parent, name = os.path.split(path)
+        cutoff = time.time() - self.VERSION_GRACE_SECONDS
+        for entry in os.listdir(parent):
+            version = os.path.join(parent, entry)
+            if not entry.startswith(f"{name}.") or version in keep or not os.path.isdir(version):
+                continue
+            try:
+                if os.path.getmtime(version) < cutoff:
+                    shutil.rmtree(version)
+            except OSError:
+                pass  # Pruned by another worker
+    
     def load_vectorstore(self, path: str = "post_vectorstore"):
-        """Load vector store from disk"""
-        try:
-            self.vectorstore = FAISS.load_local(path, self.embeddings)
-            print(f"Vector store loaded from {path}")
-        except Exception as e:
-            print(f"Could not load vector store: {e}")
+        """Load vector store and its manifest of indexed posts from disk"""
+        with self._lock:
+            try:
+                manifest_path = os.path.join(path, self.MANIFEST_FILE)
+                if not os.path.exists(manifest_path):
+                    # A store without a manifest cannot be synced incrementally, start fresh
+                    print(f"No index manifest found in {path}, starting with an empty index")
+                    return
+                # Resolve the symlink once so the index and manifest come from the same save
+                path = os.path.realpath(path)
+                manifest_path = os.path.join(path, self.MANIFEST_FILE)
+                self.vectorstore = FAISS.load_local(path, self.embeddings, allow_dangerous_deserialization=True)
+                self._rows = None
+                with open(manifest_path, 'r', encoding='utf-8') as file:
+                    self.indexed_posts = json.load(file)
+                print(f"Vector store loaded from {path} ({len(self.indexed_posts)} posts)")
+            except Exception as e:
+                self.vectorstore = None
+                self.indexed_posts = {}
+                print(f"Could not load vector store: {e}")
     
-    def search_similar_posts(self, query: str, top_k: int = 4) -> List[Dict]:
-        """Search for similar posts based on query"""
+    def search_similar_posts(self, query: str, top_k: int = 4, post_ids: Optional[set] = None) -> List[Dict]:
+        """Search for similar posts based on query, optionally restricted to the given post ids"""
         if not self.vectorstore:
             raise ValueError("Vector store not initialized. Please create it first.")
         
@@ -130,8 +438,14 @@ class PostEmbeddingSystem:
         # Perform similarity search
         # results = self.vectorstore.similarity_search_with_score(query, k=top_k)
         
-        retriever = self.vectorstore.as_retriever(search_type="similarity", search_kwargs={"k": top_k})
-        results = retriever.invoke(query)
+        # Embedded apart from the search so the two are timed separately, and outside the lock
+        query_embedding = self.embeddings.embed_query(query)
+        with self._lock, span("faiss_search"):
+            if post_ids is None:
+                results = self.vectorstore.similarity_search_by_vector(query_embedding, k=top_k)
+            else:
+                # The index holds posts from every area, so only the caller's nearby posts are scored
+                results = self._search_rows(query_embedding, top_k, self._rows_of(post_ids))
         
         similar_posts = []
         for doc in results:
@@ -153,6 +467,33 @@ class PostEmbeddingSystem:
         
         return similar_posts
     
+    def _rows_of(self, post_ids: set) -> np.ndarray:
+        """FAISS rows of the given posts that are in the index; call with the lock held"""
+        if self._rows is None:
+            docstore = self.vectorstore.docstore
+            self._rows = {
+                docstore.search(doc_id).metadata['post_id']: row
+                for row, doc_id in self.vectorstore.index_to_docstore_id.items()
+            }
+        return np.fromiter((self._rows[post_id] for post_id in post_ids if post_id in self._rows), dtype=np.int64)
+    
+    def _search_rows(self, query_embedding: List[float], top_k: int, rows: np.ndarray) -> List[Document]:
+        """
+        Nearest documents among the given rows only. The ID selector makes FAISS compute distances
+        for those rows alone, instead of ranking the whole index and filtering the result.
+        """
+        if not len(rows):
+            return []
+        query = np.array([query_embedding], dtype=np.float32)
+        if getattr(self.vectorstore, "_normalize_L2", False):
+            faiss.normalize_L2(query)
+        params = faiss.SearchParameters(sel=faiss.IDSelectorBatch(rows))
+        _, indices = self.vectorstore.index.search(query, min(top_k, len(rows)), params=params)
+        return [
+            self.vectorstore.docstore.search(self.vectorstore.index_to_docstore_id[row])
+            for row in indices[0] if row != -1
+        ]
+    
     def display_search_results(self, results: List[Dict]):
         """Display search results in a formatted way"""
         print(f"\n{'='*60}")
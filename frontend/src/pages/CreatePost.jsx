@@ -33,6 +33,7 @@ import { useAuth } from '../contexts/AuthContext'; // Import useAuth hook
 import { useNavigate } from 'react-router-dom'; // Import useNavigate
 import { collection, addDoc, Timestamp, GeoPoint, doc, getDoc } from 'firebase/firestore';
 import { uploadImage } from '../utils/storage';
+import { encodeGeohash } from '../utils/geohash';
 
 const StyledPaper = styled(Paper)(({ theme }) => ({
   marginTop: theme.spacing(2),
@@ -265,6 +266,7 @@ const CreatePost = () => {
         createdAt: Timestamp.fromDate(createdAt),
         expiresAt: Timestamp.fromDate(expiresAt),
         location: new GeoPoint(location.lat, location.lng),
+        geohash: encodeGeohash(location.lat, location.lng),
         likes: 0,
         likedBy: [],
         eyewitnesses: 0,
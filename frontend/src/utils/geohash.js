@@ -0,0 +1,50 @@
+const BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz';
+
+/**
+ * Encodes a coordinate as a geohash string.
+ * Must stay in sync with encode_geohash in chatbot/geo.py, which runs radius
+ * queries as range scans over the `geohash` field written on every post.
+ * @param {number} latitude - Latitude in decimal degrees
+ * @param {number} longitude - Longitude in decimal degrees
+ * @param {number} precision - Number of geohash characters
+ * @returns {string} The geohash of the coordinate
+ */
+export const encodeGeohash = (latitude, longitude, precision = 9) => {
+  let latMin = -90, latMax = 90;
+  let lonMin = -180, lonMax = 180;
+  let hash = '';
+  let bits = 0;
+  let bitCount = 0;
+  let evenBit = true;
+
+  while (hash.length < precision) {
+    if (evenBit) {
+      const mid = (lonMin + lonMax) / 2;
+      if (longitude >= mid) {
+        bits = bits * 2 + 1;
+        lonMin = mid;
+      } else {
+        bits = bits * 2;
+        lonMax = mid;
+      }
+    } else {
+      const mid = (latMin + latMax) / 2;
+      if (latitude >= mid) {
+        bits = bits * 2 + 1;
+        latMin = mid;
+      } else {
+        bits = bits * 2;
+        latMax = mid;
+      }
+    }
+    evenBit = !evenBit;
+
+    if (++bitCount === 5) {
+      hash += BASE32[bits];
+      bits = 0;
+      bitCount = 0;
+    }
+  }
+
+  return hash;
+};